@@ -0,0 +1,113 @@
+"""Plugin configuration.
+
+Configuration is read from the ACA-Py plugin config under the plugin name, e.g.:
+
+    --plugin-config-value acapy_plugin_pickup.backend=sqlite
+    --plugin-config-value acapy_plugin_pickup.sqlite.path=/data/pickup.db
+"""
+
+from typing import Optional
+
+from aries_cloudagent.config.base import BaseSettings
+from aries_cloudagent.config.plugin_settings import PluginSettings
+from pydantic import BaseModel, Field
+from typing_extensions import Literal
+
+
+PLUGIN_NAME = "acapy_plugin_pickup"
+
+
+class SqliteConfig(BaseModel):
+    """Configuration of the SQLite queue backend."""
+
+    path: str = "pickup-queue.db"
+    # Writes are committed together once this many are pending...
+    batch_size: int = 512
+    # ...or once the oldest pending write is this many seconds old
+    flush_interval: float = 0.01
+
+
+class RedisConfig(BaseModel):
+    """Configuration of the Redis queue backend."""
+
+    url: str = "redis://localhost:6379/0"
+    # Prefix of all keys used by the queue
+    prefix: str = "pickup:"
+
+
+class SpillConfig(BaseModel):
+    """Configuration of the spill backend."""
+
+    # Directory of the segment files (a temporary directory if unset)
+    directory: Optional[str] = None
+    # Payloads are held in memory up to this many bytes, older ones spilled
+    memory_bytes: int = 64 * 2**20
+    # Segment files are sealed once this large and a new one started
+    segment_bytes: int = 64 * 2**20
+    # Sealed segments are compacted once this fraction of their bytes is of
+    # removed messages
+    compact_ratio: float = Field(0.75, gt=0, le=1)
+
+
+class LimitsConfig(BaseModel):
+    """Limits on undelivered messages; a limit of None is disabled."""
+
+    # Messages are expired this many seconds after being queued
+    ttl: Optional[float] = None
+    # Caps on the messages queued for each recipient key...
+    max_messages_per_key: Optional[int] = None
+    max_bytes_per_key: Optional[int] = None
+    # ...and on all queued messages
+    max_messages: Optional[int] = None
+    max_bytes: Optional[int] = None
+    # A message that would exceed a cap either makes room by evicting the
+    # oldest messages queued, or is dropped itself
+    policy: Literal["drop-oldest", "reject-new"] = "drop-oldest"
+
+    @property
+    def capped(self) -> bool:
+        """Return whether any cap is set."""
+        return any(
+            cap is not None
+            for cap in (
+                self.max_messages_per_key,
+                self.max_bytes_per_key,
+                self.max_messages,
+                self.max_bytes,
+            )
+        )
+
+
+class CompressionConfig(BaseModel):
+    """Compression of stored encrypted payloads; disabled without a codec."""
+
+    codec: Optional[Literal["zlib", "lzma"]] = None
+    # Payloads smaller than this many bytes are stored as is
+    min_size: int = 1024
+    # Compression level of zlib, or preset of lzma, from 0 (fastest) to 9
+    level: int = Field(6, ge=0, le=9)
+
+
+class PickupConfig(BaseModel):
+    """Configuration of the pickup plugin."""
+
+    backend: Literal["memory", "spill", "sqlite", "redis"] = "memory"
+    # Longest a delivery request may wait for messages to arrive, in seconds
+    max_wait: float = 60.0
+    # Largest size of a delivery in bytes, though at least one message is sent
+    max_delivery_bytes: Optional[int] = None
+    # Seconds delivered messages are skipped by later deliveries unless
+    # acknowledged first (unset: delivered again until acknowledged)
+    lease_timeout: Optional[float] = None
+    # Plaintext messages encrypted concurrently in the background (0 disables)
+    encode_concurrency: int = 4
+    sqlite: SqliteConfig = SqliteConfig()
+    redis: RedisConfig = RedisConfig()
+    spill: SpillConfig = SpillConfig()
+    limits: LimitsConfig = LimitsConfig()
+    compression: CompressionConfig = CompressionConfig()
+
+    @classmethod
+    def from_settings(cls, settings: BaseSettings) -> "PickupConfig":
+        """Load configuration from ACA-Py settings."""
+        return cls.parse_obj(PluginSettings.for_plugin(settings, PLUGIN_NAME).to_dict())
@@ -0,0 +1,178 @@
+"""Encryption of queued plaintext messages ahead of pickup.
+
+Messages sent by the mediator itself are queued in plaintext and must be
+encrypted before they can be delivered. Doing so in the delivery request
+makes the recipient wait for every encryption in turn. The encoder defined
+here encrypts them in the background as soon as they are queued, with
+bounded concurrency, so that deliveries only read ready-made payloads.
+
+A scan task per recipient key (at most one at a time) walks the messages
+queued since its last scan and hands plaintext ones to a fixed pool of
+workers through a bounded queue, which holds scans back when the workers fall
+behind. A message the delivery path needs before a worker got to it is
+encrypted there, sharing any encryption already in progress.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from aries_cloudagent.core.profile import Profile, ProfileSession
+from aries_cloudagent.transport.outbound.message import OutboundMessage
+from aries_cloudagent.transport.wire_format import BaseWireFormat
+
+from .metrics import EncoderMetrics
+from .queue import PickupQueue, PickupQueuedMessage
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+async def encode_queued(
+    queue: PickupQueue,
+    key: str,
+    queued: PickupQueuedMessage,
+    profile_session: ProfileSession,
+    wire_format: BaseWireFormat,
+    default_recipient_key: Optional[str] = None,
+):
+    """Encrypt a plaintext message queued for key and record its payload."""
+    msg = queued.msg
+    target = msg.target_list[0]
+    await queue.store_enc_payload(
+        queued,
+        await wire_format.encode_message(
+            profile_session,
+            msg.payload,
+            target.recipient_keys or default_recipient_key,
+            target.routing_keys or [],
+            target.sender_key or key,
+        ),
+    )
+
+
+class PayloadEncoder:
+    """Encrypt plaintext queued messages in the background."""
+
+    def __init__(self, queue: PickupQueue, profile: Profile, *, concurrency: int = 4):
+        """Initialize the encoder, subscribing to newly queued messages."""
+        self.queue = queue
+        self.profile = profile
+        self.concurrency = concurrency
+        self.metrics = EncoderMetrics()
+        self._work: "asyncio.Queue[Tuple[str, PickupQueuedMessage]]" = asyncio.Queue(
+            2 * concurrency
+        )
+        self._workers: List[asyncio.Task] = []
+        self._active = 0
+        self._pending: Set[str] = set()
+        self._scanning: Dict[str, asyncio.Task] = {}
+        self._last_seqs: Dict[str, int] = {}
+        self._in_flight: Dict[Tuple[str, int], asyncio.Future] = {}
+        queue.subscribe(self.notify)
+
+    @property
+    def backlog(self) -> int:
+        """Return the number of messages found awaiting background encryption."""
+        return self._work.qsize() + self._active
+
+    @property
+    def pending_keys(self) -> int:
+        """Return the number of keys with newly queued messages not yet scanned."""
+        return len(self._pending)
+
+    def start(self):
+        """Start the workers."""
+        loop = asyncio.get_running_loop()
+        self._workers = [
+            loop.create_task(self._run_worker()) for _ in range(self.concurrency)
+        ]
+
+    def notify(self, key: str, msg: OutboundMessage):
+        """Scan key for plaintext messages; called for each queued message."""
+        if msg.enc_payload or not msg.target_list or not self._workers:
+            return
+        self._pending.add(key)
+        if key not in self._scanning:
+            self._scanning[key] = asyncio.get_running_loop().create_task(
+                self._scan(key)
+            )
+
+    async def _scan(self, key: str):
+        try:
+            # Messages queued while scanning mark the key pending again
+            while key in self._pending:
+                self._pending.discard(key)
+                async for queued in self.queue.messages_for_key(
+                    key, after=self._last_seqs.get(key, 0)
+                ):
+                    self._last_seqs[key] = queued.seq
+                    if not queued.encrypted and queued.msg.target_list:
+                        await self._work.put((key, queued))
+        except Exception:
+            LOGGER.exception("Failed to scan queued messages for %s", key)
+        finally:
+            del self._scanning[key]
+            if not await self.queue.count_for_key(key):
+                self._last_seqs.pop(key, None)
+
+    async def _run_worker(self):
+        while True:
+            key, queued = await self._work.get()
+            self._active += 1
+            try:
+                await self.encode(key, queued)
+            except Exception:
+                LOGGER.exception("Failed to encode queued message for %s", key)
+            finally:
+                self._active -= 1
+
+    async def encode(
+        self,
+        key: str,
+        queued: PickupQueuedMessage,
+        default_recipient_key: Optional[str] = None,
+    ):
+        """Encrypt a plaintext message queued for key, unless it already is.
+
+        An encryption of the same message already in progress is shared.
+        """
+        if queued.encrypted:
+            return
+        token = (key, queued.seq)
+        in_flight = self._in_flight.get(token)
+        if in_flight is not None:
+            enc_payload = await asyncio.shield(in_flight)
+            if enc_payload:
+                await self.queue.store_enc_payload(queued, enc_payload)
+                return
+
+        in_flight = self._in_flight[token] = asyncio.get_running_loop().create_future()
+        started = time.perf_counter()
+        try:
+            async with self.profile.session() as profile_session:
+                await encode_queued(
+                    self.queue,
+                    key,
+                    queued,
+                    profile_session,
+                    self.profile.inject(BaseWireFormat),
+                    default_recipient_key,
+                )
+        except Exception:
+            self.metrics.failed += 1
+            raise
+        else:
+            self.metrics.observe(time.perf_counter() - started)
+        finally:
+            # Sharers encrypt the message themselves if this failed
+            in_flight.set_result(queued.payload)
+            del self._in_flight[token]
+
+    async def close(self):
+        """Stop encoding messages."""
+        self.queue.unsubscribe(self.notify)
+        for task in (*self._workers, *self._scanning.values()):
+            task.cancel()
+        self._workers = []
@@ -0,0 +1,116 @@
+"""Forward messages turned away while their recipient is over its queue caps.
+
+ACA-Py accepts every forward message and queues it for pickup when the
+recipient is not connected, telling the sender nothing. When the queue
+rejects new messages over its caps, forward messages that would be queued
+(the recipient has no endpoint and no open session) are checked against the
+caps of the recipient key first, from the same aggregates its status reports.
+A forward that would exceed them is answered with a problem report rather
+than forwarded, so that a sender flooding a recipient is told to back off
+and nothing is queued. Other forwards are handled by ACA-Py's handler.
+"""
+
+import json
+import logging
+from typing import Optional
+
+from aries_cloudagent.messaging.base_handler import BaseResponder, RequestContext
+from aries_cloudagent.protocols.connections.v1_0.manager import ConnectionManager
+from aries_cloudagent.protocols.didcomm_prefix import DIDCommPrefix
+from aries_cloudagent.protocols.problem_report.v1_0.message import ProblemReport
+from aries_cloudagent.protocols.routing.v1_0.handlers.forward_handler import (
+    ForwardHandler,
+)
+from aries_cloudagent.protocols.routing.v1_0.manager import (
+    RoutingManager,
+    RoutingManagerError,
+)
+from aries_cloudagent.protocols.routing.v1_0.message_types import FORWARD
+from aries_cloudagent.protocols.routing.v1_0.messages.forward import (
+    Forward,
+    ForwardSchema,
+)
+from aries_cloudagent.transport.inbound.manager import InboundTransportManager
+from marshmallow import EXCLUDE
+
+from .queue import get_pickup_queue
+from .sessions import session_for_verkey
+
+LOGGER = logging.getLogger(__name__)
+
+MESSAGE_TYPES = DIDCommPrefix.qualify_all(
+    {FORWARD: "acapy_plugin_pickup.forward.CappedForward"}
+)
+
+
+async def queued_recipient(
+    context: RequestContext, manager: InboundTransportManager
+) -> Optional[str]:
+    """Return the recipient key a forward would be queued for, if queued at all.
+
+    ACA-Py sends a forward to the endpoint of its recipient, or returns it over
+    an open session of the recipient key, and only queues it otherwise.
+    """
+    try:
+        recipient = await RoutingManager(context.profile).get_recipient(
+            context.message.to
+        )
+    except RoutingManagerError:
+        # Left to ACA-Py's handler to report
+        return None
+    targets = await ConnectionManager(context.profile).get_connection_targets(
+        connection_id=recipient.connection_id
+    )
+    if not targets or any(target.endpoint for target in targets):
+        return None
+    verkey = targets[0].recipient_keys[0]
+    if session_for_verkey(manager, verkey):
+        return None
+    return verkey
+
+
+class CappedForwardHandler(ForwardHandler):
+    """Forward a message unless it would be queued over its recipient's caps."""
+
+    async def handle(self, context: RequestContext, responder: BaseResponder):
+        """Handle forward message."""
+        message = context.message
+        assert isinstance(message, CappedForward)
+        manager = context.inject_or(InboundTransportManager)
+        queue = get_pickup_queue(manager) if manager else None
+        if queue and context.message_receipt.recipient_verkey:
+            verkey = await queued_recipient(context, manager)
+            size = len(json.dumps(message.msg).encode("ascii"))
+            if verkey and not await queue.admit(verkey, size):
+                LOGGER.info("Forward to %s rejected: recipient over queue caps", verkey)
+                report = ProblemReport(
+                    description={
+                        "en": "Recipient has too many undelivered messages",
+                        "code": "e.m.recipient-over-quota",
+                    }
+                )
+                report.assign_thread_from(message)
+                await responder.send_reply(report)
+                return
+        await super().handle(context, responder)
+
+
+class CappedForward(Forward):
+    """Forward message, handled within the queue caps of its recipient."""
+
+    class Meta:
+        """CappedForward metadata."""
+
+        handler_class = "acapy_plugin_pickup.forward.CappedForwardHandler"
+        message_type = FORWARD
+        schema_class = "CappedForwardSchema"
+
+
+class CappedForwardSchema(ForwardSchema):
+    """CappedForward message schema."""
+
+    class Meta:
+        """CappedForwardSchema metadata."""
+
+        model_class = CappedForward
+        unknown = EXCLUDE
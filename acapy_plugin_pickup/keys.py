@@ -0,0 +1,157 @@
+"""Index of the recipient keys each connection may pick up messages for.
+
+A pickup request may name the recipient key whose messages it is about. A
+connection owns the keys ACA-Py queues its messages under (the recipient keys
+of its connection targets) and the routing keys it registered with the
+mediator. Reading these takes storage queries, so the keys of a connection are
+read on its first request naming a key other than its own and then served
+from memory. A key missing from them is looked up again, at most once a
+second, in case it was registered since; ACA-Py emits no event as routing
+keys change, so all keys are read again after a minute for removed keys to
+stop being served, and a connection whose record changes (or is deleted) is
+dropped at once. At most max_connections connections are kept, those used
+least recently dropped first, and a connection unused for a refresh interval
+is dropped as others are read, so the index stays bounded however many
+connections come and go.
+"""
+
+from collections import OrderedDict
+import logging
+import re
+import time
+from typing import FrozenSet, Optional, Tuple
+
+from aries_cloudagent.core.event_bus import Event, EventBus
+from aries_cloudagent.core.profile import Profile
+from aries_cloudagent.messaging.request_context import RequestContext
+from aries_cloudagent.protocols.connections.v1_0.manager import ConnectionManager
+from aries_cloudagent.protocols.routing.v1_0.manager import RoutingManager
+
+LOGGER = logging.getLogger(__name__)
+
+# Topic of events emitted as connection records change
+CONNECTION_EVENTS = r"^acapy::record::connections::"
+
+
+class RecipientKeyIndex:
+    """Map connections to the recipient keys they may pick up messages for."""
+
+    def __init__(
+        self,
+        refresh_interval: float = 60.0,
+        miss_interval: float = 1.0,
+        max_connections: int = 10000,
+    ):
+        """Initialize the index."""
+        # Keys are read again after refresh_interval seconds, or after
+        # miss_interval seconds when a key is not found among them
+        self.refresh_interval = refresh_interval
+        self.miss_interval = miss_interval
+        self.max_connections = max_connections
+        # Keys of each connection and when they were read, least recently used
+        # connection first
+        self.keys_by_connection: "OrderedDict[str, Tuple[FrozenSet[str], float]]" = (
+            OrderedDict()
+        )
+
+    async def keys_for_connection(
+        self, profile: Profile, connection_id: str, max_age: Optional[float] = None
+    ) -> FrozenSet[str]:
+        """Return the recipient keys of a connection, read at most max_age ago."""
+        max_age = self.refresh_interval if max_age is None else max_age
+        now = time.monotonic()
+        cached = self.keys_by_connection.get(connection_id)
+        if cached is not None and now - cached[1] < max_age:
+            self.keys_by_connection.move_to_end(connection_id)
+            return cached[0]
+        keys = await self._read_keys(profile, connection_id)
+        self.keys_by_connection[connection_id] = (keys, now)
+        self.keys_by_connection.move_to_end(connection_id)
+        self._prune(now)
+        return keys
+
+    def _prune(self, now: float):
+        """Drop the connections least recently used, past the bound or unused."""
+        connections = self.keys_by_connection
+        while connections:
+            _, (_, read) = next(iter(connections.items()))
+            if (
+                len(connections) <= self.max_connections
+                and now - read < self.refresh_interval
+            ):
+                break
+            connections.popitem(last=False)
+
+    async def _read_keys(self, profile: Profile, connection_id: str) -> FrozenSet[str]:
+        targets = await ConnectionManager(profile).get_connection_targets(
+            connection_id=connection_id
+        )
+        routes = await RoutingManager(profile).get_routes(
+            client_connection_id=connection_id
+        )
+        keys = frozenset(
+            [key for target in targets or () for key in target.recipient_keys]
+            + [route.recipient_key for route in routes]
+        )
+        LOGGER.debug("Connection %s owns %d recipient keys", connection_id, len(keys))
+        return keys
+
+    async def owns(self, profile: Profile, connection_id: str, key: str) -> bool:
+        """Return whether a connection owns a recipient key."""
+        if key in await self.keys_for_connection(profile, connection_id):
+            return True
+        # Read again, in case the key was registered since the keys were read
+        return key in await self.keys_for_connection(
+            profile, connection_id, self.miss_interval
+        )
+
+    def discard(self, connection_id: str):
+        """Drop the keys of a connection, to be read again when next needed."""
+        self.keys_by_connection.pop(connection_id, None)
+
+    async def on_connection_event(self, profile: Profile, event: Event):
+        """Drop the keys of a connection whose record changed."""
+        connection_id = (event.payload or {}).get("connection_id")
+        if connection_id:
+            self.discard(connection_id)
+
+    @classmethod
+    def bind(cls, profile: Profile) -> "RecipientKeyIndex":
+        """Return the index of the profile, binding a new one on first use."""
+        index = profile.inject_or(cls)
+        if index is None:
+            index = cls()
+            profile.context.injector.bind_instance(cls, index)
+            event_bus = profile.inject_or(EventBus)
+            if event_bus:
+                event_bus.subscribe(
+                    re.compile(CONNECTION_EVENTS), index.on_connection_event
+                )
+        return index
+
+
+async def requested_key(
+    context: RequestContext, recipient_key: Optional[str]
+) -> Optional[str]:
+    """Return the key whose messages a request is about, if the sender owns it.
+
+    That is the sender's own verkey unless the request names a recipient key,
+    which must then be owned by the connection the request came over; None is
+    returned otherwise.
+    """
+    sender = context.message_receipt.sender_verkey
+    if recipient_key is None or recipient_key == sender:
+        return sender
+    connection = context.connection_record
+    if connection is None:
+        return None
+    index = context.inject_or(RecipientKeyIndex) or RecipientKeyIndex.bind(
+        context.profile
+    )
+    if await index.owns(context.profile, connection.connection_id, recipient_key):
+        return recipient_key
+    LOGGER.info(
+        "Connection %s asked for messages of a recipient key it does not own",
+        connection.connection_id,
+    )
+    return None
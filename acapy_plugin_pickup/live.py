@@ -0,0 +1,170 @@
+"""Registry of recipient keys in live mode.
+
+With live mode (Pickup Protocol 2.0) enabled for a recipient key, messages
+queued for it are pushed over the session that enabled it as soon as they
+arrive, so the recipient no longer needs to poll. Pushed messages stay queued
+until the recipient acknowledges them, as with any delivery.
+
+The registry is notified by the pickup queue of every newly queued message and
+runs at most one push task per live key, which sends the messages queued
+since its last push, one batch at a time. A batch waits for the session to
+send its previous response; if it does not in time, the messages stay queued
+and are pushed along with the next message queued for the key.
+"""
+
+from abc import ABC, abstractmethod
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Set
+
+from aries_cloudagent.transport.inbound.session import InboundSession
+from aries_cloudagent.transport.outbound.message import OutboundMessage
+
+from .queue import PickupQueue
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class LiveSession:
+    """Session messages for a live recipient key are pushed over.
+
+    Attributes:
+        session: the open session that enabled live mode
+        reply_from_verkey: mediator key used to encrypt pushed messages
+        last_seq: sequence number of the last message pushed
+
+    """
+
+    __slots__ = ("session", "reply_from_verkey", "last_seq")
+
+    def __init__(self, session: InboundSession, reply_from_verkey: Optional[str]):
+        """Initialize the live session."""
+        self.session = session
+        self.reply_from_verkey = reply_from_verkey
+        self.last_seq = 0
+
+    @property
+    def closed(self) -> bool:
+        """Return whether messages can no longer be pushed over the session."""
+        return self.session.closed
+
+
+class LiveSessions(ABC):
+    """Track live recipient keys and push newly queued messages to them.
+
+    How messages are pushed is left to the protocol, through push.
+    """
+
+    def __init__(self, queue: PickupQueue, *, send_timeout: float = 30.0):
+        """Initialize the registry, subscribing to newly queued messages."""
+        self.queue = queue
+        self.send_timeout = send_timeout
+        self.sessions: Dict[str, LiveSession] = {}
+        self._pending: Set[str] = set()
+        self._pushing: Dict[str, asyncio.Task] = {}
+        queue.subscribe(self.notify)
+
+    def enable(
+        self, key: str, session: InboundSession, reply_from_verkey: Optional[str]
+    ):
+        """Enable live mode for key over session and push its queued messages."""
+        self.sessions[key] = LiveSession(session, reply_from_verkey)
+        self.notify(key)
+
+    def disable(self, key: str):
+        """Disable live mode for key."""
+        live = self.sessions.pop(key, None)
+        self._pending.discard(key)
+        if live is not None:
+            # Let a push waiting for the session give up
+            live.session.response_event.set()
+
+    def session_for(self, key: str) -> Optional[LiveSession]:
+        """Return the live session of key, dropping it if it has closed."""
+        live = self.sessions.get(key)
+        if live is not None and live.closed:
+            LOGGER.debug("Live session for %s closed, disabling live mode", key)
+            self.disable(key)
+            return None
+        return live
+
+    def is_live(self, key: str) -> bool:
+        """Return whether live mode is enabled for key."""
+        return self.session_for(key) is not None
+
+    def notify(self, key: str, msg: Optional[OutboundMessage] = None):
+        """Push messages for key if it is live; called for each queued message."""
+        if key not in self.sessions:
+            return
+        self._pending.add(key)
+        if key not in self._pushing:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                LOGGER.debug("No running loop; messages for %s pushed later", key)
+                return
+            self._pushing[key] = loop.create_task(self._push_pending(key))
+
+    async def _push_pending(self, key: str):
+        try:
+            # Messages queued while pushing mark the key pending again
+            while key in self._pending:
+                self._pending.discard(key)
+                while True:
+                    live = self.session_for(key)
+                    if live is None or not await self.push(key, live):
+                        break
+        except Exception:
+            LOGGER.exception("Failed to push messages for %s", key)
+        finally:
+            del self._pushing[key]
+
+    @abstractmethod
+    async def push(self, key: str, live: LiveSession) -> bool:
+        """Push a batch of messages queued after live.last_seq over live.session.
+
+        Return whether any messages were pushed.
+        """
+
+    async def send(
+        self, key: str, live: LiveSession, outbound: OutboundMessage
+    ) -> bool:
+        """Hand an outbound message to the live session once it is free.
+
+        The session holds a single response at a time, so wait up to
+        send_timeout for the previous response to be sent, leaving the
+        messages queued if it is not. Return False if the message was not
+        handed over, disabling live mode if the session closed or no longer
+        accepts messages for the key.
+        """
+        session = live.session
+        deadline = time.monotonic() + self.send_timeout
+        while not live.closed and self.sessions.get(key) is live:
+            result = session.accept_response(outbound)
+            if result.accepted:
+                return True
+            if not result.retry:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                LOGGER.debug("Live session for %s busy; messages left queued", key)
+                return False
+            # Set as the session's response is sent or cleared, or it closes
+            session.response_event.clear()
+            try:
+                await asyncio.wait_for(session.response_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        if self.sessions.get(key) is live:
+            self.disable(key)
+        return False
+
+    async def close(self):
+        """Stop pushing messages."""
+        self.queue.unsubscribe(self.notify)
+        self.sessions.clear()
+        self._pending.clear()
+        for task in list(self._pushing.values()):
+            task.cancel()
@@ -0,0 +1,439 @@
+"""Metrics of the pickup plugin, exposed in the Prometheus text format.
+
+Counters and histograms are plain objects updated in place as messages are
+handled: recording a request costs a few additions and a bisection over the
+bucket bounds, without locks since handlers share the event loop. The state
+of the queue (number, size and age of the messages queued per key) is only
+computed when the metrics are collected through the admin route.
+"""
+
+from bisect import bisect_left
+from functools import wraps
+import time
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Union,
+)
+
+from .queue import PickupQueue, PickupQueuedMessage, SpillPickupQueue
+
+if TYPE_CHECKING:
+    from .encoder import PayloadEncoder
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds of histogram buckets
+SECONDS_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+AGE_BUCKETS = (1, 10, 60, 300, 900, 3600, 21600, 86400, 259200, 604800)
+DEPTH_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 100000)
+
+Number = Union[int, float]
+
+
+class Counter:
+    """Monotonically increasing count."""
+
+    __slots__ = ("value",)
+
+    def __init__(self):
+        """Initialize the counter."""
+        self.value = 0
+
+    def inc(self, amount: Number = 1):
+        """Increase the count by amount."""
+        self.value += amount
+
+
+class Histogram:
+    """Count of observed values by bucket, with their number and sum."""
+
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets: Sequence[Number]):
+        """Initialize the histogram with the upper bounds of its buckets."""
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: Number):
+        """Record a value."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class EncoderMetrics:
+    """Counters of the encoder.
+
+    Attributes:
+        encoded: messages encrypted
+        failed: messages that could not be encrypted
+        encode_seconds: total time spent encrypting messages
+        max_encode_seconds: longest time spent encrypting a message
+        durations: histogram of the time spent encrypting each message
+
+    """
+
+    def __init__(self):
+        """Initialize the counters."""
+        self.encoded = 0
+        self.failed = 0
+        self.encode_seconds = 0.0
+        self.max_encode_seconds = 0.0
+        self.durations = Histogram(SECONDS_BUCKETS)
+
+    def observe(self, seconds: float):
+        """Record the encryption of a message taking seconds."""
+        self.encoded += 1
+        self.encode_seconds += seconds
+        if seconds > self.max_encode_seconds:
+            self.max_encode_seconds = seconds
+        self.durations.observe(seconds)
+
+
+class HandlerMetrics:
+    """Requests handled by a handler, failed requests and handling time."""
+
+    __slots__ = ("requests", "errors", "seconds")
+
+    def __init__(self):
+        """Initialize the metrics."""
+        self.requests = Counter()
+        self.errors = Counter()
+        self.seconds = Histogram(SECONDS_BUCKETS)
+
+
+class PickupMetrics:
+    """Metrics of message handling, bound in the injection context at startup.
+
+    Attributes:
+        handlers: metrics of each handler, by name
+        messages_delivered: messages delivered, by request or live
+        bytes_delivered: encrypted payload bytes delivered
+        messages_acked: messages removed on acknowledgement
+        delivery_age: histogram of the time messages waited until delivered
+
+    """
+
+    def __init__(self):
+        """Initialize the metrics."""
+        self.handlers: Dict[str, HandlerMetrics] = {}
+        self.messages_delivered = Counter()
+        self.bytes_delivered = Counter()
+        self.messages_acked = Counter()
+        self.delivery_age = Histogram(AGE_BUCKETS)
+
+    def handler(self, name: str) -> HandlerMetrics:
+        """Return the metrics of a handler."""
+        metrics = self.handlers.get(name)
+        if metrics is None:
+            metrics = self.handlers[name] = HandlerMetrics()
+        return metrics
+
+    def delivered(self, queued_messages: Iterable[PickupQueuedMessage]):
+        """Record the delivery of queued messages."""
+        now = time.time()
+        for queued in queued_messages:
+            self.messages_delivered.value += 1
+            self.bytes_delivered.value += queued.size or 0
+            self.delivery_age.observe(now - queued.timestamp)
+
+    def acked(self, count: int):
+        """Record the removal of acknowledged messages."""
+        self.messages_acked.inc(count)
+
+    async def render(
+        self,
+        queue: Optional[PickupQueue] = None,
+        encoder: Optional["PayloadEncoder"] = None,
+    ) -> str:
+        """Return the metrics in the Prometheus text format.
+
+        The messages queued for every key are summarized when a queue is given;
+        encoding metrics are included when an encoder is given.
+        """
+        text = _Exposition()
+        text.family(
+            "pickup_handler_requests_total",
+            "counter",
+            "Pickup messages handled, by handler",
+        )
+        for name, metrics in self.handlers.items():
+            text.sample(
+                "pickup_handler_requests_total", metrics.requests.value, handler=name
+            )
+        text.family(
+            "pickup_handler_errors_total",
+            "counter",
+            "Pickup messages whose handling failed, by handler",
+        )
+        for name, metrics in self.handlers.items():
+            text.sample(
+                "pickup_handler_errors_total", metrics.errors.value, handler=name
+            )
+        text.family(
+            "pickup_handler_seconds",
+            "histogram",
+            "Time spent handling pickup messages, including waiting for messages",
+        )
+        for name, metrics in self.handlers.items():
+            text.histogram("pickup_handler_seconds", metrics.seconds, handler=name)
+
+        text.counter(
+            "pickup_messages_delivered_total",
+            "Messages delivered, by request or live",
+            self.messages_delivered.value,
+        )
+        text.counter(
+            "pickup_bytes_delivered_total",
+            "Encrypted payload bytes delivered",
+            self.bytes_delivered.value,
+        )
+        text.counter(
+            "pickup_messages_acked_total",
+            "Messages removed on acknowledgement",
+            self.messages_acked.value,
+        )
+        text.family(
+            "pickup_delivery_age_seconds",
+            "histogram",
+            "Time messages were queued before being delivered",
+        )
+        text.histogram("pickup_delivery_age_seconds", self.delivery_age)
+
+        if queue is not None:
+            await _render_queue(text, queue)
+        if encoder is not None:
+            _render_encoder(text, encoder)
+        return text.render()
+
+
+def observed(name: str):
+    """Record the metrics of the decorated handle method of a message under name.
+
+    Nothing is recorded unless PickupMetrics are bound in the context.
+    """
+
+    def decorator(handle):
+        @wraps(handle)
+        async def observed_handle(self, context, responder):
+            metrics = context.inject_or(PickupMetrics)
+            if metrics is None:
+                return await handle(self, context, responder)
+            handler = metrics.handler(name)
+            handler.requests.value += 1
+            started = time.perf_counter()
+            try:
+                return await handle(self, context, responder)
+            except Exception:
+                handler.errors.value += 1
+                raise
+            finally:
+                handler.seconds.observe(time.perf_counter() - started)
+
+        return observed_handle
+
+    return decorator
+
+
+async def _render_queue(text: "_Exposition", queue: PickupQueue):
+    now = time.time()
+    keys = messages = size = 0
+    oldest = None
+    depth = Histogram(DEPTH_BUCKETS)
+    age = Histogram(AGE_BUCKETS)
+    async for _, stats in queue.stats_by_key():
+        keys += 1
+        messages += stats.count
+        size += stats.total_size
+        depth.observe(stats.count)
+        if stats.oldest is not None:
+            age.observe(now - stats.oldest)
+            oldest = stats.oldest if oldest is None else min(oldest, stats.oldest)
+
+    text.gauge("pickup_queue_keys", "Recipient keys with queued messages", keys)
+    text.gauge("pickup_queue_messages", "Messages queued", messages)
+    text.gauge("pickup_queue_bytes", "Total size of queued messages", size)
+    text.gauge(
+        "pickup_queue_oldest_age_seconds",
+        "Time the oldest queued message has waited",
+        0 if oldest is None else now - oldest,
+    )
+    text.counter(
+        "pickup_messages_expired_total",
+        "Messages removed undelivered after the ttl",
+        queue.expired,
+    )
+    text.counter(
+        "pickup_messages_evicted_total",
+        "Messages removed undelivered to make room under the queue caps",
+        queue.evicted,
+    )
+    text.counter(
+        "pickup_messages_rejected_total",
+        "Messages not queued as they would exceed the queue caps",
+        queue.rejected,
+    )
+    compressor = queue.compressor
+    if compressor.config.codec:
+        text.counter(
+            "pickup_payloads_compressed_total",
+            "Encrypted payloads compressed as they were stored",
+            compressor.compressed,
+        )
+        text.gauge(
+            "pickup_compression_ratio",
+            "Size of the payloads compressed over their size as stored",
+            compressor.ratio,
+        )
+        text.counter(
+            "pickup_compression_saved_bytes_total",
+            "Bytes saved by compressing stored payloads",
+            compressor.bytes_in - compressor.bytes_out,
+        )
+        text.counter(
+            "pickup_compress_seconds_total",
+            "CPU time spent compressing stored payloads",
+            compressor.compress_seconds,
+        )
+        text.counter(
+            "pickup_payloads_decompressed_total",
+            "Stored payloads decompressed for delivery",
+            compressor.decompressed,
+        )
+        text.counter(
+            "pickup_decompress_seconds_total",
+            "CPU time spent decompressing stored payloads for delivery",
+            compressor.decompress_seconds,
+        )
+    if isinstance(queue, SpillPickupQueue):
+        text.gauge(
+            "pickup_spill_resident_bytes",
+            "Size of the stored payloads held in memory",
+            queue.resident_bytes,
+        )
+        text.gauge(
+            "pickup_spill_bytes",
+            "Size of the stored payloads of queued messages in segment files",
+            queue.spilled_bytes,
+        )
+        text.gauge(
+            "pickup_spill_segment_bytes",
+            "Size of the segment files, including payloads of removed messages",
+            queue.disk_bytes,
+        )
+        text.gauge("pickup_spill_segments", "Segment files", len(queue.segments))
+        text.counter(
+            "pickup_payloads_spilled_total",
+            "Payloads moved from memory to segment files",
+            queue.spilled,
+        )
+        text.counter(
+            "pickup_spill_compactions_total",
+            "Segment files compacted",
+            queue.compactions,
+        )
+    text.family(
+        "pickup_queue_depth",
+        "histogram",
+        "Messages queued per recipient key, at collection",
+    )
+    text.histogram("pickup_queue_depth", depth)
+    text.family(
+        "pickup_queue_age_seconds",
+        "histogram",
+        "Time the oldest message of each recipient key has waited, at collection",
+    )
+    text.histogram("pickup_queue_age_seconds", age)
+
+
+def _render_encoder(text: "_Exposition", encoder: "PayloadEncoder"):
+    metrics = encoder.metrics
+    text.family(
+        "pickup_encode_seconds",
+        "histogram",
+        "Time spent encrypting messages queued in plaintext",
+    )
+    text.histogram("pickup_encode_seconds", metrics.durations)
+    text.counter(
+        "pickup_encode_failures_total",
+        "Messages queued in plaintext that could not be encrypted",
+        metrics.failed,
+    )
+    text.gauge(
+        "pickup_encode_backlog",
+        "Messages found awaiting background encryption",
+        encoder.backlog,
+    )
+
+
+class _Exposition:
+    """Lines of metrics in the Prometheus text format."""
+
+    def __init__(self):
+        self.lines: List[str] = []
+
+    def family(self, name: str, kind: str, description: str):
+        self.lines.append(f"# HELP {name} {description}")
+        self.lines.append(f"# TYPE {name} {kind}")
+
+    def sample(self, name: str, value: Number, **labels: str):
+        self.lines.append(f"{name}{_labels(labels)} {_number(value)}")
+
+    def counter(self, name: str, description: str, value: Number):
+        self.family(name, "counter", description)
+        self.sample(name, value)
+
+    def gauge(self, name: str, description: str, value: Number):
+        self.family(name, "gauge", description)
+        self.sample(name, value)
+
+    def histogram(self, name: str, histogram: Histogram, **labels: str):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            self.sample(f"{name}_bucket", cumulative, **labels, le=_number(bound))
+        self.sample(f"{name}_bucket", histogram.count, **labels, le="+Inf")
+        self.sample(f"{name}_sum", histogram.sum, **labels)
+        self.sample(f"{name}_count", histogram.count, **labels)
+
+    def render(self) -> str:
+        return "\n".join(self.lines) + "\n"
+
+
+def _number(value: Number) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _labels(labels: Mapping[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
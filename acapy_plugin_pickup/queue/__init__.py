@@ -0,0 +1,30 @@
+"""Queues of messages awaiting pickup."""
+
+from .base import (
+    ORDERS,
+    PickupQueue,
+    PickupQueuedMessage,
+    QueueStats,
+    payload_tag,
+    sort_position,
+)
+from .factory import create_queue, get_pickup_queue
+from .memory import MemoryPickupQueue
+from .redis import RedisPickupQueue
+from .spill import SpillPickupQueue
+from .sqlite import SqlitePickupQueue
+
+__all__ = [
+    "ORDERS",
+    "PickupQueue",
+    "PickupQueuedMessage",
+    "QueueStats",
+    "payload_tag",
+    "sort_position",
+    "create_queue",
+    "get_pickup_queue",
+    "MemoryPickupQueue",
+    "RedisPickupQueue",
+    "SpillPickupQueue",
+    "SqlitePickupQueue",
+]
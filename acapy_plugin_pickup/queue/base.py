@@ -0,0 +1,776 @@
+"""Base definitions for queues of messages awaiting pickup.
+
+A pickup queue replaces ACA-Py's undelivered queue. It implements the
+synchronous interface of ACA-Py's DeliveryQueue, which ACA-Py uses to queue
+messages and to hand them to open sessions, and an asynchronous interface
+used by the Pickup Protocol handlers, allowing backends that do I/O.
+
+Queues enforce the limits of their configuration: messages older than the
+ttl are expired in the background, visiting keys oldest first so that only
+keys with expired messages are visited, and caps on the number and size of
+messages queued (per key and in all) are checked as messages are queued.
+Messages dropped by either are counted, per key until reported in a status.
+
+Delivered messages can be leased until acknowledged, so that later deliveries
+skip them; a lease ends by itself after its timeout, putting its messages
+back in line. Leases are kept in process unless a backend shares them, with
+the sender they were delivered to, so that a sender acknowledging every
+message up to a sequence number leaves those leased to others in place.
+
+Sequence numbers increase monotonically in the order messages are queued for
+a key, so a recipient can acknowledge every message up to one sequence number
+at once, removed from the front of its queue, or every message of a delivery,
+whose sequence numbers are recorded (in process, unless a backend shares them)
+for a while after it is sent.
+"""
+
+from abc import ABC, abstractmethod
+import asyncio
+import base64
+from collections import OrderedDict
+from datetime import datetime, timezone
+import heapq
+import json
+import logging
+import re
+import time
+from typing import (
+    AsyncIterator,
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+from aries_cloudagent.connections.models.connection_target import ConnectionTarget
+from aries_cloudagent.transport.inbound.delivery_queue import DeliveryQueue
+from aries_cloudagent.transport.outbound.message import OutboundMessage
+
+from ..config import CompressionConfig, LimitsConfig
+from .compression import PayloadCompressor, is_compressed
+
+
+LOGGER = logging.getLogger(__name__)
+_TAG_VALUE = re.compile(r'\s*:\s*"([A-Za-z0-9_=+/-]*)"')
+
+
+def payload_tag(enc_payload: Union[str, bytes, None]) -> Optional[str]:
+    """Return the tag of an encrypted payload, if it has one.
+
+    JWE members are base64url encoded and can never contain a quote, so the
+    last occurrence of `"tag"` is the tag member of the envelope. This avoids
+    parsing the (potentially very large) ciphertext; a full parse is only used
+    as a fallback.
+    """
+    if not enc_payload:
+        return None
+    if isinstance(enc_payload, bytes):
+        enc_payload = enc_payload.decode("ascii", errors="replace")
+    start = enc_payload.rfind('"tag"')
+    if start >= 0:
+        match = _TAG_VALUE.match(enc_payload, start + 5)
+        if match:
+            return match.group(1)
+    try:
+        return json.loads(enc_payload)["tag"]
+    except (ValueError, KeyError, TypeError):
+        LOGGER.warning("Queued message has an encrypted payload without a tag")
+        return None
+
+
+def message_size(msg: OutboundMessage) -> int:
+    """Return the size of a message: of its encrypted payload, if it has one."""
+    payload = msg.enc_payload or msg.payload
+    return len(payload) if payload else 0
+
+
+def recipient_keys_of(msg: OutboundMessage) -> Set[str]:
+    """Return the keys an outbound message is queued for."""
+    keys = set()
+    if msg.target:
+        keys.update(msg.target.recipient_keys)
+    if msg.reply_to_verkey:
+        keys.add(msg.reply_to_verkey)
+    return keys
+
+
+def target_to_json(msg: OutboundMessage) -> Optional[str]:
+    """Serialize the routing information needed to encrypt a message later."""
+    if not msg.target_list:
+        return None
+    target = msg.target_list[0]
+    return json.dumps(
+        {
+            "recipient_keys": target.recipient_keys,
+            "routing_keys": target.routing_keys,
+            "sender_key": target.sender_key,
+        }
+    )
+
+
+def target_list_from_json(
+    target: Union[str, bytes, None]
+) -> Optional[List[ConnectionTarget]]:
+    """Deserialize routing information serialized by target_to_json."""
+    return [ConnectionTarget(**json.loads(target))] if target else None
+
+
+class PickupQueuedMessage:
+    """Compact record of a queued message, with metadata computed once.
+
+    Pickup only reads the tag, encrypted payload, size, recipient keys and
+    receipt time of a queued message, so only these are kept, in slots, with
+    the encrypted payload as bytes, along with the reply fields of the outbound
+    message, for ACA-Py to get it back as queued; the outbound message is not
+    held. A message
+    queued in plaintext (sent by the mediator itself) keeps its outbound
+    message until it is encrypted, as its payload and target are needed then.
+
+    Attributes:
+        seq: position of the message in the queue, increasing monotonically
+        timestamp: time the message was received into the queue
+        tag: tag of the encrypted payload, used as the attachment id on delivery
+        size: size of the encrypted payload in bytes (of the payload until the
+            message is encrypted)
+        recipient_keys: keys for which this message is queued
+        enc_payload: the encrypted payload as stored, if the message is
+            encrypted
+        codec: the compressor that compressed the stored payload, if any
+        plaintext: the outbound message, until it is encrypted
+        reply_to_verkey: the reply_to_verkey of the outbound message
+        reply_thread_id: the reply_thread_id of the outbound message
+        b64_payload: the encrypted payload base64 encoded, as attached to
+            deliveries; computed on first use and kept while the message is held
+
+    """
+
+    __slots__ = (
+        "seq",
+        "timestamp",
+        "tag",
+        "size",
+        "recipient_keys",
+        "enc_payload",
+        "codec",
+        "plaintext",
+        "reply_to_verkey",
+        "reply_thread_id",
+        "_b64_payload",
+    )
+
+    def __init__(
+        self,
+        msg: OutboundMessage,
+        seq: int = 0,
+        timestamp: Optional[float] = None,
+        *,
+        tag: Optional[str] = None,
+        size: Optional[int] = None,
+    ):
+        """Record message, extracting metadata from the encrypted payload if needed."""
+        self.seq = seq
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.tag = tag
+        self.size = size
+        self.recipient_keys: Tuple[str, ...] = ()
+        self.enc_payload: Optional[bytes] = None
+        self.codec: Optional[PayloadCompressor] = None
+        self.plaintext: Optional[OutboundMessage] = None
+        self.reply_to_verkey = msg.reply_to_verkey
+        self.reply_thread_id = msg.reply_thread_id
+        self._b64_payload: Optional[str] = None
+        if not msg.enc_payload:
+            self.plaintext = msg
+            if size is None:
+                self.size = message_size(msg)
+        elif tag is None and size is None:
+            self._set_enc_payload(msg.enc_payload)
+        else:
+            self.enc_payload = _as_bytes(msg.enc_payload)
+
+    @property
+    def msg(self) -> OutboundMessage:
+        """Return the message as an outbound message, rebuilt once encrypted.
+
+        The rebuilt message has the encrypted payload and the reply fields of
+        the message queued.
+        """
+        if self.plaintext is not None:
+            return self.plaintext
+        return OutboundMessage(
+            payload=b"",
+            enc_payload=self.payload,
+            reply_to_verkey=self.reply_to_verkey,
+            reply_thread_id=self.reply_thread_id,
+        )
+
+    @property
+    def encrypted(self) -> bool:
+        """Return whether the message is encrypted, its payload stored."""
+        return self.plaintext is None
+
+    @property
+    def received_at(self) -> datetime:
+        """Return the time the message was received into the queue."""
+        return datetime.fromtimestamp(self.timestamp, tz=timezone.utc)
+
+    @property
+    def payload(self) -> Optional[bytes]:
+        """Return the encrypted payload, decompressed if stored compressed."""
+        if self.codec is None:
+            return self.enc_payload
+        return self.codec.decompress(self.enc_payload)
+
+    @property
+    def b64_payload(self) -> str:
+        """Return the encrypted payload base64 encoded, computing it only once."""
+        if self._b64_payload is None:
+            self._b64_payload = base64.b64encode(self.payload).decode("ascii")
+        return self._b64_payload
+
+    def older_than(self, compare_timestamp: float) -> bool:
+        """Return whether the message was received before a time."""
+        return self.timestamp < compare_timestamp
+
+    def _set_enc_payload(self, enc_payload: Union[str, bytes]):
+        """Record the encrypted payload and its metadata, dropping the plaintext."""
+        self.enc_payload = _as_bytes(enc_payload)
+        self.codec = None
+        self.plaintext = None
+        self.tag = payload_tag(self.enc_payload)
+        self.size = len(self.enc_payload)
+
+    def _store(self, stored: Union[str, bytes], compressor: PayloadCompressor):
+        """Hold the encrypted payload as stored by compressor."""
+        self.enc_payload = _as_bytes(stored)
+        self.codec = compressor if is_compressed(self.enc_payload) else None
+
+
+def _as_bytes(enc_payload: Union[str, bytes]) -> bytes:
+    # Encrypted payloads are ascii JSON
+    return enc_payload.encode("ascii") if isinstance(enc_payload, str) else enc_payload
+
+
+class QueueStats(NamedTuple):
+    """Aggregates of the messages queued for a key.
+
+    Attributes:
+        count: number of queued messages
+        total_size: total size of queued messages in bytes
+        oldest: time the oldest queued message was received, if any
+        newest: time the newest queued message was received, if any
+
+    """
+
+    count: int = 0
+    total_size: int = 0
+    oldest: Optional[float] = None
+    newest: Optional[float] = None
+
+
+# Orders in which keys can be listed: by number or size of queued messages,
+# largest first, or by the time their oldest message was received, oldest first
+ORDERS = ("depth", "bytes", "age")
+
+# Position of a key in a listing: its sort value (as for sort_position) and
+# the key itself, which breaks ties
+Position = Tuple[float, str]
+
+
+def sort_position(order: str, key: str, stats: QueueStats) -> Position:
+    """Return the position of key in a listing of keys in order."""
+    if order == "depth":
+        return (stats.count, key)
+    if order == "bytes":
+        return (stats.total_size, key)
+    if order == "age":
+        return (stats.oldest or 0.0, key)
+    raise ValueError(f"Unknown order: {order}")
+
+
+def follows(order: str, position: Position, after: Optional[Position]) -> bool:
+    """Return whether position comes after the position after in order.
+
+    Keys are listed in descending positions, except by age where the oldest
+    come first.
+    """
+    if after is None:
+        return True
+    return position > after if order == "age" else position < after
+
+
+# Number of recent deliveries whose messages are recorded for acknowledgement
+MAX_DELIVERIES = 4096
+
+
+class _KeyEvent(asyncio.Event):
+    """Event set when a message is queued for a key, counting its waiters."""
+
+    def __init__(self):
+        super().__init__()
+        self.waiters = 0
+
+
+class PickupQueue(ABC):
+    """Queue of messages awaiting pickup, indexed by recipient key."""
+
+    # Seconds between checks for messages queued by other processes while
+    # waiting, for backends shared between processes
+    poll_interval: Optional[float] = None
+    # Seconds between runs of background expiry
+    expiry_interval: float = 1.0
+
+    def __init__(
+        self,
+        limits: Optional[LimitsConfig] = None,
+        compression: Optional[CompressionConfig] = None,
+    ):
+        """Initialize the queue."""
+        self.limits = limits or LimitsConfig()
+        # Encrypted payloads are stored as compressed by the compressor
+        self.compressor = PayloadCompressor(compression)
+        self.ttl_seconds = self.limits.ttl or 604800  # one week
+        self._capped = self.limits.capped
+        self._subscribers: List[Callable[[str, OutboundMessage], None]] = []
+        self._events: Dict[str, _KeyEvent] = {}
+        # Messages dropped before pickup, by reason, and by key until reported
+        self.expired = 0
+        self.evicted = 0
+        self.rejected = 0
+        self._dropped_by_key: Dict[str, List[int]] = {}
+        self._expiry_task: Optional[asyncio.Task] = None
+        # Deadlines and owners of leased messages by key and sequence number,
+        # and a heap of the leases taken to end them in order
+        self._leases: Dict[str, Dict[int, Tuple[float, Optional[str]]]] = {}
+        self._lease_ends: List[Tuple[float, str, Tuple[int, ...]]] = []
+        # Sequence numbers of the messages of recent deliveries, by recipient
+        # key and delivery id, oldest first
+        self._deliveries: "OrderedDict[Tuple[str, str], Tuple[int, ...]]" = (
+            OrderedDict()
+        )
+
+    def __bool__(self):
+        """Return True; ACA-Py only queues messages if the queue is truthy."""
+        return True
+
+    def migrate_from(self, queue: DeliveryQueue):
+        """Take over the messages of an existing undelivered queue."""
+        seen = set()
+        for queued_messages in queue.queue_by_key.values():
+            for queued in queued_messages:
+                if id(queued) not in seen:
+                    seen.add(id(queued))
+                    self._add(queued.msg, queued.timestamp)
+
+    @abstractmethod
+    def _add(self, msg: OutboundMessage, timestamp: float):
+        """Add a message received at timestamp once per recipient key."""
+
+    def subscribe(self, subscriber: Callable[[str, OutboundMessage], None]):
+        """Call subscriber with each newly queued message and its recipient key.
+
+        Subscribers are called synchronously while the message is queued and
+        must not block; messages of other replicas sharing the queue are not
+        reported.
+        """
+        self._subscribers.append(subscriber)
+
+    def unsubscribe(self, subscriber: Callable[[str, OutboundMessage], None]):
+        """Stop reporting newly queued messages to subscriber."""
+        self._subscribers.remove(subscriber)
+
+    # ACA-Py DeliveryQueue interface
+
+    def add_message(self, msg: OutboundMessage):
+        """Add an OutboundMessage to the queue once per recipient key."""
+        self._add(msg, time.time())
+        if self._subscribers or self._events:
+            for key in recipient_keys_of(msg):
+                self._notify(key, msg)
+
+    def _notify(self, key: str, msg: OutboundMessage):
+        self._wake(key)
+        for subscriber in self._subscribers:
+            subscriber(key, msg)
+
+    def _wake(self, key: str):
+        """Wake the waiters for messages of key, to check the queue again."""
+        event = self._events.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def has_message_for_key(self, key: str) -> bool:
+        """Check for queued messages by key."""
+        return self.message_count_for_key(key) > 0
+
+    @abstractmethod
+    def message_count_for_key(self, key: str) -> int:
+        """Count of queued messages by key."""
+
+    @abstractmethod
+    def expire_messages(self, ttl=None):
+        """Expire messages that are past the time limit."""
+
+    @abstractmethod
+    def get_one_message_for_key(self, key: str) -> Optional[OutboundMessage]:
+        """Remove and return the oldest message for key."""
+
+    @abstractmethod
+    def inspect_all_messages_for_key(self, key: str) -> Iterator[OutboundMessage]:
+        """Return all messages for key."""
+
+    @abstractmethod
+    def remove_message_for_key(self, key: str, msg: OutboundMessage):
+        """Remove specified message from queue for key."""
+
+    # Pickup interface
+
+    async def count_for_key(self, key: str) -> int:
+        """Return the number of messages queued for key."""
+        return self.message_count_for_key(key)
+
+    @abstractmethod
+    async def stats_for_key(self, key: str) -> QueueStats:
+        """Return aggregates of the messages queued for key in constant time."""
+
+    @abstractmethod
+    def stats_by_key(self) -> AsyncIterator[Tuple[str, QueueStats]]:
+        """Yield each key with queued messages and its aggregates, in no order.
+
+        This visits every key and is meant for monitoring, not for handlers.
+        """
+
+    @abstractmethod
+    async def list_keys(
+        self, order: str = "depth", limit: int = 100, after: Optional[Position] = None
+    ) -> List[Tuple[str, QueueStats]]:
+        """Return a page of keys with queued messages and their aggregates.
+
+        Keys are listed by depth or bytes (largest first) or by age (oldest
+        first), ties broken by key; see sort_position and follows.
+
+        Args:
+            order: One of ORDERS
+            limit: Maximum number of keys to return
+            after: Position of the last key of the previous page
+        """
+
+    @abstractmethod
+    def messages_for_key(
+        self, key: str, limit: Optional[int] = None, *, after: int = 0
+    ) -> AsyncIterator[PickupQueuedMessage]:
+        """Lazily yield messages for key, oldest first, without removing them.
+
+        Args:
+            key: The key to use for lookup
+            limit: Optional maximum number of messages to yield
+            after: Only yield messages with a greater sequence number
+        """
+
+    @abstractmethod
+    async def remove_by_tags(self, key: str, tags: Iterable[str]) -> int:
+        """Remove messages for key by tag, returning the number removed."""
+
+    @abstractmethod
+    async def remove_for_key(self, key: str, before: Optional[float] = None) -> int:
+        """Remove the messages for key, returning the number removed.
+
+        Args:
+            key: The key to use for lookup
+            before: Only remove messages received before this time
+        """
+
+    @abstractmethod
+    async def remove_through(
+        self, key: str, seq: int, *, keep: Collection[int] = ()
+    ) -> int:
+        """Remove the messages for key up to sequence number seq, except keep.
+
+        These are the first messages of the queue of key, so only the messages
+        removed (and those kept) are visited. Return the number of messages
+        removed.
+        """
+
+    @abstractmethod
+    async def remove_seqs(self, key: str, seqs: Iterable[int]) -> int:
+        """Remove messages for key by sequence number, returning the number removed."""
+
+    async def record_delivery(self, key: str, delivery_id: str, seqs: Sequence[int]):
+        """Record the sequence numbers of the messages of a delivery for key.
+
+        Only the last MAX_DELIVERIES deliveries are kept.
+        """
+        self._deliveries[(key, delivery_id)] = tuple(seqs)
+        while len(self._deliveries) > MAX_DELIVERIES:
+            self._deliveries.popitem(last=False)
+
+    async def take_delivery(self, key: str, delivery_id: str) -> Sequence[int]:
+        """Return and forget the sequence numbers of a delivery for key.
+
+        A delivery unknown, or no longer recorded, has no messages.
+        """
+        return self._deliveries.pop((key, delivery_id), ())
+
+    @abstractmethod
+    async def store_enc_payload(
+        self, queued: PickupQueuedMessage, enc_payload: Union[str, bytes]
+    ):
+        """Record the encrypted payload of a queued message.
+
+        The first payload recorded for a message wins: if another one was
+        recorded meanwhile (e.g. by the background encoder), queued takes that
+        one instead, so that a message is only ever delivered with one tag.
+        """
+
+    async def remove_received_before(
+        self, before: float, max_keys: Optional[int] = None
+    ) -> Tuple[Dict[str, int], bool]:
+        """Remove the messages received before a time, for at most max_keys keys.
+
+        Keys are visited oldest first, through list_keys, so each key visited
+        has messages to remove. Return the number of messages removed by key
+        and whether keys may remain to visit.
+        """
+        removed: Dict[str, int] = {}
+        while max_keys is None or len(removed) < max_keys:
+            # Keys visited no longer have messages before the cutoff, so each
+            # page is taken from the start
+            limit = 100 if max_keys is None else min(max_keys - len(removed), 100)
+            page = await self.list_keys("age", limit)
+            visiting = [
+                key
+                for key, stats in page
+                if stats.oldest is not None
+                and stats.oldest < before
+                and key not in removed
+            ]
+            for key in visiting:
+                removed[key] = await self.remove_for_key(key, before)
+            if len(visiting) < limit:
+                return removed, False
+        return removed, True
+
+    def _over_key_limits(self, count: int, size: int) -> bool:
+        """Return whether count messages of size bytes exceed the caps of a key."""
+        limits = self.limits
+        return (
+            limits.max_messages_per_key is not None
+            and count > limits.max_messages_per_key
+        ) or (limits.max_bytes_per_key is not None and size > limits.max_bytes_per_key)
+
+    def _over_total_limits(self, count: int, size: int) -> bool:
+        """Return whether count messages of size bytes exceed the caps of all keys."""
+        limits = self.limits
+        return (limits.max_messages is not None and count > limits.max_messages) or (
+            limits.max_bytes is not None and size > limits.max_bytes
+        )
+
+    async def admit(self, key: str, size: int) -> bool:
+        """Return whether a message of size bytes for key is within the caps.
+
+        This lets messages be turned away before they are queued, through the
+        same aggregates that a status reports; a message turned away is
+        counted as rejected. Caps are still checked as messages are queued.
+        """
+        if not self._capped or await self._fits(key, size):
+            return True
+        self._count_dropped(key, rejected=1)
+        return False
+
+    async def _fits(self, key: str, size: int) -> bool:
+        """Return whether a message of size bytes for key is within the caps.
+
+        Only the caps of key are checked unless overridden.
+        """
+        stats = await self.stats_for_key(key)
+        return not self._over_key_limits(stats.count + 1, stats.total_size + size)
+
+    def _count_dropped(
+        self, key: str, *, expired: int = 0, evicted: int = 0, rejected: int = 0
+    ):
+        """Count messages for key dropped before pickup."""
+        self.expired += expired
+        self.evicted += evicted
+        self.rejected += rejected
+        counts = self._dropped_by_key.setdefault(key, [0, 0])
+        counts[0] += expired
+        counts[1] += evicted + rejected
+
+    async def take_dropped(self, key: str) -> Tuple[int, int]:
+        """Return the messages for key expired, and evicted or rejected by caps.
+
+        Only messages dropped since the last call for key are counted.
+        """
+        expired, evicted = self._dropped_by_key.pop(key, (0, 0))
+        return expired, evicted
+
+    async def expire(self, now: Optional[float] = None) -> int:
+        """Remove the messages queued for longer than the ttl, counting them.
+
+        Return the number of messages expired.
+        """
+        if not self.limits.ttl:
+            return 0
+        return await self._expire_before((now or time.time()) - self.limits.ttl)
+
+    async def _expire_before(self, before: float) -> int:
+        """Remove the messages received before a time, counting them as expired."""
+        removed, _ = await self.remove_received_before(before)
+        for key, count in removed.items():
+            if count:
+                self._count_dropped(key, expired=count)
+        return sum(removed.values())
+
+    def start_expiry(self):
+        """Expire messages and log those dropped, in the background.
+
+        Nothing is started unless a ttl or caps are configured.
+        """
+        if (self.limits.ttl or self._capped) and self._expiry_task is None:
+            self._expiry_task = asyncio.get_running_loop().create_task(
+                self._expire_periodically()
+            )
+
+    async def _expire_periodically(self):
+        reported = (self.expired, self.evicted, self.rejected)
+        while True:
+            await asyncio.sleep(self.expiry_interval)
+            try:
+                await self.expire()
+            except Exception:
+                LOGGER.exception("Failed to expire queued messages")
+            dropped = (self.expired, self.evicted, self.rejected)
+            if dropped != reported:
+                LOGGER.info(
+                    "Undelivered messages dropped: %d expired, %d evicted and "
+                    "%d rejected by caps (%d, %d and %d in all)",
+                    *(now - then for now, then in zip(dropped, reported)),
+                    *dropped,
+                )
+                reported = dropped
+
+    async def leased(self, key: str) -> Set[int]:
+        """Return the sequence numbers of the messages of key under lease."""
+        return set(await self.lease_deadlines(key))
+
+    async def lease_deadlines(self, key: str) -> Dict[int, float]:
+        """Return when the leases of the messages of key end, by sequence number."""
+        self._end_leases(time.time())
+        return {
+            seq: deadline for seq, (deadline, _) in self._leases.get(key, {}).items()
+        }
+
+    async def leased_to_others(self, key: str, owner: Optional[str]) -> Set[int]:
+        """Return the sequence numbers of the messages of key leased to others."""
+        self._end_leases(time.time())
+        return {
+            seq
+            for seq, (_, leased_to) in self._leases.get(key, {}).items()
+            if leased_to != owner
+        }
+
+    async def lease(
+        self,
+        key: str,
+        seqs: Sequence[int],
+        timeout: float,
+        owner: Optional[str] = None,
+    ) -> List[int]:
+        """Lease messages of key to owner for timeout seconds, unless leased.
+
+        Return the sequence numbers of the messages leased by this call, so
+        that concurrent deliveries never both lease a message.
+        """
+        now = time.time()
+        self._end_leases(now)
+        leases = self._leases.setdefault(key, {})
+        taken = [seq for seq in seqs if seq not in leases]
+        deadline = now + timeout
+        for seq in taken:
+            leases[seq] = (deadline, owner)
+        if taken:
+            heapq.heappush(self._lease_ends, (deadline, key, tuple(taken)))
+        elif not leases:
+            del self._leases[key]
+        return taken
+
+    def _end_leases(self, now: float):
+        """End the leases past their deadline, in deadline order."""
+        ends = self._lease_ends
+        while ends and ends[0][0] <= now:
+            deadline, key, seqs = heapq.heappop(ends)
+            leases = self._leases.get(key)
+            if leases is None:
+                continue
+            for seq in seqs:
+                # Unless leased again since
+                if leases.get(seq, (None,))[0] == deadline:
+                    del leases[seq]
+            if not leases:
+                del self._leases[key]
+
+    async def _has_unleased(self, key: str, leased: Collection[int]) -> bool:
+        """Return whether a message of key is not under lease."""
+        # At most len(leased) messages are skipped
+        async for queued in self.messages_for_key(key, limit=len(leased) + 1):
+            if queued.seq not in leased:
+                return True
+        return False
+
+    async def wait_for_messages(
+        self, key: str, timeout: float, *, skip_leased: bool = False
+    ) -> bool:
+        """Wait up to timeout seconds for messages to be queued for key.
+
+        Waiters for a key share an event that is set when a message is queued
+        for it, so any number of parked waiters costs no polling (except every
+        poll_interval for backends setting it). With skip_leased, messages under
+        lease do not count: the wait goes on until a message is queued or the
+        first lease ends. Return whether (unleased) messages are queued.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            # Register before checking so a message queued meanwhile is seen
+            event = self._events.get(key)
+            if event is None:
+                event = self._events[key] = _KeyEvent()
+            event.waiters += 1
+            try:
+                leases_end = None
+                if await self.count_for_key(key):
+                    if not skip_leased:
+                        return True
+                    leases = await self.lease_deadlines(key)
+                    if not leases or await self._has_unleased(key, leases):
+                        return True
+                    leases_end = min(leases.values()) - time.time()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                if self.poll_interval:
+                    remaining = min(remaining, self.poll_interval)
+                if leases_end is not None:
+                    # Wake up as the first lease ends, to find its messages
+                    remaining = min(remaining, max(leases_end, 0))
+                try:
+                    await asyncio.wait_for(event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            finally:
+                event.waiters -= 1
+                if not event.waiters and self._events.get(key) is event:
+                    del self._events[key]
+
+    async def close(self):
+        """Release resources held by the queue."""
+        if self._expiry_task is not None:
+            self._expiry_task.cancel()
+            self._expiry_task = None
@@ -0,0 +1,103 @@
+"""Compression of the encrypted payloads of queued messages.
+
+Encrypted payloads are JSON with base64url members: their ciphertext is random
+but carries 6 bits per byte, so they compress to about three quarters of their
+size (see benchmarks/compression.py), and may wait for their recipient for
+hours. With a codec configured, payloads of at least `min_size` bytes are
+stored compressed (unless that does not make them smaller) and only
+decompressed as they are delivered.
+
+Encrypted payloads are ASCII JSON, so they never start with the magic bytes of
+a zlib stream or an xz container: stored payloads are decompressed by their
+first bytes, whatever the configured codec, and a queue written with another
+configuration (or none) is still read.
+"""
+
+import lzma
+import time
+import zlib
+from typing import Callable, Dict, Optional, Union
+
+from ..config import CompressionConfig
+
+# Magic bytes of an xz container, and the headers of zlib streams with the
+# (default) 32K window, by compression level
+XZ_MAGIC = b"\xfd7zXZ\x00"
+ZLIB_HEADERS = (b"\x78\x01", b"\x78\x5e", b"\x78\x9c", b"\x78\xda")
+
+
+def is_compressed(stored: bytes) -> bool:
+    """Return whether a stored payload is compressed."""
+    return stored[:2] in ZLIB_HEADERS or stored[:6] == XZ_MAGIC
+
+
+def decompress(stored: bytes) -> bytes:
+    """Return a stored payload decompressed, if it is compressed."""
+    if stored[:2] in ZLIB_HEADERS:
+        return zlib.decompress(stored)
+    if stored[:6] == XZ_MAGIC:
+        return lzma.decompress(stored)
+    return stored
+
+
+_COMPRESSORS: Dict[str, Callable[[bytes, int], bytes]] = {
+    "zlib": zlib.compress,
+    "lzma": lambda payload, level: lzma.compress(payload, preset=level),
+}
+
+
+class PayloadCompressor:
+    """Compress and decompress stored payloads, counting the bytes and CPU time.
+
+    Attributes:
+        compressed: payloads compressed
+        bytes_in: size of the payloads compressed
+        bytes_out: size of the payloads compressed, as stored (including those
+            stored as is as compressing did not make them smaller)
+        compress_seconds: CPU time spent compressing payloads
+        decompressed: payloads decompressed
+        decompress_seconds: CPU time spent decompressing payloads
+
+    """
+
+    def __init__(self, config: Optional[CompressionConfig] = None):
+        """Initialize the compressor; payloads are stored as is without a codec."""
+        self.config = config or CompressionConfig()
+        self._compress = _COMPRESSORS[self.config.codec] if self.config.codec else None
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_seconds = 0.0
+        self.decompressed = 0
+        self.decompress_seconds = 0.0
+
+    @property
+    def ratio(self) -> float:
+        """Return the size of the payloads compressed over their stored size."""
+        return self.bytes_in / self.bytes_out if self.bytes_out else 1.0
+
+    def compress(self, payload: Union[str, bytes]) -> bytes:
+        """Return a payload as stored: compressed if at least min_size and smaller."""
+        if isinstance(payload, str):
+            payload = payload.encode("ascii")
+        if self._compress is None or len(payload) < self.config.min_size:
+            return payload
+        started = time.thread_time()
+        stored = self._compress(payload, self.config.level)
+        self.compress_seconds += time.thread_time() - started
+        self.compressed += 1
+        self.bytes_in += len(payload)
+        if len(stored) >= len(payload):
+            stored = payload
+        self.bytes_out += len(stored)
+        return stored
+
+    def decompress(self, stored: Union[str, bytes]) -> Union[str, bytes]:
+        """Return a stored payload decompressed, if it is compressed."""
+        if isinstance(stored, str) or not is_compressed(stored):
+            return stored
+        started = time.thread_time()
+        payload = decompress(stored)
+        self.decompress_seconds += time.thread_time() - started
+        self.decompressed += 1
+        return payload
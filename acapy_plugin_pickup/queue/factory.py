@@ -0,0 +1,62 @@
+"""Select and install the configured pickup queue."""
+
+import logging
+from typing import Optional
+
+from aries_cloudagent.transport.inbound.manager import InboundTransportManager
+
+from ..config import PickupConfig
+from .base import PickupQueue
+from .memory import MemoryPickupQueue
+from .redis import RedisPickupQueue
+from .resp import RespClient
+from .spill import SpillPickupQueue
+from .sqlite import SqlitePickupQueue
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def create_queue(config: PickupConfig) -> PickupQueue:
+    """Create the queue backend selected by config."""
+    if config.backend == "sqlite":
+        return SqlitePickupQueue(
+            config.sqlite.path,
+            batch_size=config.sqlite.batch_size,
+            flush_interval=config.sqlite.flush_interval,
+            limits=config.limits,
+            compression=config.compression,
+        )
+    if config.backend == "redis":
+        return RedisPickupQueue(
+            RespClient.from_url(config.redis.url),
+            prefix=config.redis.prefix,
+            limits=config.limits,
+            compression=config.compression,
+        )
+    if config.backend == "spill":
+        return SpillPickupQueue(
+            config.spill.directory,
+            memory_bytes=config.spill.memory_bytes,
+            segment_bytes=config.spill.segment_bytes,
+            compact_ratio=config.spill.compact_ratio,
+            limits=config.limits,
+            compression=config.compression,
+        )
+    return MemoryPickupQueue(config.limits, config.compression)
+
+
+def get_pickup_queue(manager: InboundTransportManager) -> Optional[PickupQueue]:
+    """Return the pickup queue of the manager, replacing the default queue if needed.
+
+    Returns None if the undelivered queue is not enabled.
+    """
+    queue = manager.undelivered_queue
+    if queue is None or isinstance(queue, PickupQueue):
+        return queue
+    config = PickupConfig.from_settings(manager.profile.settings)
+    LOGGER.info("Replacing undelivered queue with %s pickup queue", config.backend)
+    pickup_queue = create_queue(config)
+    pickup_queue.migrate_from(queue)
+    manager.undelivered_queue = pickup_queue
+    return pickup_queue
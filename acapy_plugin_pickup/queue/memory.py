@@ -0,0 +1,488 @@
+"""In-memory pickup queue with indexes.
+
+ACA-Py's DeliveryQueue keeps a plain list of messages per recipient key. Finding
+a message by the tag of its encrypted payload therefore requires walking (and
+parsing) the whole list. The queue defined here keeps the same interface but
+maintains the messages of each key by sequence number, in order, alongside a
+tag index so that acknowledgements cost O(acknowledged tags) instead of
+O(queue size). Messages are held as compact records rather than as outbound
+messages.
+"""
+
+from collections import OrderedDict
+from itertools import count, islice, takewhile
+import logging
+import time
+from typing import (
+    AsyncIterator,
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+    Union,
+)
+from weakref import WeakKeyDictionary
+
+from aries_cloudagent.transport.outbound.message import OutboundMessage
+
+from ..config import CompressionConfig, LimitsConfig
+from .base import (
+    PickupQueue,
+    PickupQueuedMessage,
+    Position,
+    QueueStats,
+    recipient_keys_of,
+)
+from .sortedlist import SortedList
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class MemoryPickupQueue(PickupQueue):
+    """In-memory pickup queue with a per-recipient tag index.
+
+    `queue_by_key` maps each recipient key to its queued messages by sequence
+    number, in insertion (and so sequence) order, allowing constant time
+    removal of any message. `tags_by_key` maps each recipient key to the
+    queued messages for that key by tag. `size_by_key` keeps the total size of
+    the messages queued for each key; with the ordered sets this gives the
+    aggregates of a key in constant time.
+
+    Keys are also kept sorted by (number of messages, key), (total size, key)
+    and (receipt time of the first message, key). Keys whose messages change
+    are noted as they are queued and removed, with the positions they have in
+    the sorted lists, and moved in the lists before the lists are next read:
+    queueing a message stays O(1), and the lists cost O(log keys) per key
+    changed. A page of keys in any order is then read from its position in
+    these lists, and the keys with messages to expire, or the oldest message to
+    evict, are found first in order of age.
+    """
+
+    # Type of the records of queued messages
+    record_type: Type[PickupQueuedMessage] = PickupQueuedMessage
+
+    def __init__(
+        self,
+        limits: Optional[LimitsConfig] = None,
+        compression: Optional[CompressionConfig] = None,
+    ) -> None:
+        """Initialize the queue."""
+        super().__init__(limits, compression)
+        self.queue_by_key: Dict[str, "OrderedDict[int, PickupQueuedMessage]"] = {}
+        self.tags_by_key: Dict[str, Dict[str, PickupQueuedMessage]] = {}
+        self.size_by_key: Dict[str, int] = {}
+        self.total_count = 0
+        self.total_size = 0
+        self._seq = count(1)
+        self._by_depth = SortedList()
+        self._by_bytes = SortedList()
+        self._by_age = SortedList()
+        self._by_order = {
+            "depth": self._by_depth,
+            "bytes": self._by_bytes,
+            "age": self._by_age,
+        }
+        # Keys changed since the sorted lists were updated, with their
+        # positions in the lists (None for keys not in them)
+        self._moved: Dict[str, Optional[Tuple[int, int, float]]] = {}
+        # Messages handed out through the ACA-Py interface, for removal by message
+        self._seq_by_msg: "WeakKeyDictionary[OutboundMessage, int]" = (
+            WeakKeyDictionary()
+        )
+
+    def _append(self, key: str, queued: PickupQueuedMessage):
+        """Append a wrapped message to the queue for key."""
+        tags = self.tags_by_key.setdefault(key, {})
+        if queued.tag is not None:
+            if queued.tag in tags:
+                LOGGER.debug("Message with tag %s already queued for key", queued.tag)
+                return
+            tags[queued.tag] = queued
+        if key not in self._moved:
+            self._moved[key] = self._position(key)
+        self.queue_by_key.setdefault(key, OrderedDict())[queued.seq] = queued
+        self.size_by_key[key] = self.size_by_key.get(key, 0) + queued.size
+        self.total_count += 1
+        self.total_size += queued.size
+        queued.recipient_keys += (key,)
+
+    def _discard(self, key: str, queued: PickupQueuedMessage):
+        """Remove a wrapped message from the queue for key."""
+        messages = self.queue_by_key.get(key)
+        if messages is None or messages.get(queued.seq) is not queued:
+            return
+        if key not in self._moved:
+            self._moved[key] = self._position(key)
+        del messages[queued.seq]
+        self.total_count -= 1
+        self.total_size -= queued.size
+        queued.recipient_keys = tuple(
+            other for other in queued.recipient_keys if other != key
+        )
+        tags = self.tags_by_key[key]
+        if queued.tag is not None and tags.get(queued.tag) is queued:
+            del tags[queued.tag]
+        if messages:
+            self.size_by_key[key] -= queued.size
+        else:
+            del self.queue_by_key[key]
+            del self.tags_by_key[key]
+            del self.size_by_key[key]
+
+    def _discard_first(
+        self,
+        key: str,
+        before: Optional[float] = None,
+        limit: Optional[int] = None,
+        through: Optional[int] = None,
+    ) -> int:
+        """Remove the first messages for key, received before a time or up to limit.
+
+        Only messages with a sequence number up to through are removed, if given.
+        Return the number of messages removed.
+        """
+        messages = self.queue_by_key.get(key)
+        removed = []
+        for queued in messages.values() if messages else ():
+            if (
+                (before is not None and not queued.older_than(before))
+                or (limit is not None and len(removed) >= limit)
+                or (through is not None and queued.seq > through)
+            ):
+                break
+            removed.append(queued)
+        for queued in removed:
+            self._discard(key, queued)
+        return len(removed)
+
+    def _position(self, key: str) -> Optional[Tuple[int, int, float]]:
+        """Return the number, size and first receipt time of the messages of key."""
+        messages = self.queue_by_key.get(key)
+        if not messages:
+            return None
+        return (
+            len(messages),
+            self.size_by_key[key],
+            next(iter(messages.values())).timestamp,
+        )
+
+    def _sort_keys(self):
+        """Move the keys changed since the last call in the sorted lists."""
+        for key, before in self._moved.items():
+            after = self._position(key)
+            for positions, old, new in zip(
+                (self._by_depth, self._by_bytes, self._by_age),
+                before or (None,) * 3,
+                after or (None,) * 3,
+            ):
+                if old == new:
+                    continue
+                if old is None:
+                    positions.add((new, key))
+                elif new is None:
+                    positions.remove((old, key))
+                else:
+                    positions.replace((old, key), (new, key))
+        self._moved.clear()
+
+    def _oldest_key(self, before: float = float("inf")) -> Optional[str]:
+        """Return the key whose first message is the oldest, if received before."""
+        self._sort_keys()
+        oldest = self._by_age.first()
+        if oldest is not None and oldest[0] < before:
+            return oldest[1]
+        return None
+
+    def expire_messages(self, ttl=None):
+        """Expire messages that are past the time limit.
+
+        Messages are kept in arrival order and keys with expired messages are
+        found in order of age, so only expired messages are visited.
+        """
+        removed, _ = self._remove_received_before(
+            time.time() - (ttl or self.ttl_seconds)
+        )
+        for key, expired in removed.items():
+            self._count_dropped(key, expired=expired)
+
+    def _remove_received_before(
+        self, before: float, max_keys: Optional[int] = None
+    ) -> Tuple[Dict[str, int], bool]:
+        removed: Dict[str, int] = {}
+        while max_keys is None or len(removed) < max_keys:
+            key = self._oldest_key(before)
+            if key is None:
+                return removed, False
+            removed[key] = removed.get(key, 0) + self._discard_first(key, before)
+        return removed, self._oldest_key(before) is not None
+
+    def _add(self, msg: OutboundMessage, timestamp: float):
+        """Add a message once per recipient key, within the caps."""
+        queued = self.record_type(msg, next(self._seq), timestamp)
+        keys = recipient_keys_of(msg)
+        if (
+            self._capped
+            and self.limits.policy == "reject-new"
+            and not self._admits(keys, queued.size)
+        ):
+            LOGGER.debug("Message for %s rejected: queue caps reached", keys)
+            for recipient_key in keys:
+                self._count_dropped(recipient_key, rejected=1)
+            return
+        if queued.enc_payload:
+            queued._store(self.compressor.compress(queued.enc_payload), self.compressor)
+        for recipient_key in keys:
+            self._append(recipient_key, queued)
+        if self._capped and self.limits.policy == "drop-oldest":
+            self._evict(keys)
+
+    def _admits(self, keys: Set[str], size: int) -> bool:
+        """Return whether a message of size can be queued for keys within caps."""
+        if self._over_total_limits(
+            self.total_count + len(keys), self.total_size + size * len(keys)
+        ):
+            return False
+        return not any(
+            self._over_key_limits(
+                self.message_count_for_key(key) + 1, self.size_by_key.get(key, 0) + size
+            )
+            for key in keys
+        )
+
+    async def _fits(self, key: str, size: int) -> bool:
+        return self._admits({key}, size)
+
+    def _evict(self, keys: Set[str]):
+        """Evict the oldest messages of keys, then of any key, to meet the caps."""
+        for key in keys:
+            evicted = 0
+            while key in self.queue_by_key and self._over_key_limits(
+                len(self.queue_by_key[key]), self.size_by_key[key]
+            ):
+                evicted += self._discard_first(key, limit=1)
+            if evicted:
+                LOGGER.debug("Evicted %d messages queued for %s", evicted, key)
+                self._count_dropped(key, evicted=evicted)
+        while self._over_total_limits(self.total_count, self.total_size):
+            key = self._oldest_key()
+            if key is None:
+                break
+            self._count_dropped(key, evicted=self._discard_first(key, limit=1))
+
+    def has_message_for_key(self, key: str):
+        """Check for queued messages by key."""
+        return bool(self.queue_by_key.get(key))
+
+    def message_count_for_key(self, key: str):
+        """Count of queued messages by key."""
+        messages = self.queue_by_key.get(key)
+        return len(messages) if messages else 0
+
+    def get_one_message_for_key(self, key: str):
+        """Remove and return the oldest message for key."""
+        messages = self.queue_by_key.get(key)
+        if messages:
+            queued = next(iter(messages.values()))
+            self._discard(key, queued)
+            return queued.msg
+
+    def queued_messages_for_key(
+        self, key: str, limit: Optional[int] = None, *, after: int = 0
+    ) -> Iterator[PickupQueuedMessage]:
+        """Lazily yield wrapped messages for key, oldest first, without removing them.
+
+        Only the messages actually consumed are visited, so the cost depends on
+        limit (or on where the consumer stops) rather than on queue depth. The
+        queue may be modified between items: if that invalidates the underlying
+        iterator, iteration resumes after the last yielded message using the
+        monotonic sequence numbers of queued messages.
+
+        Args:
+            key: The key to use for lookup
+            limit: Optional maximum number of messages to yield
+            after: Only yield messages with a greater sequence number
+        """
+        remaining = limit
+        last_seq = after
+        while remaining is None or remaining > 0:
+            messages = self.queue_by_key.get(key)
+            if not messages:
+                return
+            try:
+                for queued in messages.values():
+                    if queued.seq <= last_seq:
+                        continue
+                    yield queued
+                    last_seq = queued.seq
+                    if remaining is not None:
+                        remaining -= 1
+                        if remaining <= 0:
+                            return
+                return
+            except RuntimeError:
+                # Queue for key was mutated while the consumer held the cursor
+                continue
+
+    def inspect_all_messages_for_key(self, key: str):
+        """Return all messages for key."""
+        for queued in self.queued_messages_for_key(key):
+            msg = queued.msg
+            self._seq_by_msg[msg] = queued.seq
+            yield msg
+
+    def remove_message_for_key(self, key: str, msg: OutboundMessage):
+        """Remove specified message from queue for key."""
+        seq = self._seq_by_msg.pop(msg, None)
+        queued = self.queue_by_key.get(key, {}).get(seq)
+        if queued is not None:
+            self._discard(key, queued)
+
+    def remove_messages_by_tag(self, key: str, tags: Iterable[str]) -> int:
+        """Remove messages for key by the tag of their encrypted payload.
+
+        Returns:
+            The number of messages removed.
+
+        """
+        index = self.tags_by_key.get(key)
+        if not index:
+            return 0
+        removed = 0
+        for tag in tags:
+            queued = index.get(tag)
+            if queued is not None:
+                self._discard(key, queued)
+                removed += 1
+        return removed
+
+    def set_enc_payload(
+        self, queued: PickupQueuedMessage, enc_payload: Union[str, bytes]
+    ):
+        """Record the encrypted payload of a queued message and index its tag.
+
+        Queued messages are shared by their keys, so a payload recorded earlier
+        is kept.
+        """
+        if queued.encrypted:
+            return
+        previous_size = queued.size
+        queued._set_enc_payload(enc_payload)
+        queued._store(self.compressor.compress(queued.enc_payload), self.compressor)
+        for key in queued.recipient_keys:
+            if key not in self._moved:
+                self._moved[key] = self._position(key)
+            self.size_by_key[key] += queued.size - previous_size
+            self.total_size += queued.size - previous_size
+            if queued.tag is not None:
+                self.tags_by_key[key].setdefault(queued.tag, queued)
+
+    async def count_for_key(self, key: str) -> int:
+        """Return the number of messages queued for key."""
+        return self.message_count_for_key(key)
+
+    async def stats_for_key(self, key: str) -> QueueStats:
+        """Return aggregates of the messages queued for key."""
+        messages = self.queue_by_key.get(key)
+        if not messages:
+            return QueueStats()
+        return QueueStats(
+            len(messages),
+            self.size_by_key[key],
+            next(iter(messages.values())).timestamp,
+            messages[next(reversed(messages))].timestamp,
+        )
+
+    async def stats_by_key(self) -> AsyncIterator[Tuple[str, QueueStats]]:
+        """Yield each key with queued messages and its aggregates."""
+        for key in list(self.queue_by_key):
+            stats = await self.stats_for_key(key)
+            if stats.count:
+                yield key, stats
+
+    async def list_keys(
+        self, order: str = "depth", limit: int = 100, after: Optional[Position] = None
+    ) -> List[Tuple[str, QueueStats]]:
+        """Return a page of keys with queued messages and their aggregates.
+
+        The page is read from the position after in the keys sorted in order,
+        in O(log keys + limit) once the keys changed since are sorted.
+        """
+        if order not in self._by_order:
+            raise ValueError(f"Unknown order: {order}")
+        self._sort_keys()
+        positions = self._by_order[order]
+        page = list(
+            islice(
+                (
+                    positions.ascending(after)
+                    if order == "age"
+                    else positions.descending(after)
+                ),
+                limit,
+            )
+        )
+        return [(key, await self.stats_for_key(key)) for _, key in page]
+
+    async def messages_for_key(
+        self, key: str, limit: Optional[int] = None, *, after: int = 0
+    ) -> AsyncIterator[PickupQueuedMessage]:
+        """Lazily yield messages for key, oldest first, without removing them."""
+        for queued in self.queued_messages_for_key(key, limit, after=after):
+            yield queued
+
+    async def remove_by_tags(self, key: str, tags: Iterable[str]) -> int:
+        """Remove messages for key by tag, returning the number removed."""
+        return self.remove_messages_by_tag(key, tags)
+
+    async def remove_for_key(self, key: str, before: Optional[float] = None) -> int:
+        """Remove the messages for key, oldest first, returning the number removed."""
+        return self._discard_first(key, before)
+
+    async def remove_through(
+        self, key: str, seq: int, *, keep: Collection[int] = ()
+    ) -> int:
+        """Remove the messages for key up to sequence number seq, except keep."""
+        if not keep:
+            return self._discard_first(key, through=seq)
+        return await self.remove_seqs(
+            key,
+            [
+                queued_seq
+                for queued_seq in takewhile(
+                    lambda queued_seq: queued_seq <= seq, self.queue_by_key.get(key, ())
+                )
+                if queued_seq not in keep
+            ],
+        )
+
+    async def remove_seqs(self, key: str, seqs: Iterable[int]) -> int:
+        """Remove messages for key by sequence number, returning the number removed."""
+        removed = 0
+        for seq in seqs:
+            queued = self.queue_by_key.get(key, {}).get(seq)
+            if queued is not None:
+                self._discard(key, queued)
+                removed += 1
+        return removed
+
+    async def remove_received_before(
+        self, before: float, max_keys: Optional[int] = None
+    ) -> Tuple[Dict[str, int], bool]:
+        """Remove the messages received before a time, for at most max_keys keys.
+
+        Keys with messages to remove are found in order of age, through the
+        sorted list of keys by first message.
+        """
+        return self._remove_received_before(before, max_keys)
+
+    async def store_enc_payload(
+        self, queued: PickupQueuedMessage, enc_payload: Union[str, bytes]
+    ):
+        """Record the encrypted payload of a queued message."""
+        self.set_enc_payload(queued, enc_payload)
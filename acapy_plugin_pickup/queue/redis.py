@@ -0,0 +1,1040 @@
+"""Pickup queue shared between mediator replicas through Redis.
+
+Keys (all under a configurable prefix):
+
+    seq:<recipient key>     counter assigning sequence numbers to queued messages
+    q:<recipient key>       sorted set of sequence numbers of queued messages
+    m:<recipient key>:<seq> hash holding a queued message and its metadata
+    t:<recipient key>       hash mapping payload tags to sequence numbers
+    b:<recipient key>       total size of queued messages in bytes
+    l:<recipient key>       sorted set of sequence numbers of leased messages, by
+                            lease deadline
+    o:<recipient key>       hash mapping leased sequence numbers to the sender
+                            they were leased to
+    d:<recipient key>:<id>  sequence numbers of the messages of a delivery, kept
+                            for an hour for its acknowledgement
+    x:<recipient key>       hash counting messages expired and evicted since the
+                            last status
+    totals                  hash holding the number and size of all messages
+    by:depth                sorted set of recipient keys by number of messages
+    by:bytes                sorted set of recipient keys by total size
+    by:age                  sorted set of recipient keys by oldest receipt time
+    queued                  channel publishing the recipient keys of messages
+                            as they are written
+
+ACA-Py queues messages synchronously, so new messages are buffered and
+written in the background, a batch per round trip pair. Every read first
+waits for buffered writes of this replica. Each pickup operation costs a
+constant number of round trips, regardless of the number of messages:
+delivering a page of messages takes two (sequence numbers, then messages) and
+acknowledging any number of tags takes three (look up tags, delete, then
+update the total size and the indexes of keys) and the status of a key takes
+two (counts and the first and last sequence numbers, then their receipt
+times). Listing the status of every key, for monitoring, scans the keys a
+batch at a time.
+
+The by: sorted sets list keys a page at a time in constant round trips.
+Their scores are updated as messages are queued and removed, but updates of
+replicas can interleave (and keys emptied stay by age), so they are only
+hints: the scores of the keys of a page are checked against the aggregates of
+those keys and repaired before the page is returned.
+
+Waiters for messages are woken through one subscription to the queued
+channel per replica, shared by all waiting keys, so parked long polls cost
+no round trips. When the subscription is (re)established, every waiter
+checks the queue again, for messages queued while it was down.
+
+ACA-Py's synchronous interface cannot wait for a round trip. It counts the
+messages buffered by this replica and those of the key last seen in Redis by
+this replica (as it wrote, read or removed them), so messages queued or
+removed by other replicas are counted once this replica next reads the key.
+Expiring through it drops buffered messages at once and removes written ones
+in the background.
+
+Caps are checked as buffered messages are written: against the totals read
+before the batch is written with reject-new, or by evicting the oldest
+messages after it is written with drop-oldest, through by:age for the caps
+on all messages. Replicas writing at the same time can briefly exceed caps.
+"""
+
+import asyncio
+from itertools import islice
+import logging
+import math
+import time
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+
+from aries_cloudagent.transport.outbound.message import OutboundMessage
+
+from ..config import CompressionConfig, LimitsConfig
+from .base import (
+    ORDERS,
+    PickupQueue,
+    PickupQueuedMessage,
+    Position,
+    QueueStats,
+    message_size,
+    payload_tag,
+    recipient_keys_of,
+    sort_position,
+    target_list_from_json,
+    target_to_json,
+)
+from .resp import RespClient, RespError
+
+
+LOGGER = logging.getLogger(__name__)
+
+FIELDS = (
+    "received_at",
+    "tag",
+    "size",
+    "enc_payload",
+    "payload",
+    "target",
+    "reply_to_verkey",
+    "reply_thread_id",
+)
+
+# Times a page of keys is read again after repairing the scores of its keys
+REPAIR_ROUNDS = 3
+
+# Seconds the sequence numbers of a delivery are kept for its acknowledgement
+DELIVERY_SECONDS = 3600
+
+# Seconds before subscribing again to the queued channel after losing it
+RESUBSCRIBE_SECONDS = 1.0
+
+
+class RedisPickupQueue(PickupQueue):
+    """Pickup queue stored in Redis (or a server speaking its protocol)."""
+
+    def __init__(
+        self,
+        client: RespClient,
+        *,
+        prefix: str = "pickup:",
+        page_size: int = 100,
+        limits: Optional[LimitsConfig] = None,
+        compression: Optional[CompressionConfig] = None,
+    ):
+        """Initialize the queue."""
+        super().__init__(limits, compression)
+        self.client = client
+        self.prefix = prefix
+        self.page_size = page_size
+        self._buffer: List[Tuple[OutboundMessage, float]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        # Number of written messages by key, as last seen by this replica
+        self._known_counts: Dict[str, int] = {}
+        self._sync_expiry: Optional[asyncio.Task] = None
+        self._watcher: Optional[asyncio.Task] = None
+
+    def _key(self, kind: str, recipient_key: str, seq: Optional[int] = None) -> str:
+        if seq is None:
+            return f"{self.prefix}{kind}:{recipient_key}"
+        return f"{self.prefix}{kind}:{recipient_key}:{seq}"
+
+    def _index(self, order: str) -> str:
+        if order not in ORDERS:
+            raise ValueError(f"Unknown order: {order}")
+        return f"{self.prefix}by:{order}"
+
+    # Writes
+
+    def _add(self, msg: OutboundMessage, timestamp: float):
+        """Buffer a message to be written in the background."""
+        self._buffer.append((msg, timestamp))
+        if self._flush_task is None or self._flush_task.done():
+            try:
+                self._flush_task = asyncio.get_running_loop().create_task(
+                    self._background_flush()
+                )
+            except RuntimeError:
+                LOGGER.debug("No running loop; message written on next read")
+
+    async def _background_flush(self):
+        try:
+            await self.flush()
+        except Exception:
+            LOGGER.exception("Failed to write queued messages; will retry")
+
+    async def flush(self):
+        """Write buffered messages, keeping them buffered if this fails."""
+        async with self._flush_lock:
+            buffer, self._buffer = self._buffer, []
+            if not buffer:
+                return
+            try:
+                await self._write(buffer)
+            except Exception:
+                self._buffer[:0] = buffer
+                raise
+
+    async def _write(self, buffer: List[Tuple[OutboundMessage, float]]):
+        if self._capped and self.limits.policy == "reject-new":
+            buffer = await self._admitted(buffer)
+            if not buffer:
+                await self._store_dropped()
+                return
+        entries: Dict[str, List[Tuple[OutboundMessage, float]]] = {}
+        for msg, timestamp in buffer:
+            for key in recipient_keys_of(msg):
+                entries.setdefault(key, []).append((msg, timestamp))
+
+        keys = list(entries)
+        last_seqs = await self.client.pipeline(
+            [("INCRBY", self._key("seq", key), len(entries[key])) for key in keys]
+        )
+        commands = []
+        # Positions of the replies counting the messages of each key
+        counts = []
+        added = added_size = 0
+        for key, last_seq in zip(keys, last_seqs):
+            first_seq = last_seq - len(entries[key]) + 1
+            zadd = ["ZADD", self._key("q", key)]
+            tags = ["HSET", self._key("t", key)]
+            total_size = 0
+            for seq, (msg, timestamp) in enumerate(entries[key], first_seq):
+                tag = payload_tag(msg.enc_payload)
+                size = message_size(msg)
+                total_size += size
+                fields = {
+                    "received_at": timestamp,
+                    "size": size,
+                    "payload": msg.payload,
+                    "target": target_to_json(msg),
+                    "reply_to_verkey": msg.reply_to_verkey,
+                    "reply_thread_id": msg.reply_thread_id,
+                }
+                if msg.enc_payload:
+                    fields.update(
+                        tag=tag, enc_payload=self.compressor.compress(msg.enc_payload)
+                    )
+                commands.append(
+                    (
+                        "HSET",
+                        self._key("m", key, seq),
+                        *_flatten((k, v) for k, v in fields.items() if v is not None),
+                    )
+                )
+                zadd.extend((seq, seq))
+                if tag:
+                    tags.extend((tag, seq))
+            added += len(entries[key])
+            added_size += total_size
+            commands.append(zadd)
+            counts.append(len(commands))
+            commands.append(("ZCARD", self._key("q", key)))
+            commands.append(("INCRBY", self._key("b", key), total_size))
+            commands.append(("ZINCRBY", self._index("depth"), len(entries[key]), key))
+            commands.append(("ZINCRBY", self._index("bytes"), total_size, key))
+            commands.append(("ZADD", self._index("age"), "NX", entries[key][0][1], key))
+            if len(tags) > 2:
+                commands.append(tags)
+        commands.append(("HINCRBY", self._totals, "count", added))
+        commands.append(("HINCRBY", self._totals, "bytes", added_size))
+        commands.extend(("PUBLISH", self._channel, key) for key in keys)
+        replies = await self.client.pipeline(commands)
+        for key, position in zip(keys, counts):
+            self._know_count(key, replies[position])
+        if self._capped and self.limits.policy == "drop-oldest":
+            await self._evict(keys)
+        await self._store_dropped()
+
+    def _know_count(self, key: str, count: int):
+        """Record the number of written messages of key, as just read."""
+        if count:
+            self._known_counts[key] = count
+        else:
+            self._known_counts.pop(key, None)
+
+    @property
+    def _totals(self) -> str:
+        return f"{self.prefix}totals"
+
+    async def _queued(self, keys: List[str]) -> Tuple[int, int, Dict[str, List[int]]]:
+        """Return the number and size of all messages, and of those of keys."""
+        replies = await self.client.pipeline(
+            [
+                ("HMGET", self._totals, "count", "bytes"),
+                *(
+                    command
+                    for key in keys
+                    for command in (
+                        ("ZCARD", self._key("q", key)),
+                        ("GET", self._key("b", key)),
+                    )
+                ),
+            ]
+        )
+        count, total_size = (int(value or 0) for value in replies[0])
+        for key, key_count in zip(keys, replies[1::2]):
+            self._know_count(key, key_count)
+        return (
+            count,
+            total_size,
+            {
+                key: [count, int(size or 0)]
+                for key, count, size in zip(keys, replies[1::2], replies[2::2])
+            },
+        )
+
+    async def _fits(self, key: str, size: int) -> bool:
+        await self.flush()
+        count, total_size, queued = await self._queued([key])
+        return not (
+            self._over_total_limits(count + 1, total_size + size)
+            or self._over_key_limits(queued[key][0] + 1, queued[key][1] + size)
+        )
+
+    async def _admitted(
+        self, buffer: List[Tuple[OutboundMessage, float]]
+    ) -> List[Tuple[OutboundMessage, float]]:
+        """Return the buffered messages that can be queued within the caps."""
+        count, total_size, queued = await self._queued(
+            list({key for msg, _ in buffer for key in recipient_keys_of(msg)})
+        )
+        admitted = []
+        for msg, timestamp in buffer:
+            keys = recipient_keys_of(msg)
+            size = message_size(msg)
+            if self._over_total_limits(
+                count + len(keys), total_size + size * len(keys)
+            ) or any(
+                self._over_key_limits(queued[key][0] + 1, queued[key][1] + size)
+                for key in keys
+            ):
+                LOGGER.debug("Message for %s rejected: queue caps reached", keys)
+                for key in keys:
+                    self._count_dropped(key, rejected=1)
+                continue
+            admitted.append((msg, timestamp))
+            count += len(keys)
+            total_size += size * len(keys)
+            for key in keys:
+                queued[key][0] += 1
+                queued[key][1] += size
+        return admitted
+
+    async def _evict(self, keys: List[str]):
+        """Evict the oldest messages of keys, then of any key, to meet the caps."""
+        replies = await self.client.pipeline(
+            [
+                command
+                for key in keys
+                for command in (
+                    ("ZCARD", self._key("q", key)),
+                    ("GET", self._key("b", key)),
+                )
+            ]
+        )
+        for key, count, size in zip(keys, replies[0::2], replies[1::2]):
+            if self._over_key_limits(count, int(size or 0)):
+                evicted = await self._remove_first(
+                    key, count, int(size or 0), self._over_key_limits
+                )
+                self._count_dropped(key, evicted=evicted)
+
+        index = self._index("age")
+        while True:
+            count, total_size = (
+                int(value or 0)
+                for value in await self.client.execute(
+                    "HMGET", self._totals, "count", "bytes"
+                )
+            )
+            if not self._over_total_limits(count, total_size):
+                return
+            # Evict from the key with the oldest messages, up to the oldest
+            # message of the next key, then update its position by age
+            reply = await self.client.execute("ZRANGE", index, 0, 1, "WITHSCORES")
+            if not reply:
+                return
+            key = reply[0].decode()
+            horizon = float(reply[3]) if len(reply) > 2 else None
+            evicted = await self._remove_first(
+                key, count, total_size, self._over_total_limits, horizon
+            )
+            self._count_dropped(key, evicted=evicted)
+            (stats,) = await self._stats_for_keys([key])
+            await self.client.execute(
+                *(
+                    ("ZADD", index, "XX", stats.oldest, key)
+                    if stats.count
+                    else ("ZREM", index, key)
+                )
+            )
+
+    async def _remove_first(
+        self,
+        key: str,
+        count: int,
+        total_size: int,
+        over: Callable[[int, int], bool],
+        horizon: Optional[float] = None,
+    ) -> int:
+        """Remove the first messages of key until no longer over caps.
+
+        Messages received after horizon are kept, except the first.
+        """
+        found: List[Tuple[Optional[str], int]] = []
+        last_seq = 0
+        while over(count, total_size):
+            seqs = await self.client.execute(
+                "ZRANGEBYSCORE",
+                self._key("q", key),
+                f"({last_seq}",
+                "+inf",
+                "LIMIT",
+                0,
+                self.page_size,
+            )
+            rows = await self.client.pipeline(
+                [
+                    (
+                        "HMGET",
+                        self._key("m", key, int(seq)),
+                        "received_at",
+                        "size",
+                        "tag",
+                    )
+                    for seq in seqs
+                ]
+            )
+            for seq, (received_at, size, tag) in zip(seqs, rows):
+                if received_at is None:  # removed since the range was read
+                    continue
+                if not over(count, total_size) or (
+                    found and horizon is not None and float(received_at) > horizon
+                ):
+                    return await self._remove(key, found)
+                found.append((tag.decode() if tag else None, int(seq)))
+                count -= 1
+                total_size -= int(size or 0)
+            if len(seqs) < self.page_size:
+                break
+            last_seq = int(seqs[-1])
+        return await self._remove(key, found)
+
+    async def _store_dropped(self):
+        """Move the counts of messages dropped by key to Redis, for any replica."""
+        if not self._dropped_by_key:
+            return
+        dropped, self._dropped_by_key = self._dropped_by_key, {}
+        await self.client.pipeline(
+            [
+                ("HINCRBY", self._key("x", key), field, value)
+                for key, counts in dropped.items()
+                for field, value in zip(("expired", "evicted"), counts)
+                if value
+            ]
+        )
+
+    async def take_dropped(self, key: str) -> Tuple[int, int]:
+        """Return the messages for key expired or dropped by caps, by any replica."""
+        await self._store_dropped()
+        *_, (counts, _) = await self.client.pipeline(
+            [
+                ("MULTI",),
+                ("HMGET", self._key("x", key), "expired", "evicted"),
+                ("DEL", self._key("x", key)),
+                ("EXEC",),
+            ]
+        )
+        expired, evicted = (int(value or 0) for value in counts)
+        return expired, evicted
+
+    async def _expire_before(self, before: float) -> int:
+        """Remove the messages received before a time, counting them as expired."""
+        await self.flush()
+        expired = await super()._expire_before(before)
+        await self._store_dropped()
+        return expired
+
+    @property
+    def _channel(self) -> str:
+        return f"{self.prefix}queued"
+
+    async def wait_for_messages(
+        self, key: str, timeout: float, *, skip_leased: bool = False
+    ) -> bool:
+        """Wait up to timeout seconds for messages queued for key by any replica."""
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.get_running_loop().create_task(self._watch())
+        return await super().wait_for_messages(key, timeout, skip_leased=skip_leased)
+
+    async def _watch(self):
+        """Wake the waiters of keys as messages are written for them."""
+        while True:
+            try:
+                subscription = await self.client.subscribe(self._channel)
+            except (OSError, asyncio.IncompleteReadError, RespError):
+                LOGGER.exception("Failed to subscribe to queued messages; will retry")
+                await asyncio.sleep(RESUBSCRIBE_SECONDS)
+                continue
+            try:
+                # Messages may have been written before the subscription
+                for key in list(self._events):
+                    self._wake(key)
+                async for key in subscription:
+                    self._wake(key.decode())
+            except (OSError, asyncio.IncompleteReadError):
+                LOGGER.warning("Lost the subscription to queued messages; will retry")
+            finally:
+                subscription.close()
+            await asyncio.sleep(RESUBSCRIBE_SECONDS)
+
+    async def close(self):
+        """Write buffered messages and close the connections."""
+        await super().close()
+        if self._sync_expiry is not None:
+            self._sync_expiry.cancel()
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+        await self.flush()
+        await self.client.close()
+
+    # ACA-Py DeliveryQueue interface
+    #
+    # ACA-Py uses these to hand queued messages to open sessions of this
+    # replica, which cannot be done synchronously against a shared queue:
+    # messages are delivered through the Pickup Protocol only, and counted
+    # as last seen by this replica.
+
+    def message_count_for_key(self, key: str) -> int:
+        """Count messages buffered for key, and written as last seen."""
+        buffered = sum(1 for msg, _ in self._buffer if key in recipient_keys_of(msg))
+        return self._known_counts.get(key, 0) + buffered
+
+    def expire_messages(self, ttl=None):
+        """Drop buffered messages past the time limit, and remove written ones.
+
+        Written messages are removed in the background, through the running
+        event loop.
+        """
+        before = time.time() - (ttl or self.ttl_seconds)
+        buffered = []
+        for msg, timestamp in self._buffer:
+            if timestamp < before:
+                for key in recipient_keys_of(msg):
+                    self._count_dropped(key, expired=1)
+            else:
+                buffered.append((msg, timestamp))
+        self._buffer = buffered
+        if self._sync_expiry is not None and not self._sync_expiry.done():
+            return
+        try:
+            self._sync_expiry = asyncio.get_running_loop().create_task(
+                self._background_expire(before)
+            )
+        except RuntimeError:
+            LOGGER.warning("No running loop; messages written to Redis not expired")
+
+    async def _background_expire(self, before: float):
+        try:
+            await self._expire_before(before)
+        except Exception:
+            LOGGER.exception("Failed to expire queued messages")
+
+    def get_one_message_for_key(self, key: str) -> Optional[OutboundMessage]:
+        """Return None; queued messages are only delivered by pickup."""
+        return None
+
+    def inspect_all_messages_for_key(self, key: str) -> Iterator[OutboundMessage]:
+        """Yield nothing; queued messages are only delivered by pickup."""
+        return iter(())
+
+    def remove_message_for_key(self, key: str, msg: OutboundMessage):
+        """Do nothing; no messages are handed out through this interface."""
+
+    # Pickup interface
+
+    async def count_for_key(self, key: str) -> int:
+        """Return the number of messages queued for key."""
+        await self.flush()
+        count = await self.client.execute("ZCARD", self._key("q", key))
+        self._know_count(key, count)
+        return count
+
+    async def stats_for_key(self, key: str) -> QueueStats:
+        """Return aggregates of the messages queued for key."""
+        await self.flush()
+        (stats,) = await self._stats_for_keys([key])
+        return stats
+
+    async def stats_by_key(self) -> AsyncIterator[Tuple[str, QueueStats]]:
+        """Yield each key with queued messages and its aggregates.
+
+        Keys are found with SCAN, a batch at a time; the aggregates of a batch
+        take two round trips.
+        """
+        await self.flush()
+        pattern = self._key("q", "*")
+        start = len(pattern) - 1
+        cursor = b"0"
+        while True:
+            cursor, found = await self.client.execute(
+                "SCAN", cursor, "MATCH", pattern, "COUNT", self.page_size
+            )
+            keys = [name.decode()[start:] for name in found]
+            for key, stats in zip(keys, await self._stats_for_keys(keys)):
+                if stats.count:
+                    yield key, stats
+            if cursor == b"0":
+                return
+
+    async def _stats_for_keys(self, keys: List[str]) -> List[QueueStats]:
+        """Return aggregates of the messages queued for keys in two round trips."""
+        if not keys:
+            return []
+        replies = await self.client.pipeline(
+            [
+                command
+                for key in keys
+                for command in (
+                    ("ZCARD", self._key("q", key)),
+                    ("GET", self._key("b", key)),
+                    ("ZRANGE", self._key("q", key), 0, 0),
+                    ("ZRANGE", self._key("q", key), -1, -1),
+                )
+            ]
+        )
+        ends = [
+            [int(seq) for seq in (*first, *last)]
+            for first, last in zip(replies[2::4], replies[3::4])
+        ]
+        times = iter(
+            await self.client.pipeline(
+                [
+                    ("HGET", self._key("m", key, seq), "received_at")
+                    for key, seqs in zip(keys, ends)
+                    for seq in seqs
+                ]
+            )
+            if any(ends)
+            else ()
+        )
+        stats = []
+        for key, count in zip(keys, replies[0::4]):
+            self._know_count(key, count)
+        for count, total_size, seqs in zip(replies[0::4], replies[1::4], ends):
+            # Replicas number messages in the order they write them, which can
+            # differ slightly from the order they received them in
+            received = [float(value) for value in islice(times, len(seqs)) if value]
+            stats.append(
+                QueueStats(
+                    count,
+                    int(total_size or 0),
+                    min(received, default=None),
+                    max(received, default=None),
+                )
+                if count
+                else QueueStats()
+            )
+        return stats
+
+    async def list_keys(
+        self, order: str = "depth", limit: int = 100, after: Optional[Position] = None
+    ) -> List[Tuple[str, QueueStats]]:
+        """Return a page of keys with queued messages, through a sorted set.
+
+        Reading a page takes three to five round trips, and as many again for
+        each round of repairs.
+        """
+        index = self._index(order)
+        await self.flush()
+        for _ in range(REPAIR_ROUNDS):
+            scored = await self._index_page(index, order == "age", limit, after)
+            keys = [key.decode() for key, _ in scored]
+            page = list(zip(keys, await self._stats_for_keys(keys)))
+            repairs = []
+            for (key, stats), (_, score) in zip(page, scored):
+                if not stats.count:
+                    repairs.append(("ZREM", index, key))
+                else:
+                    value, _ = sort_position(order, key, stats)
+                    if value != float(score):
+                        repairs.append(("ZADD", index, "XX", value, key))
+            if not repairs:
+                break
+            await self.client.pipeline(repairs)
+        page = [(key, stats) for key, stats in page if stats.count]
+        page.sort(key=lambda item: sort_position(order, *item), reverse=order != "age")
+        return page
+
+    async def _index_page(
+        self, index: str, ascending: bool, limit: int, after: Optional[Position]
+    ) -> List[Tuple[bytes, bytes]]:
+        """Return members and scores of a page of a sorted set, after a position.
+
+        The page starts right after the member at that position if it is still
+        there with the same score; otherwise, after its score (skipping the
+        members tied with it that were not listed yet).
+        """
+        range_, rank = ("ZRANGE", "ZRANK") if ascending else ("ZREVRANGE", "ZREVRANK")
+        start = 0
+        if after is not None:
+            value, key = after
+            score, position = await self.client.pipeline(
+                [("ZSCORE", index, key), (rank, index, key)]
+            )
+            if score is not None and float(score) == value:
+                start = position + 1
+            else:
+                reply = await self.client.execute(
+                    *(
+                        ("ZRANGEBYSCORE", index, f"({value!r}", "+inf")
+                        if ascending
+                        else ("ZREVRANGEBYSCORE", index, f"({value!r}", "-inf")
+                    ),
+                    "WITHSCORES",
+                    "LIMIT",
+                    0,
+                    limit,
+                )
+                return list(zip(reply[0::2], reply[1::2]))
+        reply = await self.client.execute(
+            range_, index, start, start + limit - 1, "WITHSCORES"
+        )
+        return list(zip(reply[0::2], reply[1::2]))
+
+    async def messages_for_key(
+        self, key: str, limit: Optional[int] = None, *, after: int = 0
+    ) -> AsyncIterator[PickupQueuedMessage]:
+        """Lazily yield messages for key, a page per two round trips."""
+        await self.flush()
+        remaining = limit
+        last_seq = after
+        while remaining is None or remaining > 0:
+            page_size = (
+                self.page_size if remaining is None else min(remaining, self.page_size)
+            )
+            seqs = await self.client.execute(
+                "ZRANGEBYSCORE",
+                self._key("q", key),
+                f"({last_seq}",
+                "+inf",
+                "LIMIT",
+                0,
+                page_size,
+            )
+            if not seqs:
+                return
+            rows = await self.client.pipeline(
+                [("HMGET", self._key("m", key, int(seq)), *FIELDS) for seq in seqs]
+            )
+            for seq, row in zip(seqs, rows):
+                if row[0] is not None:  # removed since the range was read
+                    queued = _from_row(key, int(seq), row)
+                    if queued.enc_payload:
+                        queued._store(queued.enc_payload, self.compressor)
+                    yield queued
+            if remaining is not None:
+                remaining -= len(seqs)
+            if len(seqs) < page_size:
+                return
+            last_seq = int(seqs[-1])
+
+    async def remove_by_tags(self, key: str, tags: Iterable[str]) -> int:
+        """Remove messages for key by tag, returning the number removed."""
+        tags = list(tags)
+        if not tags:
+            return 0
+        await self.flush()
+        seqs = await self.client.execute("HMGET", self._key("t", key), *tags)
+        return await self._remove(
+            key, [(tag, int(seq)) for tag, seq in zip(tags, seqs) if seq is not None]
+        )
+
+    async def remove_for_key(self, key: str, before: Optional[float] = None) -> int:
+        """Remove the messages for key, a page per three round trips.
+
+        Messages are visited in sequence order, which replicas make close to
+        the order they are received in, up to the first received after before.
+        """
+        return await self._remove_prefix(key, before=before)
+
+    async def remove_through(
+        self, key: str, seq: int, *, keep: Collection[int] = ()
+    ) -> int:
+        """Remove the messages for key up to sequence number seq, except keep.
+
+        Only the messages removed (and those kept) are read, a page per three
+        round trips.
+        """
+        return await self._remove_prefix(key, through=seq, keep=keep)
+
+    async def _remove_prefix(
+        self,
+        key: str,
+        *,
+        before: Optional[float] = None,
+        through: Optional[int] = None,
+        keep: Collection[int] = (),
+    ) -> int:
+        await self.flush()
+        removed = last_seq = 0
+        while True:
+            seqs = await self.client.execute(
+                "ZRANGEBYSCORE",
+                self._key("q", key),
+                f"({last_seq}",
+                "+inf" if through is None else through,
+                "LIMIT",
+                0,
+                self.page_size,
+            )
+            rows = await self.client.pipeline(
+                [
+                    ("HMGET", self._key("m", key, int(seq)), "received_at", "tag")
+                    for seq in seqs
+                ]
+            )
+            found = []
+            for seq, (received_at, tag) in zip(seqs, rows):
+                if received_at is None or int(seq) in keep:
+                    # Removed since the range was read, or kept
+                    continue
+                if before is not None and float(received_at) >= before:
+                    return removed + await self._remove(key, found)
+                found.append((tag.decode() if tag else None, int(seq)))
+            removed += await self._remove(key, found)
+            if len(seqs) < self.page_size:
+                return removed
+            last_seq = int(seqs[-1])
+
+    async def remove_seqs(self, key: str, seqs: Iterable[int]) -> int:
+        """Remove messages for key by sequence number in three round trips."""
+        seqs = list(seqs)
+        if not seqs:
+            return 0
+        await self.flush()
+        rows = await self.client.pipeline(
+            [("HMGET", self._key("m", key, seq), "received_at", "tag") for seq in seqs]
+        )
+        return await self._remove(
+            key,
+            [
+                (tag.decode() if tag else None, seq)
+                for seq, (received_at, tag) in zip(seqs, rows)
+                if received_at is not None
+            ],
+        )
+
+    async def _remove(self, key: str, found: List[Tuple[Optional[str], int]]) -> int:
+        """Remove messages for key by tag and sequence number in two round trips."""
+        if not found:
+            return 0
+        # Read the sizes and remove the messages atomically so that a message
+        # removed concurrently by another replica is only subtracted once
+        commands = [("MULTI",)]
+        for _, seq in found:
+            commands.append(("HGET", self._key("m", key, seq), "size"))
+            commands.append(("ZREM", self._key("q", key), seq))
+        commands.append(("DEL", *(self._key("m", key, seq) for _, seq in found)))
+        commands.append(("ZREM", self._key("l", key), *(seq for _, seq in found)))
+        tags = [tag for tag, _ in found if tag]
+        if tags:
+            commands.append(("HDEL", self._key("t", key), *tags))
+        commands.append(("ZCARD", self._key("q", key)))
+        commands.append(("EXEC",))
+        replies = (await self.client.pipeline(commands))[-1]
+        self._know_count(key, replies[-1])
+        removed = freed = 0
+        for size, count in zip(replies[0::2], replies[1::2][: len(found)]):
+            if count:
+                removed += 1
+                freed += int(size or 0)
+        if removed:
+            await self.client.pipeline(
+                [
+                    ("DECRBY", self._key("b", key), freed),
+                    ("ZINCRBY", self._index("depth"), -removed, key),
+                    ("ZINCRBY", self._index("bytes"), -freed, key),
+                    ("ZREMRANGEBYSCORE", self._index("depth"), "-inf", 0),
+                    ("HINCRBY", self._totals, "count", -removed),
+                    ("HINCRBY", self._totals, "bytes", -freed),
+                ]
+            )
+        return removed
+
+    async def lease_deadlines(self, key: str) -> Dict[int, float]:
+        """Return when the leases of key taken by any replica end, by sequence number."""
+        leases = self._key("l", key)
+        _, reply = await self.client.pipeline(
+            [
+                ("ZREMRANGEBYSCORE", leases, "-inf", time.time()),
+                ("ZRANGE", leases, 0, -1, "WITHSCORES"),
+            ]
+        )
+        return {
+            int(seq): float(deadline) for seq, deadline in zip(reply[::2], reply[1::2])
+        }
+
+    async def leased_to_others(self, key: str, owner: Optional[str]) -> Set[int]:
+        """Return the sequence numbers of the messages of key leased to others.
+
+        A message whose owner is not yet recorded counts as leased to others.
+        """
+        seqs = list(await self.leased(key))
+        if not seqs:
+            return set()
+        owners = await self.client.execute("HMGET", self._key("o", key), *seqs)
+        return {
+            seq
+            for seq, leased_to in zip(seqs, owners)
+            if owner is None or leased_to is None or leased_to.decode() != owner
+        }
+
+    async def lease(
+        self,
+        key: str,
+        seqs: Sequence[int],
+        timeout: float,
+        owner: Optional[str] = None,
+    ) -> List[int]:
+        """Lease messages of key to owner for timeout seconds.
+
+        Each message is added to the leases of key unless already there, in one
+        round trip, so replicas leasing the same message concurrently only
+        lease it once; the owners of the messages leased are then recorded in
+        another.
+        """
+        if not seqs:
+            return []
+        leases = self._key("l", key)
+        now = time.time()
+        replies = await self.client.pipeline(
+            [
+                ("ZREMRANGEBYSCORE", leases, "-inf", now),
+                *(("ZADD", leases, "NX", now + timeout, seq) for seq in seqs),
+                # Leases of a key all end by then
+                ("EXPIRE", leases, math.ceil(timeout)),
+            ]
+        )
+        taken = [seq for seq, added in zip(seqs, replies[1:-1]) if added]
+        if taken and owner is not None:
+            owners = self._key("o", key)
+            await self.client.pipeline(
+                [
+                    ("HSET", owners, *(x for seq in taken for x in (seq, owner))),
+                    ("EXPIRE", owners, math.ceil(timeout)),
+                ]
+            )
+        return taken
+
+    async def record_delivery(self, key: str, delivery_id: str, seqs: Sequence[int]):
+        """Record the sequence numbers of a delivery for any replica, for a while."""
+        await self.client.execute(
+            "SET",
+            self._key("d", key, delivery_id),
+            ",".join(str(seq) for seq in seqs),
+            "EX",
+            DELIVERY_SECONDS,
+        )
+
+    async def take_delivery(self, key: str, delivery_id: str) -> Sequence[int]:
+        """Return and forget the sequence numbers of a delivery for key."""
+        delivery = self._key("d", key, delivery_id)
+        seqs, _ = await self.client.pipeline([("GET", delivery), ("DEL", delivery)])
+        return [int(seq) for seq in seqs.split(b",")] if seqs else []
+
+    async def store_enc_payload(
+        self, queued: PickupQueuedMessage, enc_payload: Union[str, bytes]
+    ):
+        """Record the encrypted payload of a queued message, unless one was."""
+        (key,) = queued.recipient_keys
+        message_key = self._key("m", key, queued.seq)
+        compressed = self.compressor.compress(enc_payload)
+        stored, current, received_at = await self.client.pipeline(
+            [
+                ("HSETNX", message_key, "enc_payload", compressed),
+                ("HGET", message_key, "enc_payload"),
+                ("HGET", message_key, "received_at"),
+            ]
+        )
+        previous_size = queued.size
+        if current and not stored:
+            # Recorded meanwhile, by another replica
+            compressed = current
+            enc_payload = self.compressor.decompress(current)
+        queued._set_enc_payload(enc_payload)
+        queued._store(compressed, self.compressor)
+        if stored and received_at is None:
+            # Removed meanwhile; drop the hash just created
+            await self.client.execute("DEL", message_key)
+            return
+        if not stored:
+            return
+        commands = [
+            ("INCRBY", self._key("b", key), queued.size - (previous_size or 0)),
+            (
+                "ZINCRBY",
+                self._index("bytes"),
+                queued.size - (previous_size or 0),
+                key,
+            ),
+            ("HINCRBY", self._totals, "bytes", queued.size - (previous_size or 0)),
+            (
+                "HSET",
+                message_key,
+                "size",
+                queued.size,
+                *(("tag", queued.tag) if queued.tag else ()),
+            ),
+        ]
+        if queued.tag:
+            commands.append(("HSET", self._key("t", key), queued.tag, queued.seq))
+        await self.client.pipeline(commands)
+
+
+def _flatten(pairs: Iterable[Tuple[Any, Any]]) -> Iterator[Any]:
+    for first, second in pairs:
+        yield first
+        yield second
+
+
+def _from_row(key: str, seq: int, row: List[Optional[bytes]]) -> PickupQueuedMessage:
+    (
+        received_at,
+        tag,
+        size,
+        enc_payload,
+        payload,
+        target,
+        reply_to_verkey,
+        reply_thread_id,
+    ) = row
+    msg = OutboundMessage(
+        payload=payload,
+        enc_payload=enc_payload,
+        reply_to_verkey=reply_to_verkey.decode() if reply_to_verkey else None,
+        reply_thread_id=reply_thread_id.decode() if reply_thread_id else None,
+        target_list=target_list_from_json(target),
+    )
+    queued = PickupQueuedMessage(
+        msg,
+        seq,
+        float(received_at),
+        tag=tag.decode() if tag else None,
+        size=int(size) if size else None,
+    )
+    queued.recipient_keys = (key,)
+    return queued
@@ -0,0 +1,185 @@
+"""Minimal asyncio client for the Redis serialization protocol (RESP2).
+
+Only what the Redis queue backend needs: single commands and pipelines of
+commands sent in one round trip over one connection, and subscriptions to a
+channel over connections of their own.
+"""
+
+import asyncio
+from typing import Any, List, Optional, Sequence, Union
+from urllib.parse import urlparse
+
+
+class RespError(Exception):
+    """Error reply from the server or protocol error."""
+
+
+Arg = Union[str, bytes, int, float]
+
+
+def encode_command(args: Sequence[Arg]) -> bytes:
+    """Encode a command as a RESP array of bulk strings."""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        elif not isinstance(arg, bytes):
+            arg = repr(arg).encode() if isinstance(arg, float) else str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def read_reply(reader: asyncio.StreamReader) -> Any:
+    """Read one reply; error replies are returned as RespError instances."""
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection closed by server")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest.decode()
+    if kind == b"-":
+        return RespError(rest.decode())
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        length = int(rest)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise RespError(f"Unexpected reply type: {line!r}")
+
+
+class Subscription:
+    """Messages published to a channel, read over a connection of its own."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Wrap a connection subscribed to a channel."""
+        self._reader = reader
+        self._writer = writer
+
+    def __aiter__(self) -> "Subscription":
+        """Iterate over the messages published, until the connection is lost."""
+        return self
+
+    async def __anext__(self) -> bytes:
+        """Return the next message published."""
+        while True:
+            reply = await read_reply(self._reader)
+            if isinstance(reply, list) and reply[:1] == [b"message"]:
+                return reply[2]
+
+    def close(self):
+        """Close the connection."""
+        self._writer.close()
+
+
+class RespClient:
+    """Client holding a single connection, used for one request at a time."""
+
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 6379,
+        *,
+        password: Optional[str] = None,
+        db: int = 0,
+    ):
+        """Initialize the client; the connection is opened on first use."""
+        self.host = host
+        self.port = port
+        self.password = password
+        self.db = db
+        self.round_trips = 0
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def from_url(cls, url: str) -> "RespClient":
+        """Create a client from a redis://[:password@]host[:port][/db] URL."""
+        parsed = urlparse(url)
+        if parsed.scheme != "redis":
+            raise ValueError(f"Unsupported URL scheme: {parsed.scheme}")
+        return cls(
+            parsed.hostname or "localhost",
+            parsed.port or 6379,
+            password=parsed.password,
+            db=int(parsed.path.lstrip("/") or 0),
+        )
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        setup = []
+        if self.password:
+            setup.append(("AUTH", self.password))
+        if self.db:
+            setup.append(("SELECT", self.db))
+        if setup:
+            await self._round_trip(setup)
+
+    async def _round_trip(self, commands: Sequence[Sequence[Arg]]) -> List[Any]:
+        self._writer.write(b"".join(encode_command(command) for command in commands))
+        await self._writer.drain()
+        self.round_trips += 1
+        replies = [await read_reply(self._reader) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RespError):
+                raise reply
+        return replies
+
+    async def pipeline(self, commands: Sequence[Sequence[Arg]]) -> List[Any]:
+        """Send commands in a single round trip and return their replies."""
+        if not commands:
+            return []
+        async with self._lock:
+            if self._writer is None or self._writer.is_closing():
+                await self._connect()
+            try:
+                return await self._round_trip(commands)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # Replies can no longer be matched to requests
+                await self._disconnect()
+                raise
+
+    async def subscribe(self, channel: str) -> Subscription:
+        """Subscribe to channel over a connection of its own."""
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        # Channels are shared by all databases, so there is nothing to select
+        commands = [("AUTH", self.password)] if self.password else []
+        commands.append(("SUBSCRIBE", channel))
+        writer.write(b"".join(encode_command(command) for command in commands))
+        try:
+            await writer.drain()
+            for _ in commands:
+                reply = await read_reply(reader)
+                if isinstance(reply, RespError):
+                    raise reply
+        except BaseException:
+            writer.close()
+            raise
+        return Subscription(reader, writer)
+
+    async def execute(self, *args: Arg) -> Any:
+        """Send a single command and return its reply."""
+        (reply,) = await self.pipeline([args])
+        return reply
+
+    async def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        self._reader = self._writer = None
+
+    async def close(self):
+        """Close the connection."""
+        async with self._lock:
+            await self._disconnect()
@@ -0,0 +1,124 @@
+"""List kept sorted as values are added and removed.
+
+Values are held in buckets of at most twice `load` values, each sorted, with
+the largest value of each bucket in a separate sorted list. Adding or removing
+a value costs two binary searches and moving at most a bucket's worth of
+pointers, however many values are held, and values can be visited in either
+order from any value.
+"""
+
+from bisect import bisect_left, bisect_right, insort
+from typing import Any, Iterator, List, Optional
+
+
+class SortedList:
+    """Values sorted in ascending order, in buckets."""
+
+    def __init__(self, load: int = 512):
+        """Initialize an empty list."""
+        self.load = load
+        self._buckets: List[list] = []
+        self._maxes: list = []
+        self._len = 0
+
+    def __len__(self) -> int:
+        """Return the number of values held."""
+        return self._len
+
+    def add(self, value: Any):
+        """Add a value."""
+        maxes = self._maxes
+        self._len += 1
+        if not maxes:
+            self._buckets.append([value])
+            maxes.append(value)
+            return
+        pos = bisect_left(maxes, value)
+        if pos == len(maxes):
+            pos -= 1
+            self._buckets[pos].append(value)
+            maxes[pos] = value
+        else:
+            insort(self._buckets[pos], value)
+        bucket = self._buckets[pos]
+        if len(bucket) > 2 * self.load:
+            # Split the bucket in two halves
+            half = bucket[self.load :]  # noqa: E203
+            del bucket[self.load :]  # noqa: E203
+            self._buckets.insert(pos + 1, half)
+            maxes.insert(pos, bucket[-1])
+
+    def remove(self, value: Any):
+        """Remove a value, which must be held."""
+        maxes = self._maxes
+        pos = bisect_left(maxes, value)
+        if pos == len(maxes):
+            raise ValueError(f"{value!r} not in list")
+        bucket = self._buckets[pos]
+        index = bisect_left(bucket, value)
+        if bucket[index] != value:
+            raise ValueError(f"{value!r} not in list")
+        del bucket[index]
+        self._len -= 1
+        if not bucket:
+            del self._buckets[pos]
+            del maxes[pos]
+        elif index == len(bucket):
+            maxes[pos] = bucket[-1]
+
+    def replace(self, old: Any, new: Any):
+        """Replace a value held by another, in place if it falls in the same bucket."""
+        maxes = self._maxes
+        pos = bisect_left(maxes, old)
+        if pos == len(maxes):
+            raise ValueError(f"{old!r} not in list")
+        buckets = self._buckets
+        bucket = buckets[pos]
+        index = bisect_left(bucket, old)
+        if bucket[index] != old:
+            raise ValueError(f"{old!r} not in list")
+        del bucket[index]
+        if (
+            bucket
+            and (pos == 0 or new > maxes[pos - 1])
+            and (pos == len(maxes) - 1 or new < buckets[pos + 1][0])
+        ):
+            insort(bucket, new)
+            maxes[pos] = bucket[-1]
+            return
+        self._len -= 1
+        if not bucket:
+            del buckets[pos]
+            del maxes[pos]
+        elif index == len(bucket):
+            maxes[pos] = bucket[-1]
+        self.add(new)
+
+    def first(self) -> Optional[Any]:
+        """Return the smallest value, if any."""
+        return self._buckets[0][0] if self._buckets else None
+
+    def ascending(self, after: Optional[Any] = None) -> Iterator[Any]:
+        """Yield the values greater than after (or all), smallest first."""
+        buckets = self._buckets
+        pos = 0 if after is None else bisect_right(self._maxes, after)
+        for number in range(pos, len(buckets)):
+            bucket = buckets[number]
+            start = 0
+            if number == pos and after is not None:
+                start = bisect_right(bucket, after)
+            yield from bucket[start:]
+
+    def descending(self, before: Optional[Any] = None) -> Iterator[Any]:
+        """Yield the values less than before (or all), largest first."""
+        buckets = self._buckets
+        pos = len(buckets) - 1
+        if before is not None:
+            pos = min(bisect_left(self._maxes, before), pos)
+        for number in range(pos, -1, -1):
+            bucket = buckets[number]
+            end = len(bucket)
+            if number == pos and before is not None:
+                end = bisect_left(bucket, before)
+            for index in range(end - 1, -1, -1):
+                yield bucket[index]
@@ -0,0 +1,311 @@
+"""In-memory pickup queue spilling payloads to memory-mapped segment files.
+
+When many recipients are offline, the payloads queued for them can take more
+memory than the mediator should use, while the records indexing them (tag,
+size, sequence number, receipt time) stay small. The queue defined here keeps
+the records and indexes of the memory queue, and the payloads held most
+recently up to a memory budget; older payloads are appended to segment files
+and read back through mmap when delivered. Memory then grows with the number
+of queued messages rather than with their size, without an external database.
+
+A segment is sealed once it reaches segment_bytes and a new one started.
+Payloads of removed messages are left in place and counted as dead bytes; once
+compact_ratio of a sealed segment is dead, its live payloads are copied to the
+active segment and its file deleted, so disk use stays within a small multiple
+of the bytes spilled.
+
+Segment files are scratch space, deleted as the queue closes: as with the
+memory queue, queued messages do not survive a restart (the SQLite backend
+persists them).
+"""
+
+import base64
+from collections import OrderedDict
+from itertools import count
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+from typing import List, Optional, Set, Union
+
+from ..config import CompressionConfig, LimitsConfig
+from .base import PickupQueuedMessage
+from .memory import MemoryPickupQueue
+
+
+LOGGER = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".seg"
+
+
+class Segment:
+    """Append-only file of spilled payloads, read back through mmap.
+
+    The file is mapped again on a read past the end of its current mapping, so
+    that a read is a slice of the mapping rather than a seek and read shared
+    with the writes.
+
+    Attributes:
+        path: path of the segment file
+        size: bytes written to the segment
+        dead: bytes of the payloads of messages removed from the queue
+        records: records of the queued messages whose payloads are in the segment
+
+    """
+
+    def __init__(self, path: str):
+        """Create the segment file."""
+        self.path = path
+        self.size = 0
+        self.dead = 0
+        self.records: Set["SpilledQueuedMessage"] = set()
+        self._file = open(path, "w+b")
+        self._map: Optional[mmap.mmap] = None
+
+    def append(self, record: "SpilledQueuedMessage", stored: bytes) -> int:
+        """Append the stored payload of record, returning its offset."""
+        offset = self.size
+        self._file.write(stored)
+        self.size += len(stored)
+        self.records.add(record)
+        return offset
+
+    def read(self, offset: int, length: int) -> bytes:
+        """Return the length bytes at offset."""
+        if self._map is None or len(self._map) < offset + length:
+            self._remap()
+        return self._map[offset : offset + length]  # noqa: E203
+
+    def release(self, record: "SpilledQueuedMessage"):
+        """Count the payload of a removed message as dead."""
+        self.records.discard(record)
+        self.dead += record.stored_size
+
+    def _remap(self):
+        self._file.flush()
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def delete(self):
+        """Delete the segment file.
+
+        The file stays mapped until the segment is dropped, so that records of
+        messages removed before can still be read.
+        """
+        if self.size and (self._map is None or len(self._map) < self.size):
+            self._remap()
+        self._file.close()
+        os.remove(self.path)
+
+    def close(self):
+        """Unmap and delete the segment file."""
+        if not self._file.closed:
+            self.delete()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class SpilledQueuedMessage(PickupQueuedMessage):
+    """Record of a queued message whose payload may be spilled to a segment.
+
+    Once spilled, the stored payload is no longer held in enc_payload but read
+    from its segment as needed. Its base64 encoding is kept, as for other
+    records, only while the payload is held in memory, so that memory holds
+    nothing of the payloads spilled.
+
+    Attributes:
+        segment: the segment holding the stored payload, once spilled
+        offset: position of the stored payload in its segment
+        stored_size: size of the stored payload in its segment
+
+    """
+
+    __slots__ = ("segment", "offset", "stored_size")
+
+    def __init__(self, *args, **kwargs):
+        """Record message, with its payload held in memory."""
+        super().__init__(*args, **kwargs)
+        self.segment: Optional[Segment] = None
+        self.offset = 0
+        self.stored_size = 0
+
+    @property
+    def payload(self) -> Optional[bytes]:
+        """Return the encrypted payload, read from its segment if spilled."""
+        if self.segment is None:
+            return super().payload
+        stored = self.segment.read(self.offset, self.stored_size)
+        if self.codec is None:
+            return stored
+        return self.codec.decompress(stored)
+
+    @property
+    def b64_payload(self) -> str:
+        """Return the encrypted payload base64 encoded, kept unless spilled."""
+        if self.segment is None:
+            return super().b64_payload
+        return base64.b64encode(self.payload).decode("ascii")
+
+
+class SpillPickupQueue(MemoryPickupQueue):
+    """Memory pickup queue holding payloads past a memory budget in segment files.
+
+    Encrypted payloads are held in memory in the order they were stored;
+    once they take more than memory_bytes, the oldest are appended to the
+    active segment until they fit again. Plaintext messages are held until
+    encrypted, and only spilled then.
+
+    Attributes:
+        resident_bytes: size of the stored payloads held in memory
+        spilled: payloads spilled to segments
+        spilled_bytes: size of the stored payloads of queued messages in segments
+        compactions: segments compacted
+
+    """
+
+    record_type = SpilledQueuedMessage
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        *,
+        memory_bytes: int = 64 * 2**20,
+        segment_bytes: int = 64 * 2**20,
+        compact_ratio: float = 0.75,
+        limits: Optional[LimitsConfig] = None,
+        compression: Optional[CompressionConfig] = None,
+    ) -> None:
+        """Initialize the queue, deleting segment files left in directory."""
+        super().__init__(limits, compression)
+        self._own_directory = directory is None
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="pickup-spill-")
+        else:
+            os.makedirs(directory, exist_ok=True)
+            for name in os.listdir(directory):
+                if name.endswith(SEGMENT_SUFFIX):
+                    os.remove(os.path.join(directory, name))
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.segment_bytes = segment_bytes
+        self.compact_ratio = compact_ratio
+        # Records holding their payloads in memory, oldest held first
+        self._resident: "OrderedDict[SpilledQueuedMessage, None]" = OrderedDict()
+        self.resident_bytes = 0
+        # Segments, oldest first; the last is the one appended to
+        self.segments: List[Segment] = []
+        self._segment_ids = count(1)
+        self.spilled = 0
+        self.spilled_bytes = 0
+        self.compactions = 0
+
+    @property
+    def disk_bytes(self) -> int:
+        """Return the size of the segment files, including dead bytes."""
+        return sum(segment.size for segment in self.segments)
+
+    def _append(self, key: str, queued: SpilledQueuedMessage):
+        """Append a wrapped message to the queue for key, holding its payload."""
+        held = bool(queued.recipient_keys)
+        super()._append(key, queued)
+        if not held and queued.recipient_keys:
+            self._hold(queued)
+
+    def _discard(self, key: str, queued: SpilledQueuedMessage):
+        """Remove a wrapped message from the queue for key, once for all keys."""
+        super()._discard(key, queued)
+        if not queued.recipient_keys:
+            self._release(queued)
+
+    def set_enc_payload(
+        self, queued: SpilledQueuedMessage, enc_payload: Union[str, bytes]
+    ):
+        """Record the encrypted payload of a queued message, holding it in memory."""
+        encrypted = queued.encrypted
+        super().set_enc_payload(queued, enc_payload)
+        if not encrypted and queued.recipient_keys:
+            self._hold(queued)
+
+    def _hold(self, queued: SpilledQueuedMessage):
+        """Hold the payload of a newly queued message, spilling older payloads."""
+        if queued.enc_payload is None:
+            return
+        self._resident[queued] = None
+        self.resident_bytes += len(queued.enc_payload)
+        while self.resident_bytes > self.memory_bytes and self._resident:
+            self._spill(self._resident.popitem(last=False)[0])
+
+    def _spill(self, queued: SpilledQueuedMessage):
+        """Move the payload of a message from memory to the active segment."""
+        stored = queued.enc_payload
+        self.resident_bytes -= len(stored)
+        segment = self._active_segment(len(stored))
+        queued.offset = segment.append(queued, stored)
+        queued.segment = segment
+        queued.stored_size = len(stored)
+        queued.enc_payload = None
+        queued._b64_payload = None
+        self.spilled += 1
+        self.spilled_bytes += len(stored)
+
+    def _release(self, queued: SpilledQueuedMessage):
+        """Drop the payload of a message removed for all keys."""
+        if queued in self._resident:
+            del self._resident[queued]
+            self.resident_bytes -= len(queued.enc_payload)
+            return
+        segment = queued.segment
+        if segment is None or queued not in segment.records:
+            return
+        segment.release(queued)
+        self.spilled_bytes -= queued.stored_size
+        if segment is not self.segments[-1] and self._compactable(segment):
+            self._compact(segment)
+
+    def _compactable(self, segment: Segment) -> bool:
+        return segment.dead >= segment.size * self.compact_ratio
+
+    def _active_segment(self, size: int) -> Segment:
+        """Return the segment to append size bytes to, sealing a full segment."""
+        if self.segments:
+            active = self.segments[-1]
+            if not active.size or active.size + size <= self.segment_bytes:
+                return active
+        segment = Segment(
+            os.path.join(
+                self.directory, f"{next(self._segment_ids):08d}{SEGMENT_SUFFIX}"
+            )
+        )
+        self.segments.append(segment)
+        if len(self.segments) > 1 and self._compactable(self.segments[-2]):
+            self._compact(self.segments[-2])
+        return segment
+
+    def _compact(self, segment: Segment):
+        """Copy the live payloads of a segment to the active one and delete it."""
+        self.segments.remove(segment)
+        for queued in sorted(segment.records, key=lambda queued: queued.seq):
+            stored = segment.read(queued.offset, queued.stored_size)
+            target = self._active_segment(len(stored))
+            queued.offset = target.append(queued, stored)
+            queued.segment = target
+        LOGGER.debug(
+            "Compacted segment %s: %d of %d bytes live",
+            segment.path,
+            segment.size - segment.dead,
+            segment.size,
+        )
+        segment.delete()
+        self.compactions += 1
+
+    async def close(self):
+        """Delete the segment files."""
+        await super().close()
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+        if self._own_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,844 @@
+"""Durable pickup queue backed by SQLite.
+
+The database is only accessed from a thread of its own, in the order calls are
+made, so that queries and commits never block the event loop; the methods of
+the asynchronous pickup interface await it. ACA-Py's interface is synchronous
+and never waits for it either: messages queued through it are buffered and
+inserted in batches, a batch per pass of the event loop (or of batch_size
+messages), checked against the caps as they are inserted; any later call sees
+them. The number of messages of each key is kept in process for ACA-Py's
+counts, and, as with the Redis backend, queued messages are only handed out
+through pickup, never read back through ACA-Py's interface.
+
+The database runs in WAL mode with synchronous=NORMAL. Writes are applied to
+an open transaction immediately, so they are visible to subsequent reads, and
+committed together once `batch_size` writes are pending or `flush_interval`
+seconds after the first of them (group commit). A crash can therefore lose at
+most the writes of the last flush interval, but enqueueing never waits on a
+sync to disk.
+
+Per-key message counts, sizes and oldest receipt times are kept in a
+separate table, and the newest message of a key is found through an index, so
+the aggregates of a key never require a scan. That table is indexed on each
+aggregate to list keys a page at a time in any order. Rather than updating it
+(and its indexes) with a trigger for each row, the queue sums the changes of
+its writes per key and applies them once per commit, or before aggregates are
+read; the count and size of a key, checked against the caps as messages are
+queued, are read with the changes not yet applied. Sequence numbers are shared
+by all keys; the messages of a key up to one are removed through an index on
+(recipient key, sequence number).
+"""
+
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import sqlite3
+import threading
+import time
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+from aries_cloudagent.transport.outbound.message import OutboundMessage
+
+from ..config import CompressionConfig, LimitsConfig
+from .base import (
+    PickupQueue,
+    PickupQueuedMessage,
+    Position,
+    QueueStats,
+    message_size,
+    payload_tag,
+    recipient_keys_of,
+    target_list_from_json,
+    target_to_json,
+)
+
+
+LOGGER = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queued_messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient_key TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    tag TEXT,
+    size INTEGER,
+    enc_payload BLOB,
+    payload BLOB,
+    target TEXT,
+    reply_to_verkey TEXT,
+    reply_thread_id TEXT
+);
+CREATE INDEX IF NOT EXISTS queued_messages_key_received
+    ON queued_messages (recipient_key, received_at);
+CREATE INDEX IF NOT EXISTS queued_messages_key_tag
+    ON queued_messages (recipient_key, tag);
+CREATE INDEX IF NOT EXISTS queued_messages_key_seq
+    ON queued_messages (recipient_key, seq);
+CREATE INDEX IF NOT EXISTS queued_messages_received ON queued_messages (received_at);
+"""
+
+STATS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue_stats (
+    recipient_key TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    total_size INTEGER NOT NULL,
+    oldest REAL
+);
+CREATE INDEX IF NOT EXISTS queue_stats_count ON queue_stats (count, recipient_key);
+CREATE INDEX IF NOT EXISTS queue_stats_size
+    ON queue_stats (total_size, recipient_key);
+CREATE INDEX IF NOT EXISTS queue_stats_oldest ON queue_stats (oldest, recipient_key);
+CREATE TABLE IF NOT EXISTS queue_totals (
+    count INTEGER NOT NULL,
+    total_size INTEGER NOT NULL
+);
+"""
+
+# Triggers that kept the stats of queues created with earlier versions
+DROP_TRIGGERS = """
+DROP TRIGGER IF EXISTS queue_stats_insert;
+DROP TRIGGER IF EXISTS queue_stats_delete;
+DROP TRIGGER IF EXISTS queue_stats_size;
+"""
+
+# Apply the changes to the count, size and oldest receipt time of a key
+UPDATE_STATS = (
+    "INSERT INTO queue_stats VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (recipient_key) DO UPDATE "
+    "SET count = count + excluded.count, "
+    "total_size = total_size + excluded.total_size, "
+    "oldest = coalesce(min(oldest, excluded.oldest), oldest)"
+)
+
+COLUMNS = (
+    "seq, recipient_key, received_at, tag, size, enc_payload, payload, target, "
+    "reply_to_verkey, reply_thread_id"
+)
+# Columns added since queues were first created
+ADDED_COLUMNS = (("reply_to_verkey", "TEXT"), ("reply_thread_id", "TEXT"))
+STATS_COLUMNS = (
+    "recipient_key, count, total_size, oldest, (SELECT MAX(received_at) "
+    "FROM queued_messages WHERE recipient_key = queue_stats.recipient_key)"
+)
+
+# Clauses listing keys from a position, in the order given by sort_position
+LIST_KEYS = {
+    "depth": ("count", "<", "count DESC, recipient_key DESC"),
+    "bytes": ("total_size", "<", "total_size DESC, recipient_key DESC"),
+    "age": ("oldest", ">", "oldest, recipient_key"),
+}
+
+# Keep well below SQLITE_MAX_VARIABLE_NUMBER
+MAX_PARAMS = 500
+
+T = TypeVar("T")
+
+
+def _log_failure(future: "Union[Future, asyncio.Future]"):
+    if not future.cancelled() and future.exception() is not None:
+        LOGGER.error(
+            "Failed to write to the pickup queue database",
+            exc_info=future.exception(),
+        )
+
+
+class SqlitePickupQueue(PickupQueue):
+    """Pickup queue stored in an SQLite database.
+
+    Methods under "Database thread" only run in the database thread, through
+    _call or _run; the others run on the event loop.
+    """
+
+    def __init__(
+        self,
+        path: str = ":memory:",
+        *,
+        batch_size: int = 512,
+        flush_interval: float = 0.01,
+        page_size: int = 100,
+        limits: Optional[LimitsConfig] = None,
+        compression: Optional[CompressionConfig] = None,
+    ):
+        """Open (creating if needed) the queue database at path."""
+        super().__init__(limits, compression)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.page_size = page_size
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="pickup-sqlite"
+        )
+        # Queued messages, until handed to the database thread
+        self._inserts: List[tuple] = []
+        self._insert_handle: Optional[asyncio.Handle] = None
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # Writes not committed yet, and the changes they made to the count,
+        # size and oldest receipt time of keys (and whether messages were
+        # removed), and to the totals, not applied to the stats tables yet
+        self._pending = 0
+        self._stats_changes: Dict[str, List[Any]] = {}
+        self._totals_change = [0, 0]
+        # Number of messages of each key, including those not inserted yet,
+        # updated from both threads
+        self._counts: Dict[str, int] = {}
+        self._counts_lock = threading.Lock()
+        self._sync_expiry: Optional[asyncio.Task] = None
+        self.conn: sqlite3.Connection = self._call(self._open)
+
+    # Database thread access
+
+    def _call(self, func: Callable[..., T], *args) -> T:
+        """Run func in the database thread, after the rows queued, and wait."""
+        self._submit_inserts()
+        result = self._executor.submit(func, *args).result()
+        if self._pending:
+            self._schedule_flush()
+        return result
+
+    async def _run(self, func: Callable[..., T], *args) -> T:
+        """Run func in the database thread, after the rows queued."""
+        self._submit_inserts()
+        result = await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
+        if self._pending:
+            self._schedule_flush()
+        return result
+
+    def _submit_inserts(self):
+        """Hand the messages queued to the database thread, without waiting.
+
+        The messages rejected and evicted by the caps as they are inserted are
+        counted once the insert is done, on the event loop.
+        """
+        if self._insert_handle is not None:
+            self._insert_handle.cancel()
+            self._insert_handle = None
+        if not self._inserts:
+            return
+        messages, self._inserts = self._inserts, []
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._count_inserted(
+                *self._executor.submit(self._insert, messages).result()
+            )
+        else:
+            loop.run_in_executor(
+                self._executor, self._insert, messages
+            ).add_done_callback(self._inserted)
+        self._schedule_flush()
+
+    def _inserted(self, future: asyncio.Future):
+        if future.cancelled() or future.exception() is not None:
+            _log_failure(future)
+        else:
+            self._count_inserted(*future.result())
+
+    def _count_inserted(self, rejected: Dict[str, int], evicted: Dict[str, int]):
+        for key, count in rejected.items():
+            LOGGER.debug("%d messages for %s rejected: queue caps reached", count, key)
+            self._count_dropped(key, rejected=count)
+        for key, count in evicted.items():
+            LOGGER.debug("Evicted %d messages queued for %s", count, key)
+            self._count_dropped(key, evicted=count)
+
+    def _recount(self, key: str, change: int):
+        """Change the number of messages of key, from either thread."""
+        with self._counts_lock:
+            count = self._counts.get(key, 0) + change
+            if count > 0:
+                self._counts[key] = count
+            else:
+                self._counts.pop(key, None)
+
+    def _schedule_flush(self):
+        """Commit pending writes after flush_interval, or now without a loop."""
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._executor.submit(self._commit).result()
+        else:
+            self._flush_handle = loop.call_later(self.flush_interval, self._flush_later)
+
+    def _flush_later(self):
+        self._flush_handle = None
+        self._submit_inserts()
+        self._executor.submit(self._commit).add_done_callback(_log_failure)
+
+    def flush(self):
+        """Commit pending writes."""
+        self._submit_inserts()
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self._executor.submit(self._commit).result()
+
+    async def close(self):
+        """Commit pending writes and close the database."""
+        await super().close()
+        if self._sync_expiry is not None:
+            self._sync_expiry.cancel()
+        self._submit_inserts()
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        await self._run(self._close)
+        self._executor.shutdown()
+
+    # ACA-Py DeliveryQueue interface
+
+    def _add(self, msg: OutboundMessage, timestamp: float):
+        """Queue a message once per recipient key, inserted in the background."""
+        keys = recipient_keys_of(msg)
+        self._inserts.append(
+            (
+                keys,
+                timestamp,
+                payload_tag(msg.enc_payload),
+                message_size(msg),
+                msg.enc_payload,
+                msg.payload,
+                target_to_json(msg),
+                msg.reply_to_verkey,
+                msg.reply_thread_id,
+            )
+        )
+        for key in keys:
+            self._recount(key, 1)
+        if len(self._inserts) >= self.batch_size:
+            self._submit_inserts()
+        elif self._insert_handle is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self._submit_inserts()
+            else:
+                self._insert_handle = loop.call_soon(self._submit_inserts)
+
+    def message_count_for_key(self, key: str) -> int:
+        """Count of queued messages by key, as kept in process."""
+        return self._counts.get(key, 0)
+
+    def expire_messages(self, ttl=None):
+        """Expire messages that are past the time limit, through an index.
+
+        Messages are removed in the background, through the running event
+        loop; without one, they are removed at once.
+        """
+        before = time.time() - (ttl or self.ttl_seconds)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            for key, expired in self._call(self._expire, before).items():
+                self._count_dropped(key, expired=expired)
+            return
+        if self._sync_expiry is None or self._sync_expiry.done():
+            self._sync_expiry = loop.create_task(self._background_expire(before))
+
+    async def _background_expire(self, before: float):
+        try:
+            await self._expire_before(before)
+        except Exception:
+            LOGGER.exception("Failed to expire queued messages")
+
+    def get_one_message_for_key(self, key: str) -> Optional[OutboundMessage]:
+        """Return None; queued messages are only delivered by pickup."""
+        return None
+
+    def inspect_all_messages_for_key(self, key: str) -> Iterator[OutboundMessage]:
+        """Yield nothing; queued messages are only delivered by pickup."""
+        return iter(())
+
+    def remove_message_for_key(self, key: str, msg: OutboundMessage):
+        """Do nothing; no messages are handed out through this interface."""
+
+    # Pickup interface
+
+    async def count_for_key(self, key: str) -> int:
+        """Return the number of messages queued for key."""
+        return (await self._run(self._key_totals, key))[0]
+
+    async def _fits(self, key: str, size: int) -> bool:
+        return await self._run(self._admits, {key}, size)
+
+    async def stats_for_key(self, key: str) -> QueueStats:
+        """Return aggregates of the messages queued for key."""
+        return await self._run(self._stats_for_key, key)
+
+    async def stats_by_key(self) -> AsyncIterator[Tuple[str, QueueStats]]:
+        """Yield each key with queued messages and its aggregates."""
+        for key, stats in await self._run(self._stats_by_key):
+            yield key, stats
+
+    async def list_keys(
+        self, order: str = "depth", limit: int = 100, after: Optional[Position] = None
+    ) -> List[Tuple[str, QueueStats]]:
+        """Return a page of keys with queued messages, through an index."""
+        if order not in LIST_KEYS:
+            raise ValueError(f"Unknown order: {order}")
+        return await self._run(self._list_keys, order, limit, after)
+
+    async def messages_for_key(
+        self, key: str, limit: Optional[int] = None, *, after: int = 0
+    ) -> AsyncIterator[PickupQueuedMessage]:
+        """Lazily yield messages for key, oldest first, a page at a time."""
+        remaining = limit
+        last = (float("-inf"), after)
+        while remaining is None or remaining > 0:
+            page_size = (
+                self.page_size if remaining is None else min(remaining, self.page_size)
+            )
+            page = await self._run(
+                self._select,
+                "recipient_key = ? AND (received_at, seq) > (?, ?) AND seq > ? "
+                "ORDER BY received_at, seq LIMIT ?",
+                (key, *last, after, page_size),
+            )
+            for queued in page:
+                yield queued
+            if remaining is not None:
+                remaining -= len(page)
+            if len(page) < page_size:
+                return
+            last = (page[-1].timestamp, page[-1].seq)
+
+    async def remove_by_tags(self, key: str, tags: Iterable[str]) -> int:
+        """Remove messages for key by tag, returning the number removed."""
+        return await self._run(self._delete_in, key, "tag", list(tags))
+
+    async def remove_for_key(self, key: str, before: Optional[float] = None) -> int:
+        """Remove the messages for key, returning the number removed."""
+        if before is None:
+            removed = await self._run(self._delete, "recipient_key = ?", (key,))
+        else:
+            removed = await self._run(
+                self._delete, "recipient_key = ? AND received_at < ?", (key, before)
+            )
+        return len(removed)
+
+    async def remove_through(
+        self, key: str, seq: int, *, keep: Collection[int] = ()
+    ) -> int:
+        """Remove the messages for key up to sequence number seq, through an index.
+
+        Messages of keep are left in place: the messages between them are
+        removed a range at a time.
+        """
+        kept = sorted(kept for kept in keep if kept <= seq)
+        return await self._run(
+            self._delete_between, key, list(zip([0, *kept], [*kept, seq + 1]))
+        )
+
+    async def remove_seqs(self, key: str, seqs: Iterable[int]) -> int:
+        """Remove messages for key by sequence number, returning the number removed."""
+        return await self._run(self._delete_in, key, "seq", list(seqs))
+
+    async def store_enc_payload(
+        self, queued: PickupQueuedMessage, enc_payload: Union[str, bytes]
+    ):
+        """Record the encrypted payload of a queued message, unless one was."""
+        enc_payload, stored = await self._run(
+            self._store_enc_payload, queued.seq, enc_payload
+        )
+        queued._set_enc_payload(enc_payload)
+        queued._store(stored, self.compressor)
+
+    # Database thread
+
+    def _open(self) -> sqlite3.Connection:
+        # Only used from the database thread, which may not be the one closing
+        # it when the queue is dropped
+        self.conn = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self._add_columns()
+        self._create_stats()
+        self._counts.update(
+            self.conn.execute(
+                "SELECT recipient_key, count FROM queue_stats WHERE count > 0"
+            )
+        )
+        return self.conn
+
+    def _add_columns(self):
+        """Add the columns missing from queues created with earlier versions."""
+        present = {
+            row[0]
+            for row in self.conn.execute(
+                "SELECT name FROM pragma_table_info('queued_messages')"
+            )
+        }
+        for name, kind in ADDED_COLUMNS:
+            if name not in present:
+                self.conn.execute(
+                    f"ALTER TABLE queued_messages ADD COLUMN {name} {kind}"
+                )
+
+    def _create_stats(self):
+        """Create the stats tables, computing them for queues created without.
+
+        Queues created with an earlier version of the tables get them
+        recreated, and the triggers that kept them dropped.
+        """
+        current = self.conn.execute(
+            "SELECT 1 FROM pragma_table_info('queue_stats') WHERE name = 'oldest' "
+            "AND EXISTS (SELECT 1 FROM pragma_table_info('queue_totals'))"
+        ).fetchone()
+        populate = (
+            ""
+            if current
+            else "DROP TABLE IF EXISTS queue_stats; "
+            "DROP TABLE IF EXISTS queue_totals; "
+            f"{STATS_SCHEMA} "
+            "INSERT INTO queue_stats SELECT recipient_key, COUNT(*), "
+            "coalesce(SUM(size), 0), MIN(received_at) FROM queued_messages "
+            "GROUP BY recipient_key; "
+            "INSERT INTO queue_totals SELECT COUNT(*), coalesce(SUM(size), 0) "
+            "FROM queued_messages;"
+        )
+        self.conn.executescript(
+            f"BEGIN; {DROP_TRIGGERS} {populate or STATS_SCHEMA} COMMIT;"
+        )
+
+    def _close(self):
+        self._commit()
+        self.conn.close()
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        """Apply a write in the open transaction."""
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+        return self.conn.execute(sql, params)
+
+    def _wrote(self, count: int = 1):
+        """Count writes applied, committing once batch_size are pending."""
+        self._pending += count
+        if self._pending >= self.batch_size:
+            self._commit()
+
+    def _commit(self):
+        """Apply the changes to the stats and commit pending writes."""
+        self._apply_stats()
+        if self.conn.in_transaction:
+            self.conn.execute("COMMIT")
+        self._pending = 0
+
+    def _change_stats(
+        self,
+        key: str,
+        count: int,
+        size: int,
+        oldest: Optional[float] = None,
+        removed: bool = False,
+    ):
+        """Record a change to the aggregates of key, applied on commit."""
+        change = self._stats_changes.get(key)
+        if change is None:
+            change = self._stats_changes[key] = [0, 0, None, False]
+        change[0] += count
+        change[1] += size
+        if oldest is not None and (change[2] is None or oldest < change[2]):
+            change[2] = oldest
+        change[3] = change[3] or removed
+        self._totals_change[0] += count
+        self._totals_change[1] += size
+
+    def _apply_stats(self):
+        """Apply the changes to the aggregates of keys, in the open transaction."""
+        if not self._stats_changes:
+            return
+        changes, self._stats_changes = self._stats_changes, {}
+        (count, size), self._totals_change = self._totals_change, [0, 0]
+        self.conn.executemany(
+            UPDATE_STATS,
+            [(key, change[0], change[1], change[2]) for key, change in changes.items()],
+        )
+        # The oldest message of keys with messages removed is looked up again
+        removed = [(key,) for key, change in changes.items() if change[3]]
+        if removed:
+            self.conn.executemany(
+                "UPDATE queue_stats SET oldest = (SELECT MIN(received_at) "
+                "FROM queued_messages WHERE recipient_key = queue_stats.recipient_key) "
+                "WHERE recipient_key = ?",
+                removed,
+            )
+            self.conn.executemany(
+                "DELETE FROM queue_stats WHERE recipient_key = ? AND count <= 0",
+                removed,
+            )
+        self.conn.execute(
+            "UPDATE queue_totals SET count = count + ?, total_size = total_size + ?",
+            (count, size),
+        )
+
+    def _insert(self, messages: List[tuple]) -> Tuple[Dict[str, int], Dict[str, int]]:
+        """Insert queued messages once per key, within the caps.
+
+        Payloads are compressed once per message. Return the number of
+        messages rejected and evicted by the caps, by key.
+        """
+        compress = self.compressor.compress
+        reject = self._capped and self.limits.policy == "reject-new"
+        rows = []
+        rejected: Dict[str, int] = {}
+        for keys, received_at, tag, size, enc_payload, *fields in messages:
+            if reject and not self._admits(keys, size):
+                for key in keys:
+                    rejected[key] = rejected.get(key, 0) + 1
+                    self._recount(key, -1)
+                continue
+            stored = compress(enc_payload) if enc_payload else None
+            for key in keys:
+                rows.append((key, received_at, tag, size, stored, *fields))
+                # Applied now, so that the next message is checked against it
+                self._change_stats(key, 1, size or 0, received_at)
+        if rows:
+            if not self.conn.in_transaction:
+                self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT INTO queued_messages (recipient_key, received_at, tag, size, "
+                "enc_payload, payload, target, reply_to_verkey, reply_thread_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._wrote(len(rows))
+        evicted: Dict[str, int] = {}
+        if self._capped and self.limits.policy == "drop-oldest":
+            evicted = self._evict({row[0] for row in rows})
+        return rejected, evicted
+
+    def _delete(self, where: str, params: tuple) -> List[Tuple[str, int]]:
+        """Delete the messages matching where, returning their keys and sizes."""
+        removed = self._execute(
+            f"DELETE FROM queued_messages WHERE {where} "
+            "RETURNING recipient_key, coalesce(size, 0)",
+            params,
+        ).fetchall()
+        for key, size in removed:
+            self._change_stats(key, -1, -size, removed=True)
+            self._recount(key, -1)
+        self._wrote()
+        return removed
+
+    def _delete_between(self, key: str, bounds: List[Tuple[int, int]]) -> int:
+        """Delete the messages of key with a sequence number between bounds."""
+        return sum(
+            len(self._delete("recipient_key = ? AND seq > ? AND seq < ?", (key, *pair)))
+            for pair in bounds
+            if pair[1] - pair[0] > 1
+        )
+
+    def _delete_in(self, key: str, column: str, values: List[Any]) -> int:
+        """Delete the messages of key with column in values, a chunk at a time."""
+        removed = 0
+        for start in range(0, len(values), MAX_PARAMS):
+            chunk = values[start : start + MAX_PARAMS]  # noqa: E203
+            removed += len(
+                self._delete(
+                    f"recipient_key = ? AND {column} IN "
+                    f"({', '.join('?' * len(chunk))})",
+                    (key, *chunk),
+                )
+            )
+        return removed
+
+    def _from_row(self, row: Tuple) -> PickupQueuedMessage:
+        (
+            seq,
+            key,
+            received_at,
+            tag,
+            size,
+            enc_payload,
+            payload,
+            target,
+            reply_to_verkey,
+            reply_thread_id,
+        ) = row
+        msg = OutboundMessage(
+            payload=payload,
+            enc_payload=enc_payload,
+            reply_to_verkey=reply_to_verkey,
+            reply_thread_id=reply_thread_id,
+            target_list=target_list_from_json(target),
+        )
+        queued = PickupQueuedMessage(msg, seq, received_at, tag=tag, size=size)
+        queued.recipient_keys = (key,)
+        if queued.enc_payload:
+            queued._store(queued.enc_payload, self.compressor)
+        return queued
+
+    def _select(self, where: str, params: tuple) -> List[PickupQueuedMessage]:
+        return [
+            self._from_row(row)
+            for row in self.conn.execute(
+                f"SELECT {COLUMNS} FROM queued_messages WHERE {where}", params
+            )
+        ]
+
+    def _key_totals(self, key: str) -> Tuple[int, int]:
+        """Return the number and size of the messages of key."""
+        row = self.conn.execute(
+            "SELECT count, total_size FROM queue_stats WHERE recipient_key = ?", (key,)
+        ).fetchone()
+        count, total_size = row or (0, 0)
+        change = self._stats_changes.get(key)
+        if change is not None:
+            count += change[0]
+            total_size += change[1]
+        return count, total_size
+
+    def _totals(self) -> Tuple[int, int]:
+        """Return the number and size of all messages."""
+        count, total_size = self.conn.execute(
+            "SELECT count, total_size FROM queue_totals"
+        ).fetchone()
+        return count + self._totals_change[0], total_size + self._totals_change[1]
+
+    def _admits(self, keys: Set[str], size: int) -> bool:
+        """Return whether a message of size can be queued for keys within caps."""
+        count, total_size = self._totals()
+        if self._over_total_limits(count + len(keys), total_size + size * len(keys)):
+            return False
+        for key in keys:
+            count, total_size = self._key_totals(key)
+            if self._over_key_limits(count + 1, total_size + size):
+                return False
+        return True
+
+    def _evict(self, keys: Set[str]) -> Dict[str, int]:
+        """Evict the oldest messages of keys, then of any key, to meet the caps.
+
+        Return the number of messages evicted by key.
+        """
+        evicted: Dict[str, int] = {}
+        for key in keys:
+            count, total_size = self._key_totals(key)
+            if self._over_key_limits(count, total_size):
+                self._evict_first(
+                    "WHERE recipient_key = ?",
+                    (key,),
+                    count,
+                    total_size,
+                    self._over_key_limits,
+                    evicted,
+                )
+        count, total_size = self._totals()
+        if self._over_total_limits(count, total_size):
+            self._evict_first(
+                "", (), count, total_size, self._over_total_limits, evicted
+            )
+        return evicted
+
+    def _evict_first(
+        self,
+        where: str,
+        params: tuple,
+        count: int,
+        total_size: int,
+        over: Callable[[int, int], bool],
+        evicted: Dict[str, int],
+    ):
+        """Remove the oldest messages matching where until no longer over caps."""
+        seqs = []
+        rows = self.conn.execute(
+            "SELECT seq, recipient_key, coalesce(size, 0) FROM queued_messages "
+            f"{where} ORDER BY received_at, seq",
+            params,
+        )
+        for seq, key, size in rows:
+            if not over(count, total_size):
+                break
+            seqs.append(seq)
+            evicted[key] = evicted.get(key, 0) + 1
+            count -= 1
+            total_size -= size
+        rows.close()
+        for start in range(0, len(seqs), MAX_PARAMS):
+            chunk = seqs[start : start + MAX_PARAMS]  # noqa: E203
+            self._delete(f"seq IN ({', '.join('?' * len(chunk))})", tuple(chunk))
+
+    def _expire(self, horizon: float) -> Dict[str, int]:
+        """Remove the messages received before horizon, counting them by key."""
+        expired: Dict[str, int] = {}
+        for key, _ in self._delete("received_at < ?", (horizon,)):
+            expired[key] = expired.get(key, 0) + 1
+        return expired
+
+    def _stats_for_key(self, key: str) -> QueueStats:
+        self._apply_stats()
+        row = self.conn.execute(
+            f"SELECT {STATS_COLUMNS} FROM queue_stats WHERE recipient_key = ?", (key,)
+        ).fetchone()
+        return QueueStats(*row[1:]) if row else QueueStats()
+
+    def _stats_by_key(self) -> List[Tuple[str, QueueStats]]:
+        self._apply_stats()
+        rows = self.conn.execute(f"SELECT {STATS_COLUMNS} FROM queue_stats")
+        return [(key, QueueStats(*stats)) for key, *stats in rows]
+
+    def _list_keys(
+        self, order: str, limit: int, after: Optional[Position]
+    ) -> List[Tuple[str, QueueStats]]:
+        self._apply_stats()
+        column, comparison, order_by = LIST_KEYS[order]
+        where, params = "", (limit,)
+        if after is not None:
+            where = f"WHERE ({column}, recipient_key) {comparison} (?, ?)"
+            params = (*after, limit)
+        rows = self.conn.execute(
+            f"SELECT {STATS_COLUMNS} FROM queue_stats {where} "
+            f"ORDER BY {order_by} LIMIT ?",
+            params,
+        )
+        return [(key, QueueStats(*stats)) for key, *stats in rows]
+
+    def _store_enc_payload(
+        self, seq: int, enc_payload: Union[str, bytes]
+    ) -> Tuple[Union[str, bytes], bytes]:
+        """Store the payload of a plaintext message, unless one was.
+
+        Return the payload of the message and the payload as stored.
+        """
+        row = self.conn.execute(
+            "SELECT recipient_key, coalesce(size, 0) FROM queued_messages "
+            "WHERE seq = ? AND enc_payload IS NULL",
+            (seq,),
+        ).fetchone()
+        if row is not None:
+            key, previous_size = row
+            stored = self.compressor.compress(enc_payload)
+            self._execute(
+                "UPDATE queued_messages SET enc_payload = ?, tag = ?, size = ? "
+                "WHERE seq = ?",
+                (stored, payload_tag(enc_payload), len(enc_payload), seq),
+            )
+            self._change_stats(key, 0, len(enc_payload) - previous_size)
+            self._wrote()
+            return enc_payload, stored
+        row = self.conn.execute(
+            "SELECT enc_payload FROM queued_messages WHERE seq = ?", (seq,)
+        ).fetchone()
+        if row and row[0]:
+            return self.compressor.decompress(row[0]), row[0]
+        return enc_payload, self.compressor.compress(enc_payload)
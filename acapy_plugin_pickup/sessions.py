@@ -0,0 +1,150 @@
+"""Reverse index of inbound sessions by reply verkey.
+
+InboundTransportManager only keeps sessions by session id, so finding the
+session for a verkey means scanning every open session. The index defined
+here is kept up to date as sessions are opened and closed and as their reply
+verkeys change, making the lookup constant time.
+"""
+
+from collections import OrderedDict
+import logging
+from typing import Dict, Iterable, Optional
+
+from aries_cloudagent.transport.inbound.manager import InboundTransportManager
+from aries_cloudagent.transport.inbound.session import InboundSession
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+class _ObservedVerkeys(set):
+    """Set of reply verkeys reporting changes to the session index."""
+
+    def __init__(self, index: "SessionIndex", session: InboundSession, verkeys=()):
+        super().__init__(verkeys)
+        self._index = index
+        self._session = session
+
+    def add(self, verkey: str):
+        if verkey not in self:
+            super().add(verkey)
+            self._index._link(verkey, self._session)
+
+    def update(self, *others: Iterable[str]):
+        for other in others:
+            for verkey in other:
+                self.add(verkey)
+
+    def discard(self, verkey: str):
+        if verkey in self:
+            super().discard(verkey)
+            self._index._unlink(verkey, self._session)
+
+    def remove(self, verkey: str):
+        if verkey not in self:
+            raise KeyError(verkey)
+        self.discard(verkey)
+
+    def clear(self):
+        for verkey in list(self):
+            self.discard(verkey)
+
+
+class SessionIndex:
+    """Map reply verkeys to the open sessions that can reply to them."""
+
+    def __init__(self):
+        """Initialize the index."""
+        self.sessions_by_verkey: Dict[str, "OrderedDict[str, InboundSession]"] = {}
+
+    def _link(self, verkey: str, session: InboundSession):
+        self.sessions_by_verkey.setdefault(verkey, OrderedDict())[
+            session.session_id
+        ] = session
+
+    def _unlink(self, verkey: str, session: InboundSession):
+        sessions = self.sessions_by_verkey.get(verkey)
+        if sessions is not None:
+            sessions.pop(session.session_id, None)
+            if not sessions:
+                del self.sessions_by_verkey[verkey]
+
+    def track(self, session: InboundSession):
+        """Start tracking the reply verkeys of a session."""
+        verkeys = session._reply_verkeys or ()
+        if not isinstance(verkeys, _ObservedVerkeys):
+            session._reply_verkeys = _ObservedVerkeys(self, session, verkeys)
+        for verkey in verkeys:
+            self._link(verkey, session)
+
+    def untrack(self, session: InboundSession):
+        """Stop tracking a session."""
+        for verkey in session._reply_verkeys or ():
+            self._unlink(verkey, session)
+
+    def session_for_verkey(
+        self, verkey: str, sessions: Optional[Iterable[InboundSession]] = None
+    ) -> Optional[InboundSession]:
+        """Return an open session that can reply to verkey.
+
+        Indexed sessions are verified before they are returned and stale entries
+        are dropped. If sessions are given and the index has no valid session
+        (e.g. the reply verkeys of a session were replaced wholesale, bypassing
+        the index), fall back to scanning them and repair the index.
+        """
+        indexed = self.sessions_by_verkey.get(verkey)
+        if indexed:
+            for session in list(indexed.values()):
+                if not session.closed and verkey in session._reply_verkeys:
+                    return session
+                self._unlink(verkey, session)
+
+        if sessions is None:
+            return None
+
+        LOGGER.debug("Session index miss for verkey %s, scanning sessions", verkey)
+        found = None
+        for session in sessions:
+            if verkey in session.reply_verkeys:
+                self.track(session)
+                found = found or session
+        return found
+
+
+class IndexedSessions(OrderedDict):
+    """Session mapping for InboundTransportManager maintaining a SessionIndex."""
+
+    def __init__(self, *args, **kwargs):
+        """Initialize the mapping."""
+        self.index = SessionIndex()
+        super().__init__(*args, **kwargs)
+
+    def __setitem__(self, session_id: str, session: InboundSession):
+        """Add a session."""
+        previous = self.get(session_id)
+        if previous is not None and previous is not session:
+            self.index.untrack(previous)
+        super().__setitem__(session_id, session)
+        self.index.track(session)
+
+    def __delitem__(self, session_id: str):
+        """Remove a session."""
+        session = self[session_id]
+        super().__delitem__(session_id)
+        self.index.untrack(session)
+
+
+def get_session_index(manager: InboundTransportManager) -> SessionIndex:
+    """Return the session index of the manager, installing it if needed."""
+    if not isinstance(manager.sessions, IndexedSessions):
+        LOGGER.debug("Installing session index on inbound transport manager")
+        manager.sessions = IndexedSessions(manager.sessions)
+    return manager.sessions.index
+
+
+def session_for_verkey(
+    manager: InboundTransportManager, verkey: str
+) -> Optional[InboundSession]:
+    """Return an open session of the manager that can reply to verkey."""
+    index = get_session_index(manager)
+    return index.session_for_verkey(verkey, manager.sessions.values())
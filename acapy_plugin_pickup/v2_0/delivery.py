@@ -2,21 +2,30 @@
 
 import json
 import logging
-from typing import List, Optional, Sequence, Set, cast
+import time
+from typing import AsyncIterator, Collection, Optional, Sequence, Set, Tuple
+from uuid import uuid4
 
+from aries_cloudagent.core.profile import ProfileSession
 from aries_cloudagent.messaging.request_context import RequestContext
 from aries_cloudagent.messaging.responder import BaseResponder
-from aries_cloudagent.transport.inbound.delivery_queue import DeliveryQueue
 from aries_cloudagent.transport.inbound.manager import InboundTransportManager
-from aries_cloudagent.transport.inbound.session import InboundSession
 from aries_cloudagent.transport.outbound.message import OutboundMessage
 from aries_cloudagent.transport.wire_format import BaseWireFormat
 from pydantic import Field
 from typing_extensions import Annotated
 
 from ..acapy import AgentMessage, Attach
+from ..acapy.message import serialize_model
 from ..acapy.error import HandlerException
-from .status import Status
+from ..config import PickupConfig
+from ..encoder import PayloadEncoder, encode_queued
+from ..keys import requested_key
+from ..live import LiveSessions
+from ..metrics import PickupMetrics, observed
+from ..queue import PickupQueue, PickupQueuedMessage, get_pickup_queue
+from ..sessions import session_for_verkey
+from .status import queue_status, reject_recipient_key
 
 LOGGER = logging.getLogger(__name__)
 PROTOCOL = "https://didcomm.org/messagepickup/2.0"
@@ -29,16 +38,17 @@ class DeliveryRequest(AgentMessage):
 
     limit: int
     recipient_key: Optional[str] = None
+    # Seconds to wait for messages to arrive if none are queued
+    wait_timeout: Optional[float] = None
+    # Size the delivery may take in bytes, though at least one message is sent
+    max_bytes: Optional[int] = None
 
     @staticmethod
     def determine_session(manager: InboundTransportManager, key: str):
         """Determine the session associated with the given key."""
-        for session in manager.sessions.values():
-            session = cast(InboundSession, session)
-            if key in session.reply_verkeys:
-                return session
-        return None
+        return session_for_verkey(manager, key)
 
+    @observed("delivery")
     async def handle(self, context: RequestContext, responder: BaseResponder):
         """Handle DeliveryRequest message."""
         if not self.transport or self.transport.return_route != "all":
@@ -50,54 +60,87 @@ class DeliveryRequest(AgentMessage):
         wire_format = context.inject(BaseWireFormat)
         manager = context.inject(InboundTransportManager)
         assert manager
-        queue = manager.undelivered_queue
-        key = context.message_receipt.sender_verkey
-        message_attachments = []
+        key = await requested_key(context, self.recipient_key)
+        if key is None:
+            await reject_recipient_key(self, responder)
+            return
+        queue = get_pickup_queue(manager)
+        # Bound at startup; parsed here only for a queue set up otherwise
+        config = context.inject_or(PickupConfig) or PickupConfig.from_settings(
+            context.settings
+        )
+        sender = context.message_receipt.sender_verkey
+        delivered = []
+
+        duration_waited = None
+        if self.wait_timeout:
+            started = time.monotonic()
+            await queue.wait_for_messages(
+                key,
+                min(self.wait_timeout, config.max_wait),
+                skip_leased=bool(config.lease_timeout),
+            )
+            duration_waited = round(time.monotonic() - started)
 
-        if queue.has_message_for_key(key):
-            session = self.determine_session(manager, key)
+        if await queue.count_for_key(key):
+            session = self.determine_session(manager, sender)
             if session is None:
                 LOGGER.warning("No session available to deliver messages as requested")
                 return
 
-            returned_count = 0
+            leased = await queue.leased(key) if config.lease_timeout else ()
             async with context.session() as profile_session:
-                for msg in get_messages_for_key(queue, key):
-                    recipient_key = (
-                        msg.target_list[0].recipient_keys
-                        or context.message_receipt.recipient_verkey
-                    )
-                    routing_keys = msg.target_list[0].routing_keys or []
-                    sender_key = msg.target_list[0].sender_key or key
-
-                    # This scenario is rare; a message will almost always have an
-                    # encrypted payload. The only time it won't is if we're sending a
-                    # message from the mediator itself, rather than forwarding a message
-                    # from another agent.
-                    # TODO: update ACA-Py to store all messages with an
-                    # encrypted payload
-                    if not msg.enc_payload:
-                        msg.enc_payload = await wire_format.encode_message(
-                            profile_session,
-                            msg.payload,
-                            recipient_key,
-                            routing_keys,
-                            sender_key,
-                        )
-
-                    attached_msg = Attach.data_base64(
-                        ident=json.loads(msg.enc_payload)["tag"], value=msg.enc_payload
+                delivered = [
+                    queued_attachment
+                    async for queued_attachment in delivery_attachments(
+                        queue,
+                        key,
+                        profile_session,
+                        wire_format,
+                        limit=self.limit,
+                        max_bytes=min_bytes(self.max_bytes, config.max_delivery_bytes),
+                        leased=leased,
+                        default_recipient_key=context.message_receipt.recipient_verkey,
+                        encoder=context.inject_or(PayloadEncoder),
                     )
-                    message_attachments.append(attached_msg)
-                    returned_count += 1
-
-                    if returned_count >= self.limit:
-                        break
-
-            response = Delivery(message_attachments=message_attachments)
-        else:
-            response = Status(recipient_key=self.recipient_key, message_count=0)
+                ]
+
+        if delivered and config.lease_timeout:
+            # Another delivery may have leased some of them meanwhile
+            taken = set(
+                await queue.lease(
+                    key,
+                    [queued.seq for queued, _ in delivered],
+                    config.lease_timeout,
+                    owner=sender,
+                )
+            )
+            delivered = [pair for pair in delivered if pair[0].seq in taken]
 
+        if delivered:
+            delivery = Delivery.of_attachments(
+                [attachment for _, attachment in delivered]
+            )
+            delivery.recipient_key = self.recipient_key
+            delivery.last_sequence = delivered[-1][0].seq
+            delivery.assign_thread_from(self)
+            await queue.record_delivery(
+                key, delivery.id, [queued.seq for queued, _ in delivered]
+            )
+            await delivery.send_reply(responder)
+            metrics = context.inject_or(PickupMetrics)
+            if metrics:
+                metrics.delivered(queued for queued, _ in delivered)
+            return
+
+        live = context.inject_or(LiveSessions)
+        response = await queue_status(
+            queue,
+            key,
+            recipient_key=self.recipient_key,
+            duration_waited=duration_waited,
+            live_mode=bool(live and live.is_live(sender)),
+        )
         response.assign_thread_from(self)
         await responder.send_reply(response)
 
@@ -111,17 +154,80 @@ class Delivery(AgentMessage):
     message_type = f"{PROTOCOL}/delivery"
 
     recipient_key: Optional[str] = None
+    # Extension: the sequence number of the last message attached, which
+    # increases monotonically with the messages queued for the recipient key
+    last_sequence: Optional[int] = None
     message_attachments: Annotated[
         Sequence[Attach], Field(description="Attached messages", alias="~attach")
     ]
 
+    @classmethod
+    def of_attachments(cls, message_attachments: Sequence[Attach]) -> "Delivery":
+        """Create a delivery of attachments made by the mediator, skipping validation.
+
+        Deliveries can carry many large attachments, all of which were built
+        from queued messages and need not be validated again.
+        """
+        return cls.construct(
+            type=cls.message_type, message_attachments=message_attachments
+        )
+
+    def to_json(self) -> str:
+        """Dump to json, joining attachments made by the mediator in directly.
+
+        The JSON is the same as serializing the attachments would give, as
+        done for other attachments: the other fields are serialized by the
+        same means and the attachments come last, as their field does.
+        """
+        chunks = [attach.json_chunks() for attach in self.message_attachments]
+        if not chunks or None in chunks:
+            return super().to_json()
+        header = json.dumps(
+            serialize_model(self, exclude=("message_attachments",)),
+            default=self.__json_encoder__,
+        )
+        alias = self.__fields__["message_attachments"].alias
+        parts = [header[:-1], f", {json.dumps(alias)}: ["]
+        for attachment in chunks:
+            parts.extend(attachment)
+            parts.append(", ")
+        parts[-1] = "]}"
+        return "".join(parts)
+
+    async def send_reply(self, responder: BaseResponder):
+        """Send as a reply, serialized by to_json rather than by the responder.
+
+        The outbound message is made by the responder as for any reply, from
+        the JSON of to_json. The responder takes a string to be packed
+        already, so the JSON is moved to the payload, to be packed for the
+        recipient as the payload of any other reply is.
+        """
+        outbound = await responder.create_outbound(
+            self.to_json(),
+            connection_id=responder.connection_id,
+            reply_session_id=responder.reply_session_id,
+            reply_thread_id=self._thread_id,
+            reply_to_verkey=responder.reply_to_verkey,
+        )
+        outbound.payload, outbound.enc_payload = outbound.enc_payload, None
+        await responder.send_outbound(
+            outbound, message_type=self._message_type, message_id=self._id
+        )
+
 
 class MessagesReceived(AgentMessage):
     """MessageReceived acknowledgement message."""
 
     message_type = f"{PROTOCOL}/messages-received"
-    message_id_list: Set[str]
+    message_id_list: Set[str] = set()
+    # Extension: the recipient key the messages were delivered for
+    recipient_key: Optional[str] = None
+    # Extension: acknowledge every message up to this sequence number
+    up_to_sequence: Optional[int] = None
+    # Extension: acknowledge every message of the delivery with this id
+    delivery_id: Optional[str] = None
 
+    @observed("ack")
     async def handle(self, context: RequestContext, responder: BaseResponder):
         """Handle MessageReceived message."""
         if not self.transport or self.transport.return_route != "all":
@@ -130,55 +236,189 @@ class MessagesReceived(AgentMessage):
                 "route set to all"
             )
 
+        key = await requested_key(context, self.recipient_key)
+        if key is None:
+            await reject_recipient_key(self, responder)
+            return
         manager = context.inject(InboundTransportManager)
         assert manager
-        queue = manager.undelivered_queue
-        key = context.message_receipt.sender_verkey
+        queue = get_pickup_queue(manager)
+        sender = context.message_receipt.sender_verkey
 
-        if queue.has_message_for_key(key):
-            remove_message_by_tag_list(queue, key, self.message_id_list)
-
-        response = Status(message_count=queue.message_count_for_key(key))
+        removed = await remove_message_by_tag_list(queue, key, self.message_id_list)
+        if self.up_to_sequence is not None:
+            config = context.inject_or(PickupConfig) or PickupConfig.from_settings(
+                context.settings
+            )
+            # Messages leased to another sender were not delivered to this one
+            keep = (
+                await queue.leased_to_others(key, sender)
+                if config.lease_timeout
+                else ()
+            )
+            removed += await queue.remove_through(key, self.up_to_sequence, keep=keep)
+        if self.delivery_id is not None:
+            removed += await queue.remove_seqs(
+                key, await queue.take_delivery(key, self.delivery_id)
+            )
+        metrics = context.inject_or(PickupMetrics)
+        if metrics:
+            metrics.acked(removed)
+
+        live = context.inject_or(LiveSessions)
+        response = await queue_status(
+            queue,
+            key,
+            recipient_key=self.recipient_key,
+            live_mode=bool(live and live.is_live(sender)),
+        )
         response.assign_thread_from(self)
         await responder.send_reply(response)
 
 
-def remove_message_by_tag(queue: DeliveryQueue, recipient_key: str, tag: str):
+async def encrypt_queued(
+    queue: PickupQueue,
+    key: str,
+    queued: PickupQueuedMessage,
+    profile_session: ProfileSession,
+    wire_format: BaseWireFormat,
+    default_recipient_key: Optional[str] = None,
+    encoder: Optional[PayloadEncoder] = None,
+):
+    """Encrypt a message queued for key, unless it is already."""
+    # Messages sent by the mediator itself, rather than forwarded from another
+    # agent, are queued without an encrypted payload. The encoder normally
+    # encrypts them in the background before they are requested.
+    if not queued.encrypted:
+        if encoder:
+            await encoder.encode(key, queued, default_recipient_key)
+        else:
+            await encode_queued(
+                queue, key, queued, profile_session, wire_format, default_recipient_key
+            )
+
+
+async def queued_attachment(
+    queue: PickupQueue,
+    key: str,
+    queued: PickupQueuedMessage,
+    profile_session: ProfileSession,
+    wire_format: BaseWireFormat,
+    default_recipient_key: Optional[str] = None,
+    encoder: Optional[PayloadEncoder] = None,
+) -> Attach:
+    """Return a message queued for key as an attachment, encrypting it if needed."""
+    await encrypt_queued(
+        queue, key, queued, profile_session, wire_format, default_recipient_key, encoder
+    )
+    return Attach.trusted_base64(queued.b64_payload, ident=queued.tag or str(uuid4()))
+
+
+# Size of an attachment in a serialized delivery, less its id and data, and of
+# the rest of a delivery (with room for its id and thread)
+ATTACHMENT_OVERHEAD = len(
+    ', {"@id": "", "mime-type": "application/json", "data": {"base64": ""}}'
+)
+DELIVERY_OVERHEAD = 256
+
+
+def attachment_size(queued: PickupQueuedMessage) -> int:
+    """Return the size of an encrypted queued message attached to a delivery."""
+    return ATTACHMENT_OVERHEAD + len(queued.tag or "") + 4 * -(-queued.size // 3)
+
+
+def min_bytes(*budgets: Optional[int]) -> Optional[int]:
+    """Return the smallest of the byte budgets given, if any."""
+    return min((budget for budget in budgets if budget is not None), default=None)
+
+
+async def delivery_attachments(
+    queue: PickupQueue,
+    key: str,
+    profile_session: ProfileSession,
+    wire_format: BaseWireFormat,
+    *,
+    limit: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+    after: int = 0,
+    leased: Collection[int] = (),
+    default_recipient_key: Optional[str] = None,
+    encoder: Optional[PayloadEncoder] = None,
+) -> AsyncIterator[Tuple[PickupQueuedMessage, Attach]]:
+    """Yield messages queued for key with their attachments, oldest first.
+
+    Stop after limit messages or before the delivery would exceed max_bytes,
+    computed from the sizes of the queued messages before their attachments
+    are built; the first message is yielded regardless so that oversized
+    messages do not block the queue. Messages with a sequence number in leased
+    are skipped.
+    """
+    used = DELIVERY_OVERHEAD
+    first = True
+    remaining = limit
+    # At most len(leased) messages are skipped
+    async for queued in queue.messages_for_key(
+        key, limit=None if limit is None else limit + len(leased), after=after
+    ):
+        if queued.seq in leased:
+            continue
+        if remaining is not None:
+            if remaining <= 0:
+                return
+            remaining -= 1
+        if max_bytes is not None:
+            # The size of a plaintext message is known once it is encrypted,
+            # which is stored for later deliveries if it does not fit
+            await encrypt_queued(
+                queue,
+                key,
+                queued,
+                profile_session,
+                wire_format,
+                default_recipient_key,
+                encoder,
+            )
+            used += attachment_size(queued)
+            if used > max_bytes and not first:
+                return
+        first = False
+        yield queued, await queued_attachment(
+            queue,
+            key,
+            queued,
+            profile_session,
+            wire_format,
+            default_recipient_key,
+            encoder,
+        )
+
+
+async def remove_message_by_tag(queue: PickupQueue, recipient_key: str, tag: str):
     """Remove a message from a recipient's queue by tag.
 
     Tag corresponds to a value in the encrypted payload which is unique for
     each message.
     """
-    return remove_message_by_tag_list(queue, recipient_key, {tag})
+    return await remove_message_by_tag_list(queue, recipient_key, {tag})
 
 
-def remove_message_by_tag_list(
-    queue: DeliveryQueue, recipient_key: str, tag_list: Set[str]
+async def remove_message_by_tag_list(
+    queue: PickupQueue, recipient_key: str, tag_list: Set[str]
 ):
-    # For debugging, logs the contents of each message as it's retrieved from the queue
-    for i in queue.queue_by_key[recipient_key]:
-        LOGGER.debug("%s", i.msg)
-
-    if recipient_key not in queue.queue_by_key:
-        return
-    LOGGER.debug(
-        "Removing messages with tags from queue: %s", queue.queue_by_key[recipient_key]
-    )
-    queue.queue_by_key[recipient_key][:] = [
-        queued_message
-        for queued_message in queue.queue_by_key[recipient_key]
-        if queued_message.msg.enc_payload is None
-        or json.loads(queued_message.msg.enc_payload)["tag"] not in tag_list
-    ]
+    """Remove messages from a recipient's queue by tag."""
+    LOGGER.debug("Removing messages with tags from queue: %s", tag_list)
+    return await queue.remove_by_tags(recipient_key, tag_list)
 
 
-def get_messages_for_key(queue: DeliveryQueue, key: str) -> List[OutboundMessage]:
+async def get_messages_for_key(
+    queue: PickupQueue, key: str, limit: Optional[int] = None
+) -> AsyncIterator[OutboundMessage]:
     """
-    Return messages for a given key from the queue without removing them.
+    Lazily yield messages for a given key from the queue without removing them.
 
     Args:
         key: The key to use for lookup
+        limit: Optional maximum number of messages to yield
     """
-    if key in queue.queue_by_key:
-        return [queued.msg for queued in queue.queue_by_key[key]]
-    return []
+    async for queued in queue.messages_for_key(key, limit=limit):
+        yield queued.msg
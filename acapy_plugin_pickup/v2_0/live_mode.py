@@ -1,13 +1,89 @@
+"""Live Delivery Change message and live delivery for the Pickup Protocol."""
+
+import logging
+from typing import Optional
+
 from aries_cloudagent.messaging.request_context import RequestContext
 from aries_cloudagent.messaging.responder import BaseResponder
+from aries_cloudagent.protocols.problem_report.v1_0.message import ProblemReport
+from aries_cloudagent.transport.inbound.manager import InboundTransportManager
+from aries_cloudagent.transport.outbound.message import OutboundMessage
 
 from ..acapy import AgentMessage
+from ..acapy.error import HandlerException
+from ..encoder import PayloadEncoder
+from ..live import LiveSession, LiveSessions
+from ..metrics import PickupMetrics, observed
+from ..queue import PickupQueue, get_pickup_queue
+from ..sessions import session_for_verkey
+from .delivery import Delivery, delivery_attachments
+from .status import queue_status
 
+LOGGER = logging.getLogger(__name__)
 PROTOCOL = "https://didcomm.org/messagepickup/2.0"
 
 
-# This is the start of a message updating the Live Delivery status
-# Will require a deeper analysis of ACA-Py to fully implement
+class LiveDelivery(LiveSessions):
+    """Push newly queued messages to live recipients as Delivery messages."""
+
+    def __init__(
+        self,
+        queue: PickupQueue,
+        *,
+        batch_size: int = 100,
+        max_bytes: Optional[int] = None,
+        encoder: Optional[PayloadEncoder] = None,
+        metrics: Optional[PickupMetrics] = None,
+        **kwargs,
+    ):
+        """Initialize live delivery."""
+        super().__init__(queue, **kwargs)
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.encoder = encoder
+        self.metrics = metrics
+
+    async def push(self, key: str, live: LiveSession) -> bool:
+        """Push a batch of messages queued after live.last_seq as a Delivery."""
+        session = live.session
+        delivered = []
+        attachments = []
+        async with session.profile.session() as profile_session:
+            async for queued, attachment in delivery_attachments(
+                self.queue,
+                key,
+                profile_session,
+                session.wire_format,
+                limit=self.batch_size,
+                max_bytes=self.max_bytes,
+                after=live.last_seq,
+                default_recipient_key=live.reply_from_verkey,
+                encoder=self.encoder,
+            ):
+                delivered.append(queued)
+                attachments.append(attachment)
+        if not attachments:
+            return False
+
+        delivery = Delivery.of_attachments(attachments)
+        delivery.last_sequence = delivered[-1].seq
+        await self.queue.record_delivery(
+            key, delivery.id, [queued.seq for queued in delivered]
+        )
+        outbound = OutboundMessage(
+            payload=delivery.to_json(),
+            reply_to_verkey=key,
+            reply_from_verkey=live.reply_from_verkey,
+        )
+        if not await self.send(key, live, outbound):
+            return False
+        LOGGER.debug("Pushed %d messages to live recipient %s", len(attachments), key)
+        live.last_seq = delivered[-1].seq
+        if self.metrics:
+            self.metrics.delivered(delivered)
+        return True
+
+
 class LiveDeliveryChange(AgentMessage):
     """Live Delivery Change message."""
 
@@ -15,6 +91,44 @@ class LiveDeliveryChange(AgentMessage):
 
     live_delivery: bool = False
 
+    @observed("live_mode")
     async def handle(self, context: RequestContext, responder: BaseResponder):
-        """Handle LiveDeliveryChange message"""
-        return await super().handle(context, responder)
+        """Handle LiveDeliveryChange message."""
+        if not self.transport or self.transport.return_route != "all":
+            raise HandlerException(
+                "LiveDeliveryChange must have transport decorator with return "
+                "route set to all"
+            )
+
+        manager = context.inject(InboundTransportManager)
+        assert manager
+        queue = get_pickup_queue(manager)
+        live = context.inject_or(LiveSessions)
+        key = context.message_receipt.sender_verkey
+
+        session = None
+        if not self.live_delivery:
+            if live:
+                live.disable(key)
+        else:
+            # Only websocket sessions stay open to push messages over
+            session = session_for_verkey(manager, key)
+            if not live or not session or session.transport_type != "ws":
+                LOGGER.debug("Live mode requested by %s over a session without it", key)
+                report = ProblemReport(
+                    description={
+                        "en": "Connection does not support Live Delivery",
+                        "code": "e.m.live-mode-not-supported",
+                    }
+                )
+                report.assign_thread_id(self._thread_id)
+                await responder.send_reply(report)
+                return
+
+        response = await queue_status(queue, key, live_mode=self.live_delivery)
+        response.assign_thread_from(self)
+        await responder.send_reply(response)
+
+        # Enable only now so that pushed messages follow the status
+        if session:
+            live.enable(key, session, context.message_receipt.recipient_verkey)
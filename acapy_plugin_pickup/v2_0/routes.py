@@ -1,14 +1,49 @@
+import base64
+from datetime import datetime, timezone
+import json
 import logging
 import re
+import time
+from typing import Optional, Tuple
 
+from aiohttp import web
+from aiohttp_apispec import (
+    docs,
+    match_info_schema,
+    querystring_schema,
+    request_schema,
+    response_schema,
+)
 from aries_cloudagent.core.event_bus import Event, EventBus
 from aries_cloudagent.core.profile import Profile
 from aries_cloudagent.core.protocol_registry import ProtocolRegistry
+from aries_cloudagent.messaging.models.openapi import OpenAPISchema
+from aries_cloudagent.transport.inbound.manager import InboundTransportManager
+from marshmallow import fields, validate
+
+from ..config import PickupConfig
+from ..encoder import PayloadEncoder
+from ..forward import MESSAGE_TYPES as FORWARD_TYPES
+from ..keys import RecipientKeyIndex
+from ..live import LiveSessions
+from ..metrics import CONTENT_TYPE, PickupMetrics
+from ..queue import (
+    ORDERS,
+    PickupQueue,
+    PickupQueuedMessage,
+    QueueStats,
+    get_pickup_queue,
+    sort_position,
+)
+from ..sessions import get_session_index
+from .live_mode import LiveDelivery
 
 LOGGER = logging.getLogger(__name__)
 
 WEBHOOK_TOPIC = "acapy::webhook::questionanswer"
 
+MAX_PAGE = 1000
+
 
 def register_events(event_bus: EventBus):
     """Register to handle events."""
@@ -16,9 +51,426 @@ def register_events(event_bus: EventBus):
         re.compile("^acapy::core::startup"),
         on_startup,
     )
+    event_bus.subscribe(
+        re.compile("^acapy::core::shutdown"),
+        on_shutdown,
+    )
 
 
 async def on_startup(profile: Profile, event: Event):
     """Perform startup actions."""
     protocol_registry = profile.inject(ProtocolRegistry)
     LOGGER.debug("Registered protocols: %s", protocol_registry.message_types)
+
+    manager = profile.inject_or(InboundTransportManager)
+    if manager:
+        queue = get_pickup_queue(manager)
+        get_session_index(manager)
+        if queue:
+            queue.start_expiry()
+            config = PickupConfig.from_settings(profile.settings)
+            profile.context.injector.bind_instance(PickupConfig, config)
+            if config.limits.capped and config.limits.policy == "reject-new":
+                # Turn forwards away while their recipient is over its caps
+                protocol_registry.register_message_types(FORWARD_TYPES)
+            metrics = PickupMetrics()
+            profile.context.injector.bind_instance(PickupMetrics, metrics)
+            RecipientKeyIndex.bind(profile)
+            encoder = None
+            if config.encode_concurrency:
+                encoder = PayloadEncoder(
+                    queue, profile, concurrency=config.encode_concurrency
+                )
+                encoder.start()
+                profile.context.injector.bind_instance(PayloadEncoder, encoder)
+            profile.context.injector.bind_instance(
+                LiveSessions,
+                LiveDelivery(
+                    queue,
+                    max_bytes=config.max_delivery_bytes,
+                    encoder=encoder,
+                    metrics=metrics,
+                ),
+            )
+
+
+async def on_shutdown(profile: Profile, event: Event):
+    """Perform shutdown actions."""
+    live = profile.inject_or(LiveSessions)
+    if live:
+        await live.close()
+    encoder = profile.inject_or(PayloadEncoder)
+    if encoder:
+        await encoder.close()
+    manager = profile.inject_or(InboundTransportManager)
+    if manager and isinstance(manager.undelivered_queue, PickupQueue):
+        await manager.undelivered_queue.close()
+
+
+@docs(tags=["pickup"], summary="Metrics of the pickup plugin, for Prometheus")
+async def metrics_handler(request: web.BaseRequest):
+    """Render the pickup metrics in the Prometheus text format."""
+    profile = request["context"].profile
+    metrics = profile.inject_or(PickupMetrics)
+    if metrics is None:
+        raise web.HTTPNotFound(reason="Pickup metrics are not enabled")
+    manager = profile.inject_or(InboundTransportManager)
+    queue = get_pickup_queue(manager) if manager else None
+    text = await metrics.render(queue, profile.inject_or(PayloadEncoder))
+    return web.Response(body=text.encode(), headers={"Content-Type": CONTENT_TYPE})
+
+
+class RecipientKeyMatchInfoSchema(OpenAPISchema):
+    """Path parameters of requests about the queue of a recipient key."""
+
+    recipient_key = fields.Str(
+        required=True, metadata={"description": "Recipient key of queued messages"}
+    )
+
+
+class QueueListQueryStringSchema(OpenAPISchema):
+    """Query string parameters of a request listing queues."""
+
+    order = fields.Str(
+        required=False,
+        load_default="depth",
+        validate=validate.OneOf(ORDERS),
+        metadata={
+            "description": "List by number of messages or bytes queued (largest "
+            "first), or by age of the oldest message (oldest first)"
+        },
+    )
+    limit = fields.Int(
+        required=False,
+        load_default=100,
+        validate=validate.Range(min=1, max=MAX_PAGE),
+        metadata={"description": "Maximum number of queues to list"},
+    )
+    cursor = fields.Str(
+        required=False,
+        metadata={"description": "Cursor returned with the previous page"},
+    )
+
+
+class QueueStatsSchema(OpenAPISchema):
+    """Aggregates of the messages queued for a recipient key."""
+
+    recipient_key = fields.Str(metadata={"description": "Recipient key"})
+    message_count = fields.Int(metadata={"description": "Number of queued messages"})
+    total_size = fields.Int(metadata={"description": "Bytes of queued messages"})
+    oldest_time = fields.Str(
+        metadata={"description": "Time the oldest message was received (ISO 8601)"}
+    )
+    newest_time = fields.Str(
+        metadata={"description": "Time the newest message was received (ISO 8601)"}
+    )
+
+
+class QueueListSchema(OpenAPISchema):
+    """Page of queues."""
+
+    results = fields.List(fields.Nested(QueueStatsSchema()))
+    next = fields.Str(
+        allow_none=True,
+        metadata={"description": "Cursor of the next page, if there may be one"},
+    )
+
+
+class QueueMessagesQueryStringSchema(OpenAPISchema):
+    """Query string parameters of a request for the messages of a queue."""
+
+    limit = fields.Int(
+        required=False,
+        load_default=100,
+        validate=validate.Range(min=1, max=MAX_PAGE),
+        metadata={"description": "Maximum number of messages to list"},
+    )
+    after = fields.Int(
+        required=False,
+        load_default=0,
+        metadata={"description": "List messages after this sequence number"},
+    )
+
+
+class QueuedMessageSchema(OpenAPISchema):
+    """Metadata of a queued message."""
+
+    seq = fields.Int(metadata={"description": "Sequence number in the queue"})
+    tag = fields.Str(
+        allow_none=True,
+        metadata={"description": "Tag of the encrypted payload, its id on delivery"},
+    )
+    size = fields.Int(metadata={"description": "Bytes of the payload"})
+    received_at = fields.Str(
+        metadata={"description": "Time the message was received (ISO 8601)"}
+    )
+    encrypted = fields.Bool(metadata={"description": "Whether encrypted yet"})
+
+
+class QueueDetailSchema(QueueStatsSchema):
+    """Aggregates and a page of messages of a queue."""
+
+    messages = fields.List(fields.Nested(QueuedMessageSchema()))
+    next = fields.Int(
+        allow_none=True,
+        metadata={"description": "Value of after for the next page, if any"},
+    )
+
+
+class QueueRemoveQueryStringSchema(OpenAPISchema):
+    """Query string parameters of a request removing queued messages."""
+
+    older_than = fields.Float(
+        required=False,
+        validate=validate.Range(min=0),
+        metadata={"description": "Only remove messages queued this many seconds ago"},
+    )
+
+
+class QueueRemoveTagsSchema(OpenAPISchema):
+    """Request body removing queued messages by tag."""
+
+    tags = fields.List(
+        fields.Str(),
+        required=True,
+        metadata={"description": "Tags of the messages to remove"},
+    )
+
+
+class QueuePurgeSchema(OpenAPISchema):
+    """Request body removing the queued messages of several recipient keys."""
+
+    recipient_keys = fields.List(
+        fields.Str(),
+        required=False,
+        validate=validate.Length(max=MAX_PAGE),
+        metadata={"description": "Remove the messages queued for these keys"},
+    )
+    older_than = fields.Float(
+        required=False,
+        validate=validate.Range(min=0),
+        metadata={
+            "description": "Only remove messages queued this many seconds ago; "
+            "for all keys unless recipient_keys are given"
+        },
+    )
+    limit = fields.Int(
+        required=False,
+        load_default=MAX_PAGE,
+        validate=validate.Range(min=1, max=MAX_PAGE),
+        metadata={"description": "Maximum number of keys to remove messages for"},
+    )
+
+
+class QueueRemovedSchema(OpenAPISchema):
+    """Result of removing queued messages."""
+
+    removed = fields.Int(metadata={"description": "Number of messages removed"})
+    more = fields.Bool(
+        metadata={"description": "Whether messages may remain to remove (purge only)"}
+    )
+
+
+def _pickup_queue(request: web.BaseRequest) -> PickupQueue:
+    manager = request["context"].profile.inject_or(InboundTransportManager)
+    queue = get_pickup_queue(manager) if manager else None
+    if queue is None:
+        raise web.HTTPNotFound(reason="The undelivered queue is not enabled")
+    return queue
+
+
+def _limit(value: Optional[str], default: int) -> int:
+    try:
+        return min(max(int(value), 1), MAX_PAGE) if value else default
+    except ValueError:
+        raise web.HTTPBadRequest(reason=f"Invalid limit: {value}") from None
+
+
+def _before(older_than: Optional[str]) -> Optional[float]:
+    """Return the receipt time cutoff of messages queued older_than seconds ago."""
+    if older_than is None:
+        return None
+    try:
+        return time.time() - float(older_than)
+    except (TypeError, ValueError):
+        raise web.HTTPBadRequest(reason=f"Invalid age: {older_than}") from None
+
+
+def _iso(timestamp: Optional[float]) -> Optional[str]:
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
+
+
+def _stats_json(key: str, stats: QueueStats) -> dict:
+    return {
+        "recipient_key": key,
+        "message_count": stats.count,
+        "total_size": stats.total_size,
+        "oldest_time": _iso(stats.oldest),
+        "newest_time": _iso(stats.newest),
+    }
+
+
+def _message_json(queued: PickupQueuedMessage) -> dict:
+    return {
+        "seq": queued.seq,
+        "tag": queued.tag,
+        "size": queued.size,
+        "received_at": _iso(queued.timestamp),
+        "encrypted": queued.encrypted,
+    }
+
+
+def encode_cursor(order: str, position: Tuple[float, str]) -> str:
+    """Return an opaque cursor for the position of a key listed in order."""
+    return base64.urlsafe_b64encode(json.dumps([order, *position]).encode()).decode()
+
+
+def decode_cursor(order: str, cursor: str) -> Tuple[float, str]:
+    """Return the position encoded in a cursor of a listing in order."""
+    try:
+        cursor_order, value, key = json.loads(base64.urlsafe_b64decode(cursor))
+    except (ValueError, TypeError):
+        raise web.HTTPBadRequest(reason="Invalid cursor") from None
+    if (
+        not isinstance(value, (int, float))
+        or isinstance(value, bool)
+        or not isinstance(key, str)
+    ):
+        raise web.HTTPBadRequest(reason="Invalid cursor")
+    if cursor_order != order:
+        raise web.HTTPBadRequest(reason=f"Cursor is not of a listing by {order}")
+    return value, key
+
+
+@docs(tags=["pickup"], summary="List queues of recipient keys, a page at a time")
+@querystring_schema(QueueListQueryStringSchema())
+@response_schema(QueueListSchema(), 200, description="")
+async def list_queues(request: web.BaseRequest):
+    """List the queues of recipient keys in order, a page at a time."""
+    queue = _pickup_queue(request)
+    order = request.query.get("order", "depth")
+    if order not in ORDERS:
+        raise web.HTTPBadRequest(reason=f"Invalid order: {order}")
+    limit = _limit(request.query.get("limit"), 100)
+    cursor = request.query.get("cursor")
+    after = decode_cursor(order, cursor) if cursor else None
+
+    page = await queue.list_keys(order, limit, after)
+    next_cursor = None
+    if len(page) == limit:
+        next_cursor = encode_cursor(order, sort_position(order, *page[-1]))
+    return web.json_response(
+        {
+            "results": [_stats_json(key, stats) for key, stats in page],
+            "next": next_cursor,
+        }
+    )
+
+
+@docs(tags=["pickup"], summary="Show the queue of a recipient key")
+@match_info_schema(RecipientKeyMatchInfoSchema())
+@querystring_schema(QueueMessagesQueryStringSchema())
+@response_schema(QueueDetailSchema(), 200, description="")
+async def queue_detail(request: web.BaseRequest):
+    """Show the aggregates and metadata of a page of messages of a queue."""
+    queue = _pickup_queue(request)
+    key = request.match_info["recipient_key"]
+    limit = _limit(request.query.get("limit"), 100)
+    try:
+        after = int(request.query.get("after", 0))
+    except ValueError:
+        raise web.HTTPBadRequest(reason="Invalid sequence number") from None
+
+    stats = await queue.stats_for_key(key)
+    messages = [
+        _message_json(queued)
+        async for queued in queue.messages_for_key(key, limit, after=after)
+    ]
+    return web.json_response(
+        {
+            **_stats_json(key, stats),
+            "messages": messages,
+            "next": messages[-1]["seq"] if len(messages) == limit else None,
+        }
+    )
+
+
+@docs(tags=["pickup"], summary="Remove the queued messages of a recipient key")
+@match_info_schema(RecipientKeyMatchInfoSchema())
+@querystring_schema(QueueRemoveQueryStringSchema())
+@response_schema(QueueRemovedSchema(), 200, description="")
+async def remove_queue(request: web.BaseRequest):
+    """Remove the messages of a queue, or only the older ones."""
+    queue = _pickup_queue(request)
+    key = request.match_info["recipient_key"]
+    before = _before(request.query.get("older_than"))
+    removed = await queue.remove_for_key(key, before)
+    LOGGER.info("Removed %d messages queued for %s through admin API", removed, key)
+    return web.json_response({"removed": removed})
+
+
+@docs(tags=["pickup"], summary="Remove queued messages of a recipient key by tag")
+@match_info_schema(RecipientKeyMatchInfoSchema())
+@request_schema(QueueRemoveTagsSchema())
+@response_schema(QueueRemovedSchema(), 200, description="")
+async def remove_queued_tags(request: web.BaseRequest):
+    """Remove messages of a queue by the tags of their encrypted payloads."""
+    queue = _pickup_queue(request)
+    key = request.match_info["recipient_key"]
+    body = await request.json()
+    removed = await queue.remove_by_tags(key, body.get("tags") or ())
+    LOGGER.info("Removed %d messages queued for %s through admin API", removed, key)
+    return web.json_response({"removed": removed})
+
+
+@docs(tags=["pickup"], summary="Remove queued messages by recipient key or age")
+@request_schema(QueuePurgeSchema())
+@response_schema(QueueRemovedSchema(), 200, description="")
+async def purge_queues(request: web.BaseRequest):
+    """Remove the messages of the given keys, or older messages of any key.
+
+    At most limit keys are visited, so that the request takes bounded time;
+    more is set if it should be repeated.
+    """
+    queue = _pickup_queue(request)
+    body = await request.json()
+    keys = body.get("recipient_keys")
+    before = _before(body.get("older_than"))
+    max_keys = _limit(body.get("limit"), MAX_PAGE)
+    if keys:
+        removed = 0
+        for key in keys[:max_keys]:
+            removed += await queue.remove_for_key(key, before)
+        more = len(keys) > max_keys
+    elif before is not None:
+        removed_by_key, more = await queue.remove_received_before(before, max_keys)
+        removed = sum(removed_by_key.values())
+    else:
+        raise web.HTTPBadRequest(reason="Give recipient_keys, older_than or both")
+    LOGGER.info("Removed %d queued messages through admin API", removed)
+    return web.json_response({"removed": removed, "more": more})
+
+
+async def register(app: web.Application):
+    """Register admin routes."""
+    app.add_routes(
+        [
+            web.get("/pickup/metrics", metrics_handler, allow_head=False),
+            web.get("/pickup/queues", list_queues, allow_head=False),
+            web.post("/pickup/queues/purge", purge_queues),
+            web.get("/pickup/queues/{recipient_key}", queue_detail, allow_head=False),
+            web.delete("/pickup/queues/{recipient_key}", remove_queue),
+            web.post("/pickup/queues/{recipient_key}/remove-tags", remove_queued_tags),
+        ]
+    )
+
+
+def post_process_routes(app: web.Application):
+    """Amend swagger API."""
+    if "tags" not in app._state["swagger_dict"]:
+        app._state["swagger_dict"]["tags"] = []
+    app._state["swagger_dict"]["tags"].append(
+        {"name": "pickup", "description": "Pickup queue monitoring and management"}
+    )
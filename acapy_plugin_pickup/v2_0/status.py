@@ -1,14 +1,21 @@
 """Status Request and Status messages for the Pickup Protocol."""
 
+from datetime import datetime, timezone
 import logging
+import time
 from typing import Optional
 
 from aries_cloudagent.messaging.request_context import RequestContext
 from aries_cloudagent.messaging.responder import BaseResponder
+from aries_cloudagent.protocols.problem_report.v1_0.message import ProblemReport
 from aries_cloudagent.transport.inbound.manager import InboundTransportManager
 
 from ..acapy import AgentMessage
 from ..acapy.error import HandlerException
+from ..keys import requested_key
+from ..live import LiveSessions
+from ..metrics import observed
+from ..queue import PickupQueue, get_pickup_queue
 from ..valid import ISODateTime
 
 LOGGER = logging.getLogger(__name__)
@@ -22,6 +29,7 @@ class StatusRequest(AgentMessage):
 
     recipient_key: Optional[str] = None
 
+    @observed("status")
     async def handle(self, context: RequestContext, responder: BaseResponder):
         """Handle status request message."""
         if not self.transport or self.transport.return_route != "all":
@@ -29,13 +37,21 @@ class StatusRequest(AgentMessage):
                 "StatusRequest must have transport decorator with return "
                 "route set to all"
             )
-        recipient_key = self.recipient_key
+        key = await requested_key(context, self.recipient_key)
+        if key is None:
+            await reject_recipient_key(self, responder)
+            return
         manager = context.inject(InboundTransportManager)
         assert manager
-        count = manager.undelivered_queue.message_count_for_key(
-            recipient_key or context.message_receipt.sender_verkey
+        queue = get_pickup_queue(manager)
+        sender = context.message_receipt.sender_verkey
+        live = context.inject_or(LiveSessions)
+        response = await queue_status(
+            queue,
+            key,
+            recipient_key=self.recipient_key,
+            live_mode=bool(live and live.is_live(sender)),
         )
-        response = Status(message_count=count, recipient_key=recipient_key)
         response.assign_thread_from(self)
         await responder.send_reply(response)
 
@@ -52,3 +68,49 @@ class Status(AgentMessage):
     oldest_time: Optional[ISODateTime] = None
     total_size: Optional[int] = None
     live_mode: Optional[bool] = None
+    # Extensions: messages dropped since the last status, by expiry or caps
+    expired_count: Optional[int] = None
+    evicted_count: Optional[int] = None
+
+
+async def reject_recipient_key(message: AgentMessage, responder: BaseResponder):
+    """Reply to a request naming a recipient key its sender does not own."""
+    report = ProblemReport(
+        description={
+            "en": "Recipient key not owned by this connection",
+            "code": "e.m.recipient-key-not-owned",
+        }
+    )
+    report.assign_thread_id(message._thread_id)
+    await responder.send_reply(report)
+
+
+def _isoformat(timestamp: Optional[float]) -> Optional[str]:
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
+
+
+async def queue_status(queue: PickupQueue, key: str, **fields) -> Status:
+    """Return the status of the queue for key, from its aggregates.
+
+    duration_waited is how long the oldest queued message has waited, in
+    seconds; messages expired or dropped by caps since the last status of key
+    are reported, if any. Other fields of the status may be given as keyword
+    arguments.
+    """
+    stats = await queue.stats_for_key(key)
+    expired, evicted = await queue.take_dropped(key)
+    values = dict(
+        message_count=stats.count,
+        total_size=stats.total_size,
+        oldest_time=_isoformat(stats.oldest),
+        newest_time=_isoformat(stats.newest),
+        duration_waited=(
+            None if stats.oldest is None else round(time.time() - stats.oldest)
+        ),
+        expired_count=expired or None,
+        evicted_count=evicted or None,
+    )
+    values.update((name, value) for name, value in fields.items() if value is not None)
+    return Status(**values)
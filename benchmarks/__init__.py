@@ -0,0 +1,6 @@
+"""Offline benchmarks for the pickup plugin.
+
+Run a benchmark from the repository root, e.g.:
+
+    python -m benchmarks.ack
+"""
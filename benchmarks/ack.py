@@ -0,0 +1,61 @@
+"""Compare acknowledgement cost of the tag index against a full queue rescan.
+
+    python -m benchmarks.ack
+"""
+
+import json
+from typing import Set
+
+from aries_cloudagent.transport.inbound.delivery_queue import DeliveryQueue
+
+from acapy_plugin_pickup.queue import MemoryPickupQueue
+
+from .common import queued_message, timed
+
+KEY = "recipient"
+ACKED = 10
+
+
+def rescan_remove(queue: DeliveryQueue, recipient_key: str, tag_list: Set[str]):
+    """Remove messages by tag by parsing every queued payload (previous behavior)."""
+    queue.queue_by_key[recipient_key][:] = [
+        queued_message
+        for queued_message in queue.queue_by_key[recipient_key]
+        if queued_message.msg.enc_payload is None
+        or json.loads(queued_message.msg.enc_payload)["tag"] not in tag_list
+    ]
+
+
+def main():
+    """Run the benchmark."""
+    print(f"{'depth':>8} {'rescan (ms)':>12} {'indexed (ms)':>13} {'speedup':>8}")
+    for depth in (10_000, 100_000):
+        messages = [queued_message(KEY) for _ in range(depth)]
+        plain = DeliveryQueue()
+        indexed = MemoryPickupQueue()
+        for msg in messages:
+            plain.add_message(msg)
+            indexed.add_message(msg)
+
+        # Acknowledge tags from the middle of the queue; each run removes
+        # distinct messages so runs do not become no-ops.
+        tags = [json.loads(msg.enc_payload)["tag"] for msg in messages]
+        batches = [
+            set(tags[start : start + ACKED])  # noqa: E203
+            for start in range(depth // 2, depth, ACKED)
+        ]
+        plain_batches = iter(batches)
+        indexed_batches = iter(batches)
+
+        rescan = timed(lambda: rescan_remove(plain, KEY, next(plain_batches)), 3)
+        index = timed(
+            lambda: indexed.remove_messages_by_tag(KEY, next(indexed_batches)), 3
+        )
+        print(
+            f"{depth:>8} {rescan * 1000:>12.3f} {index * 1000:>13.4f} "
+            f"{rescan / index:>7.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
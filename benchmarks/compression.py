@@ -0,0 +1,38 @@
+"""Measure the ratio and CPU cost of compressing stored payloads.
+
+    python -m benchmarks.compression
+"""
+
+from acapy_plugin_pickup.config import CompressionConfig
+from acapy_plugin_pickup.queue.compression import PayloadCompressor
+
+from .common import jwe_payloads
+
+MESSAGES = 2000
+
+
+def main():
+    """Run the benchmark."""
+    print(
+        f"{'size':>7} {'codec':>6} {'level':>6} {'ratio':>6} "
+        f"{'compress (us)':>14} {'decompress (us)':>16}"
+    )
+    for size in (1024, 16384, 262144):
+        payloads = list(jwe_payloads(MESSAGES if size < 262144 else 100, size))
+        for codec in ("zlib", "lzma"):
+            for level in (1, 6, 9):
+                compressor = PayloadCompressor(
+                    CompressionConfig(codec=codec, level=level, min_size=0)
+                )
+                stored = [compressor.compress(payload) for payload in payloads]
+                for payload in stored:
+                    compressor.decompress(payload)
+                print(
+                    f"{size:>7} {codec:>6} {level:>6} {compressor.ratio:>6.2f} "
+                    f"{compressor.compress_seconds / len(payloads) * 1e6:>14.1f} "
+                    f"{compressor.decompress_seconds / len(payloads) * 1e6:>16.1f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
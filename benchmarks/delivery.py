@@ -0,0 +1,71 @@
+"""Compare building and serializing deliveries against full model validation.
+
+    python -m benchmarks.delivery
+"""
+
+import json
+
+from acapy_plugin_pickup.acapy import AgentMessage, Attach
+from acapy_plugin_pickup.queue import MemoryPickupQueue
+from acapy_plugin_pickup.v2_0.delivery import Delivery
+
+from .common import queued_message, timed
+
+KEY = "recipient"
+MESSAGES = 100
+
+
+def validated_delivery(queued_messages) -> str:
+    """Build and serialize a delivery validating every attachment (previous path)."""
+    delivery = Delivery(
+        message_attachments=[
+            Attach.data_base64(ident=queued.tag, value=queued.enc_payload)
+            for queued in queued_messages
+        ]
+    )
+    return json.dumps(AgentMessage.serialize(delivery))
+
+
+def trusted_delivery(queued_messages) -> str:
+    """Build and write out a delivery from base64 payloads cached per message."""
+    delivery = Delivery.of_attachments(
+        [
+            Attach.trusted_base64(queued.b64_payload, ident=queued.tag)
+            for queued in queued_messages
+        ]
+    )
+    return delivery.to_json()
+
+
+def main():
+    """Run the benchmark."""
+    print(
+        f"{'size':>7} {'validated (ms)':>15} {'first (ms)':>11} {'cached (ms)':>12} "
+        f"{'speedup':>8}"
+    )
+    for size in (1024, 16 * 1024, 256 * 1024):
+        queue = MemoryPickupQueue()
+        for _ in range(MESSAGES):
+            queue.add_message(queued_message(KEY, size))
+        queued_messages = list(queue.queued_messages_for_key(KEY))
+        assert json.loads(validated_delivery(queued_messages))["~attach"] == (
+            json.loads(trusted_delivery(queued_messages))["~attach"]
+        )
+
+        validated = timed(lambda: validated_delivery(queued_messages))
+
+        def first():
+            for queued in queued_messages:
+                queued._b64_payload = None
+            trusted_delivery(queued_messages)
+
+        uncached = timed(first)
+        cached = timed(lambda: trusted_delivery(queued_messages))
+        print(
+            f"{size:>7} {validated * 1000:>15.3f} {uncached * 1000:>11.3f} "
+            f"{cached * 1000:>12.3f} {validated / cached:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Measure the dispatch overhead of pickup messages, up to their handle method.
+
+Each message goes through the steps ACA-Py's dispatcher takes: resolving its
+class from the protocol registry, deserializing it and calling the handle
+method of a new instance of its handler. Handle methods are replaced with
+no-ops so that only the overhead is measured.
+
+    python -m benchmarks.dispatch
+"""
+
+import asyncio
+import json
+from types import SimpleNamespace
+
+from aries_cloudagent.core.protocol_registry import ProtocolRegistry
+from aries_cloudagent.messaging.base_handler import BaseHandler
+
+from acapy_plugin_pickup.v2_0.message_types import MESSAGE_TYPES
+
+from .common import jwe_payload
+
+RUNS = 5000
+TRANSPORT = {"~transport": {"return_route": "all"}}
+ATTACHMENT = {
+    "@id": "tag",
+    "mime-type": "application/json",
+    "data": {"base64": jwe_payload().hex()},
+}
+
+MESSAGES = {
+    "status-request": TRANSPORT,
+    "status": {"message_count": 3, "total_size": 3072},
+    "delivery-request": {"limit": 10, **TRANSPORT},
+    "delivery": {"~attach": [ATTACHMENT] * 10},
+    "messages-received": {"message_id_list": ["a", "b", "c"], **TRANSPORT},
+    "live-delivery-change": {"live_delivery": True, **TRANSPORT},
+}
+
+
+async def noop_handle(self, context, responder):
+    """Stand in for the handle method of a message."""
+
+
+def uncached_handler(msg) -> type:
+    """Return a new handler class for a message (previous behavior)."""
+    msg_class = msg.__class__
+
+    class Handler(BaseHandler):
+        async def handle(self, context, responder):
+            return await msg_class.handle(context.message, context, responder)
+
+    return Handler
+
+
+async def dispatch(registry: ProtocolRegistry, raw: str, handler_class) -> float:
+    """Dispatch raw RUNS times, returning the time per message in microseconds."""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    for _ in range(RUNS):
+        parsed = json.loads(raw)
+        message_class = registry.resolve_message_class(parsed["@type"])
+        message = message_class.deserialize(parsed)
+        context = SimpleNamespace(message=message)
+        await handler_class(message)().handle(context, None)
+    return (loop.time() - started) / RUNS * 1e6
+
+
+async def main():
+    """Run the benchmark."""
+    registry = ProtocolRegistry()
+    registry.register_message_types(MESSAGE_TYPES)
+
+    print(f"{'message':>22} {'uncached (us)':>14} {'cached (us)':>12} {'saved':>7}")
+    for name, value in MESSAGES.items():
+        message_type = f"https://didcomm.org/messagepickup/2.0/{name}"
+        message_class = registry.resolve_message_class(message_type)
+        raw = json.dumps({"@type": message_type, **value})
+
+        handle = message_class.handle
+        message_class.handle = noop_handle
+        try:
+            best = {"uncached": float("inf"), "cached": float("inf")}
+            for _ in range(3):
+                for label, handler_class in (
+                    ("uncached", uncached_handler),
+                    ("cached", lambda message: message.Handler),
+                ):
+                    best[label] = min(
+                        best[label], await dispatch(registry, raw, handler_class)
+                    )
+        finally:
+            message_class.handle = handle
+
+        print(
+            f"{name:>22} {best['uncached']:>14.1f} {best['cached']:>12.1f} "
+            f"{1 - best['cached'] / best['uncached']:>6.0%}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,44 @@
+"""Measure enqueue throughput of the pickup queue backends.
+
+    python -m benchmarks.enqueue
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+
+from acapy_plugin_pickup.queue import MemoryPickupQueue, SqlitePickupQueue
+
+from .common import queued_message
+
+MESSAGES = 20_000
+
+
+async def enqueue_rate(queue, messages) -> float:
+    """Return enqueues per second, including the final commit."""
+    start = time.perf_counter()
+    for msg in messages:
+        queue.add_message(msg)
+    await queue.close()
+    return len(messages) / (time.perf_counter() - start)
+
+
+async def main():
+    """Run the benchmark."""
+    messages = [queued_message(f"key-{i % 100}") for i in range(MESSAGES)]
+    with tempfile.TemporaryDirectory() as tmp:
+        backends = {
+            "memory": MemoryPickupQueue(),
+            "sqlite, group commit": SqlitePickupQueue(os.path.join(tmp, "group.db")),
+            "sqlite, commit per message": SqlitePickupQueue(
+                os.path.join(tmp, "single.db"), batch_size=1
+            ),
+        }
+        for name, queue in backends.items():
+            rate = await enqueue_rate(queue, messages)
+            print(f"{name:>28}: {rate:>10.0f} msgs/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
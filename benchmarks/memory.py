@@ -0,0 +1,98 @@
+"""Compare the memory held per queued message by full messages and compact records.
+
+    python -m benchmarks.memory [count]
+
+ACA-Py's DeliveryQueue holds each queued OutboundMessage, with its target
+list, while the pickup queue keeps a slotted record of what pickup reads.
+Payloads are small so that the per-message overhead stands out; the bytes of
+the payloads themselves are reported separately.
+"""
+
+import gc
+import sys
+import time
+import tracemalloc
+from typing import Callable, Iterator
+
+from aries_cloudagent.connections.models.connection_target import ConnectionTarget
+from aries_cloudagent.transport.inbound.delivery_queue import (
+    DeliveryQueue,
+    QueuedMessage,
+)
+from aries_cloudagent.transport.outbound.message import OutboundMessage
+
+from acapy_plugin_pickup.queue import MemoryPickupQueue, PickupQueuedMessage
+
+COUNT = 1_000_000
+KEYS = 1000
+
+
+def messages(count: int) -> Iterator[OutboundMessage]:
+    """Yield count forwarded messages with distinct small payloads over KEYS keys."""
+    for i in range(count):
+        key = f"recipient-{i % KEYS:04d}"
+        yield OutboundMessage(
+            payload=b"",
+            enc_payload=b'{"protected": "eyJ", "ciphertext": "Y2lwaGVy", '
+            b'"tag": "%08x"}' % i,
+            reply_to_verkey=key,
+            target_list=[ConnectionTarget(recipient_keys=[key])],
+        )
+
+
+def held(fill: Callable[[], object]) -> int:
+    """Return the bytes still allocated by what fill returns."""
+    gc.collect()
+    tracemalloc.start()
+    kept = fill()
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del kept
+    return current
+
+
+def delivery_queue(count: int) -> DeliveryQueue:
+    """Fill ACA-Py's queue, holding full messages."""
+    queue = DeliveryQueue()
+    for msg in messages(count):
+        queue.add_message(msg)
+    return queue
+
+
+def pickup_queue(count: int) -> MemoryPickupQueue:
+    """Fill the pickup queue, holding compact records and their indexes."""
+    queue = MemoryPickupQueue()
+    for msg in messages(count):
+        queue.add_message(msg)
+    return queue
+
+
+def main():
+    """Run the benchmark."""
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else COUNT
+    payloads = sum(len(msg.enc_payload) for msg in messages(count))
+    print(f"{count} messages, {payloads / 2**20:.0f} MiB of payloads")
+    print(f"{'held':>40} {'MiB':>8} {'bytes/msg':>10} {'fill (s)':>9}")
+    cases = {
+        "QueuedMessage(OutboundMessage) list": lambda: [
+            QueuedMessage(msg) for msg in messages(count)
+        ],
+        "PickupQueuedMessage list": lambda: [
+            PickupQueuedMessage(msg) for msg in messages(count)
+        ],
+        "DeliveryQueue": lambda: delivery_queue(count),
+        "MemoryPickupQueue": lambda: pickup_queue(count),
+    }
+    for name, fill in cases.items():
+        start = time.perf_counter()
+        size = held(fill)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name:>40} {size / 2**20:>8.0f} {(size - payloads) / count:>10.0f} "
+            f"{elapsed:>9.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
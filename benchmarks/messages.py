@@ -0,0 +1,95 @@
+"""Compare message (de)serialization against pydantic's generic paths.
+
+    python -m benchmarks.messages
+"""
+
+import json
+from datetime import datetime, timezone
+
+from dateutil import parser
+from pydantic import BaseModel, parse_obj_as
+
+from acapy_plugin_pickup.acapy import Attach
+from acapy_plugin_pickup.v2_0.delivery import (
+    Delivery,
+    DeliveryRequest,
+    MessagesReceived,
+)
+from acapy_plugin_pickup.v2_0.live_mode import LiveDeliveryChange
+from acapy_plugin_pickup.v2_0.status import Status, StatusRequest
+from acapy_plugin_pickup.valid import ISODateTime
+
+from .common import jwe_payload, timed
+
+RUNS = 2000
+NOW = datetime.now(timezone.utc).isoformat()
+THREAD = {"~thread": {"thid": "0b5d1ac4-5f31-4bd3-b88e-34a7f0bff20d"}}
+TRANSPORT = {"~transport": {"return_route": "all"}}
+
+MESSAGES = {
+    StatusRequest: {"recipient_key": "recipient", **TRANSPORT},
+    Status: {
+        "message_count": 12,
+        "recipient_key": "recipient",
+        "duration_waited": 3,
+        "newest_time": NOW,
+        "oldest_time": NOW,
+        "total_size": 12288,
+        "live_mode": False,
+        **THREAD,
+    },
+    DeliveryRequest: {"limit": 10, "recipient_key": "recipient", **TRANSPORT},
+    Delivery: {
+        "~attach": [
+            json.loads(
+                Attach.data_base64(jwe_payload(), ident=str(i)).json(
+                    by_alias=True, exclude_none=True
+                )
+            )
+            for i in range(10)
+        ],
+        **THREAD,
+    },
+    MessagesReceived: {"message_id_list": [str(i) for i in range(10)], **TRANSPORT},
+    LiveDeliveryChange: {"live_delivery": True, **TRANSPORT},
+}
+
+
+def per_run(fn) -> float:
+    """Return the time of a call to fn in microseconds."""
+    return timed(lambda: [fn() for _ in range(RUNS)]) / RUNS * 1e6
+
+
+def main():
+    """Run the benchmark."""
+    print(
+        f"{'message':>20} {'serialize (us)':>22} {'to_json (us)':>22} "
+        f"{'deserialize (us)':>22}"
+    )
+    for cls, value in MESSAGES.items():
+        msg = cls.deserialize(value)
+        serialize = per_run(msg.serialize)
+        to_json = per_run(msg.to_json)
+        deserialize = per_run(lambda: cls.deserialize(value))
+
+        dict_ = per_run(lambda: BaseModel.dict(msg, exclude_none=True, by_alias=True))
+        json_ = per_run(msg.json)
+        parse = per_run(lambda: parse_obj_as(cls, value))
+
+        print(
+            f"{cls.__name__:>20} "
+            f"{dict_:>8.1f} -> {serialize:>5.1f} ({dict_ / serialize:>3.1f}x) "
+            f"{json_:>8.1f} -> {to_json:>5.1f} ({json_ / to_json:>3.1f}x) "
+            f"{parse:>8.1f} -> {deserialize:>5.1f} ({parse / deserialize:>3.1f}x)"
+        )
+
+    isoparse = per_run(lambda: parser.isoparse(NOW))
+    validate = per_run(lambda: ISODateTime.validate(NOW))
+    print(
+        f"{'ISO timestamp':>20} {'':>22} {'':>22} "
+        f"{isoparse:>8.1f} -> {validate:>5.1f} ({isoparse / validate:>3.1f}x)"
+    )
+
+
+if __name__ == "__main__":
+    main()
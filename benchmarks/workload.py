@@ -0,0 +1,323 @@
+"""Time the pickup handlers on synthetic queues of various shapes.
+
+Each workload fills a queue with JWE-shaped messages spread over a number of
+recipient keys, then times StatusRequest, DeliveryRequest and
+MessagesReceived handling for randomly chosen keys, with stub contexts in
+place of ACA-Py's dispatcher. Workloads run in separate processes so that
+their peak memory can be told apart.
+
+Results are saved as JSON, named after the current commit by default, so runs
+on different commits can be compared:
+
+    python -m benchmarks.workload --workload 10000x100 1x100000
+    python -m benchmarks.workload --compare benchmarks/results/<commit>.json
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+from aries_cloudagent.connections.models.connection_target import ConnectionTarget
+from aries_cloudagent.core.in_memory import InMemoryProfile
+from aries_cloudagent.messaging.request_context import RequestContext
+from aries_cloudagent.messaging.responder import BaseResponder, MockResponder
+from aries_cloudagent.transport.inbound.manager import InboundTransportManager
+from aries_cloudagent.transport.inbound.receipt import MessageReceipt
+from aries_cloudagent.transport.inbound.session import InboundSession
+from aries_cloudagent.transport.outbound.message import OutboundMessage
+from aries_cloudagent.transport.wire_format import BaseWireFormat
+
+from acapy_plugin_pickup.config import PickupConfig, RedisConfig, SqliteConfig
+from acapy_plugin_pickup.queue import PickupQueue, create_queue
+from acapy_plugin_pickup.v2_0.delivery import DeliveryRequest, MessagesReceived
+from acapy_plugin_pickup.v2_0.status import StatusRequest
+
+from .common import jwe_payloads
+
+RESULTS = os.path.join(os.path.dirname(__file__), "results")
+TRANSPORT = {"~transport": {"return_route": "all"}}
+OPERATIONS = ("status", "delivery", "ack")
+
+
+def parse_workload(workload: str):
+    """Parse a workload given as <keys>x<depth>."""
+    keys, depth = workload.lower().split("x")
+    return int(keys), int(depth)
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    """Return the given percentile of ordered values."""
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    """Return throughput and latency percentiles of sequential requests."""
+    ordered = sorted(latencies)
+    return {
+        "requests": len(ordered),
+        "per_second": len(ordered) / sum(ordered),
+        "p50_ms": percentile(ordered, 0.5) * 1000,
+        "p99_ms": percentile(ordered, 0.99) * 1000,
+    }
+
+
+def fill(queue: PickupQueue, keys: List[str], depth: int, size: int) -> float:
+    """Queue depth messages for each key, interleaved; return messages per second."""
+    payloads = jwe_payloads(len(keys) * depth, size)
+    targets = {key: [ConnectionTarget(recipient_keys=[key])] for key in keys}
+    started = time.perf_counter()
+    for _ in range(depth):
+        for key in keys:
+            queue.add_message(
+                OutboundMessage(
+                    payload=b"",
+                    enc_payload=next(payloads),
+                    reply_to_verkey=key,
+                    target_list=targets[key],
+                )
+            )
+    return len(keys) * depth / (time.perf_counter() - started)
+
+
+class Handling:
+    """Handle pickup messages from recipients, as ACA-Py's dispatcher would."""
+
+    def __init__(self, queue: PickupQueue, keys: List[str], config: PickupConfig):
+        """Set up a profile and a transport manager holding a session per key."""
+        # Messages are queued encrypted, so the wire format is not used
+        self.profile = InMemoryProfile.test_profile(
+            settings={"plugin_config": {"acapy_plugin_pickup": config.dict()}},
+            bind={BaseWireFormat: BaseWireFormat()},
+        )
+        self.manager = InboundTransportManager(self.profile, None)
+        self.manager.undelivered_queue = queue
+        for key in keys:
+            self.manager.sessions[key] = InboundSession(
+                profile=self.profile,
+                inbound_handler=None,
+                session_id=key,
+                wire_format=None,
+                reply_mode="all",
+                reply_verkeys=[key],
+            )
+        self.context = RequestContext(self.profile)
+        self.context.injector.bind_instance(InboundTransportManager, self.manager)
+
+    async def handle(self, key: str, message) -> MockResponder:
+        """Handle a message from key, returning the responder holding the reply."""
+        self.context.message_receipt = MessageReceipt(
+            sender_verkey=key, recipient_verkey="mediator"
+        )
+        self.context.message = message
+        responder = MockResponder()
+        BaseResponder.__init__(responder, reply_to_verkey=key)
+        await message.handle(self.context, responder)
+        return responder
+
+
+async def timed_requests(handling: Handling, keys: List[str], make_message):
+    """Handle a message made for each key in turn, returning the latencies."""
+    latencies = []
+    for key in keys:
+        message = await make_message(key)
+        started = time.perf_counter()
+        await handling.handle(key, message)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+async def run_workload(
+    backend: str, workload: str, requests: int, size: int, batch: int, seed: int
+) -> dict:
+    """Fill a queue for workload and time requests against it."""
+    key_count, depth = parse_workload(workload)
+    keys = [f"recipient-{i:06d}" for i in range(key_count)]
+    rng = random.Random(seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config = PickupConfig(
+            backend=backend,
+            sqlite=SqliteConfig(path=os.path.join(tmp, "pickup.db")),
+            redis=RedisConfig(
+                url=os.environ.get("PICKUP_REDIS_URL", RedisConfig().url),
+                prefix=f"pickup-bench-{os.getpid()}:",
+            ),
+        )
+        queue = create_queue(config)
+        try:
+            fill_rate = fill(queue, keys, depth, size)
+            handling = Handling(queue, keys, config)
+
+            async def status_request(key):
+                return StatusRequest.deserialize(TRANSPORT)
+
+            async def delivery_request(key):
+                return DeliveryRequest.deserialize({"limit": batch, **TRANSPORT})
+
+            async def messages_received(key):
+                tags = [
+                    queued.tag
+                    async for queued in queue.messages_for_key(key, limit=batch)
+                ]
+                return MessagesReceived.deserialize(
+                    {"message_id_list": tags, **TRANSPORT}
+                )
+
+            results = {}
+            for operation, make_message in zip(
+                OPERATIONS, (status_request, delivery_request, messages_received)
+            ):
+                sample = [rng.choice(keys) for _ in range(requests)]
+                results[operation] = summarize(
+                    await timed_requests(handling, sample, make_message)
+                )
+        finally:
+            await queue.close()
+
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return {
+        "backend": backend,
+        "workload": workload,
+        "fill_per_second": fill_rate,
+        "peak_rss_mb": peak_mb,
+        "operations": results,
+    }
+
+
+def run_in_process(*args) -> dict:
+    """Run a workload in this (fresh) process."""
+    return asyncio.run(run_workload(*args))
+
+
+def commit_label() -> str:
+    """Return the current commit, marked if the tree has changes."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if dirty else commit
+
+
+def report(runs: List[dict], baseline: Optional[Dict[tuple, dict]] = None):
+    """Print results, with the change from baseline if given."""
+    print(
+        f"{'workload':>12} {'backend':>8} {'operation':>9} {'req/s':>9} "
+        f"{'p50 (ms)':>9} {'p99 (ms)':>9}" + (f" {'vs base':>8}" if baseline else "")
+    )
+    for run in runs:
+        print(
+            f"{run['workload']:>12} {run['backend']:>8} {'fill':>9} "
+            f"{run['fill_per_second']:>9.0f} {'':>9} {'':>9}   "
+            f"peak {run['peak_rss_mb']:.0f} MB"
+        )
+        for operation, stats in run["operations"].items():
+            line = (
+                f"{'':>12} {'':>8} {operation:>9} {stats['per_second']:>9.0f} "
+                f"{stats['p50_ms']:>9.3f} {stats['p99_ms']:>9.3f}"
+            )
+            base = (baseline or {}).get((run["workload"], run["backend"]))
+            if base and operation in base["operations"]:
+                ratio = (
+                    stats["per_second"] / base["operations"][operation]["per_second"]
+                )
+                line += f" {ratio:>7.2f}x"
+            print(line)
+
+
+def main(argv: Optional[List[str]] = None):
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--workload",
+        nargs="+",
+        default=["10000x100", "1x100000"],
+        help="workloads as <keys>x<messages per key>",
+    )
+    parser.add_argument(
+        "--backend",
+        nargs="+",
+        default=["memory"],
+        choices=["memory", "sqlite", "redis"],
+        help="queue backends; redis uses PICKUP_REDIS_URL",
+    )
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--size", type=int, default=1024, help="ciphertext bytes")
+    parser.add_argument("--batch", type=int, default=10, help="delivery limit")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file (default: per commit)")
+    parser.add_argument("--compare", help="results file to compare against")
+    args = parser.parse_args(argv)
+
+    runs = []
+    for workload in args.workload:
+        for backend in args.backend:
+            # A fresh process per run, for its own peak memory
+            with ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                runs.append(
+                    executor.submit(
+                        run_in_process,
+                        backend,
+                        workload,
+                        args.requests,
+                        args.size,
+                        args.batch,
+                        args.seed,
+                    ).result()
+                )
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as compared:
+            baseline = {
+                (run["workload"], run["backend"]): run
+                for run in json.load(compared)["runs"]
+            }
+    report(runs, baseline)
+
+    label = commit_label()
+    output = args.output or os.path.join(RESULTS, f"{label}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as results:
+        json.dump(
+            {
+                "commit": label,
+                "python": sys.version.split()[0],
+                "parameters": {
+                    name: value
+                    for name, value in vars(args).items()
+                    if name not in ("output", "compare")
+                },
+                "runs": runs,
+            },
+            results,
+            indent=2,
+        )
+    print(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
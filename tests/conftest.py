@@ -0,0 +1,364 @@
+"""Shared test fixtures and helpers."""
+
+import asyncio
+from fnmatch import fnmatchcase
+import json
+from typing import Any, Dict, List, Set
+
+import pytest
+import pytest_asyncio
+
+from aries_cloudagent.connections.models.connection_target import ConnectionTarget
+from aries_cloudagent.transport.outbound.message import OutboundMessage
+
+from acapy_plugin_pickup.queue import (
+    MemoryPickupQueue,
+    RedisPickupQueue,
+    SpillPickupQueue,
+    SqlitePickupQueue,
+    sort_position,
+)
+from acapy_plugin_pickup.queue.resp import RespClient, RespError, read_reply
+
+
+def message(
+    key: str, tag: str = None, ciphertext: str = "abc", **kwargs
+) -> OutboundMessage:
+    """Return a message for key, encrypted unless tag is None."""
+    return OutboundMessage(
+        payload="{}",
+        enc_payload=json.dumps({"ciphertext": ciphertext, "tag": tag}) if tag else None,
+        reply_to_verkey=key,
+        target_list=[ConnectionTarget(recipient_keys=[key])],
+        **kwargs,
+    )
+
+
+def replied(tag: str = None) -> OutboundMessage:
+    """Return a message for "key" with reply fields of its own."""
+    return OutboundMessage(
+        payload="{}",
+        enc_payload=json.dumps({"ciphertext": "abc", "tag": tag}) if tag else None,
+        reply_to_verkey="sender",
+        reply_thread_id="thread",
+        target=ConnectionTarget(recipient_keys=["key"]),
+    )
+
+
+async def tags(queue, key: str, limit: int = None) -> List[str]:
+    return [queued.tag async for queued in queue.messages_for_key(key, limit)]
+
+
+async def list_all(queue, order: str, limit: int) -> List[str]:
+    listed, after = [], None
+    while True:
+        page = await queue.list_keys(order, limit, after)
+        listed.extend(key for key, _ in page)
+        if len(page) < limit:
+            return listed
+        after = sort_position(order, *page[-1])
+
+
+def fill_keys(queue):
+    # keyN has N + 1 messages, the first received at 100 - N
+    for n in range(7):
+        for i in range(n + 1):
+            queue._add(message(f"key{n}", f"{n}-{i}"), 100 - n + i)
+    for key in ("tie-a", "tie-b"):
+        queue._add(message(key, key), 200)
+
+
+DEPTH_ORDER = [f"key{n}" for n in range(6, 0, -1)] + ["tie-b", "tie-a", "key0"]
+AGE_ORDER = [f"key{n}" for n in range(6, -1, -1)] + ["tie-a", "tie-b"]
+
+
+class RespStandIn:
+    """In-process server speaking enough of the Redis protocol for the queue."""
+
+    def __init__(self):
+        self.data: Dict[bytes, Any] = {}
+        self.subscribers: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+        self.server = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.sockets[0].getsockname()[:2]
+        return f"redis://{host}:{port}/0"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        transaction = None
+        try:
+            while True:
+                command = await read_reply(reader)
+                name = command[0].upper()
+                if name == b"MULTI":
+                    transaction, reply = [], "OK"
+                elif name == b"EXEC":
+                    reply = [self._dispatch(queued) for queued in transaction]
+                    transaction = None
+                elif transaction is not None:
+                    transaction.append(command)
+                    reply = "QUEUED"
+                elif name == b"SUBSCRIBE":
+                    reply = []
+                    for channel in command[1:]:
+                        self.subscribers.setdefault(channel, set()).add(writer)
+                        reply.append([b"subscribe", channel, 1])
+                    writer.write(b"".join(self._encode(r) for r in reply))
+                    await writer.drain()
+                    continue
+                else:
+                    reply = self._dispatch(command)
+                writer.write(self._encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+        finally:
+            for writers in self.subscribers.values():
+                writers.discard(writer)
+
+    def _encode(self, reply) -> bytes:
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, RespError):
+            return b"-%s\r\n" % str(reply).encode()
+        if isinstance(reply, str):
+            return b"+%s\r\n" % reply.encode()
+        if isinstance(reply, int):
+            return b":%d\r\n" % reply
+        if isinstance(reply, bytes):
+            return b"$%d\r\n%s\r\n" % (len(reply), reply)
+        return b"*%d\r\n" % len(reply) + b"".join(self._encode(r) for r in reply)
+
+    def _dispatch(self, command: List[bytes]):
+        name, *args = command
+        handler = getattr(self, f"cmd_{name.decode().lower()}", None)
+        if handler is None:
+            return RespError(f"ERR unknown command '{name.decode()}'")
+        return handler(*args)
+
+    def _hash(self, key) -> Dict[bytes, bytes]:
+        return self.data.setdefault(key, {})
+
+    def _zset(self, key) -> Dict[bytes, float]:
+        return self.data.setdefault(key, {})
+
+    def _cleanup(self, key):
+        if key in self.data and not self.data[key]:
+            del self.data[key]
+
+    def cmd_publish(self, channel, message):
+        writers = self.subscribers.get(channel, ())
+        for writer in writers:
+            writer.write(self._encode([b"message", channel, message]))
+        return len(writers)
+
+    def cmd_ping(self):
+        return "PONG"
+
+    def cmd_select(self, db):
+        return "OK"
+
+    def cmd_incrby(self, key, amount):
+        value = int(self.data.get(key, 0)) + int(amount)
+        self.data[key] = str(value).encode()
+        return value
+
+    def cmd_decrby(self, key, amount):
+        return self.cmd_incrby(key, -int(amount))
+
+    def cmd_expire(self, key, seconds):
+        # Keys are not expired by the stand-in
+        return int(key in self.data)
+
+    def cmd_set(self, key, value, *options):
+        # Keys are not expired by the stand-in, so options are ignored
+        self.data[key] = value
+        return "OK"
+
+    def cmd_get(self, key):
+        return self.data.get(key)
+
+    def cmd_del(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def cmd_hset(self, key, *pairs):
+        values = self._hash(key)
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in values
+            values[field] = value
+        return added
+
+    def cmd_hmget(self, key, *fields):
+        values = self.data.get(key, {})
+        return [values.get(field) for field in fields]
+
+    def cmd_hsetnx(self, key, field, value):
+        values = self._hash(key)
+        if field in values:
+            return 0
+        values[field] = value
+        return 1
+
+    def cmd_hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def cmd_hincrby(self, key, field, amount):
+        values = self._hash(key)
+        value = int(values.get(field, 0)) + int(amount)
+        values[field] = str(value).encode()
+        return value
+
+    def cmd_hdel(self, key, *fields):
+        values = self.data.get(key, {})
+        removed = sum(values.pop(field, None) is not None for field in fields)
+        self._cleanup(key)
+        return removed
+
+    def cmd_zadd(self, key, *args):
+        members = self._zset(key)
+        flags = set()
+        while args[0].upper() in (b"NX", b"XX"):
+            flags.add(args[0].upper())
+            args = args[1:]
+        added = 0
+        for score, member in zip(args[::2], args[1::2]):
+            exists = member in members
+            if (b"NX" in flags and exists) or (b"XX" in flags and not exists):
+                continue
+            added += not exists
+            members[member] = float(score)
+        self._cleanup(key)
+        return added
+
+    def cmd_zincrby(self, key, amount, member):
+        members = self._zset(key)
+        members[member] = members.get(member, 0.0) + float(amount)
+        return repr(members[member]).encode()
+
+    def cmd_zscore(self, key, member):
+        score = self.data.get(key, {}).get(member)
+        return None if score is None else repr(score).encode()
+
+    def cmd_zrem(self, key, *members):
+        values = self.data.get(key, {})
+        removed = sum(values.pop(member, None) is not None for member in members)
+        self._cleanup(key)
+        return removed
+
+    def cmd_scan(self, cursor, *options):
+        # The whole keyspace fits in one page
+        pattern = b"*"
+        for option, value in zip(options[::2], options[1::2]):
+            if option.upper() == b"MATCH":
+                pattern = value
+        keys = [key for key in self.data if fnmatchcase(key, pattern)]
+        return [b"0", keys]
+
+    def cmd_zcard(self, key):
+        return len(self.data.get(key, {}))
+
+    def _ordered(self, key, reverse=False):
+        members = self.data.get(key, {}).items()
+        return sorted(((s, m) for m, s in members), reverse=reverse)
+
+    def _range(self, key, start, stop, options, reverse=False):
+        ordered = self._ordered(key, reverse)
+        start, stop = int(start), int(stop)
+        stop = len(ordered) + stop + 1 if stop < 0 else stop + 1
+        start = max(len(ordered) + start if start < 0 else start, 0)
+        return self._reply(ordered[start:stop], options)
+
+    def _reply(self, ordered, options):
+        options = [option.upper() for option in options]
+        if b"LIMIT" in options:
+            index = options.index(b"LIMIT")
+            offset, count = int(options[index + 1]), int(options[index + 2])
+            end = None if count < 0 else offset + count
+            ordered = ordered[offset:end]
+        if b"WITHSCORES" in options:
+            return [x for s, m in ordered for x in (m, repr(s).encode())]
+        return [member for _, member in ordered]
+
+    def cmd_zrange(self, key, start, stop, *options):
+        return self._range(key, start, stop, options)
+
+    def cmd_zrevrange(self, key, start, stop, *options):
+        return self._range(key, start, stop, options, reverse=True)
+
+    def cmd_zrank(self, key, member, reverse=False):
+        if member not in self.data.get(key, {}):
+            return None
+        return [m for _, m in self._ordered(key, reverse)].index(member)
+
+    def cmd_zrevrank(self, key, member):
+        return self.cmd_zrank(key, member, reverse=True)
+
+    def _by_score(self, key, low, high, options, reverse=False):
+        def bound(value: bytes):
+            exclusive = value.startswith(b"(")
+            return float(value.lstrip(b"(")), exclusive
+
+        (low, low_excl), (high, high_excl) = bound(low), bound(high)
+        ordered = [
+            (score, member)
+            for score, member in self._ordered(key, reverse)
+            if (score > low if low_excl else score >= low)
+            and (score < high if high_excl else score <= high)
+        ]
+        return self._reply(ordered, options)
+
+    def cmd_zrangebyscore(self, key, low, high, *options):
+        return self._by_score(key, low, high, options)
+
+    def cmd_zrevrangebyscore(self, key, high, low, *options):
+        return self._by_score(key, low, high, options, reverse=True)
+
+    def cmd_zremrangebyscore(self, key, low, high):
+        return self.cmd_zrem(key, *self._by_score(key, low, high, ()))
+
+
+@pytest_asyncio.fixture
+async def resp_server():
+    server = RespStandIn()
+    await server.start()
+    yield server
+    await server.stop()
+
+
+@pytest_asyncio.fixture(params=["memory", "spill", "sqlite", "redis"])
+async def make_queue(request, tmp_path, resp_server):
+    """Return a factory of queues of each backend, closed after the test."""
+    queues = []
+
+    def make(**kwargs):
+        if request.param == "memory":
+            queue = MemoryPickupQueue(**kwargs)
+        elif request.param == "spill":
+            # Small enough a budget that most payloads are spilled
+            directory = str(tmp_path / f"spill{len(queues)}")
+            queue = SpillPickupQueue(directory, memory_bytes=100, **kwargs)
+        elif request.param == "sqlite":
+            queue = SqlitePickupQueue(**kwargs)
+        else:
+            client = RespClient.from_url(resp_server.url)
+            queue = RedisPickupQueue(client, page_size=2, **kwargs)
+        queues.append(queue)
+        return queue
+
+    yield make
+    for queue in queues:
+        await queue.close()
+
+
+@pytest.fixture
+def queue(make_queue):
+    return make_queue()
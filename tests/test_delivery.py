@@ -0,0 +1,257 @@
+"""Test building deliveries from queued messages."""
+
+import json
+import time
+
+import pytest
+
+from aries_cloudagent.core.in_memory import InMemoryProfile
+from aries_cloudagent.messaging.request_context import RequestContext
+from aries_cloudagent.messaging.responder import BaseResponder, MockResponder
+from aries_cloudagent.transport.inbound.manager import InboundTransportManager
+from aries_cloudagent.transport.inbound.receipt import MessageReceipt
+from aries_cloudagent.transport.inbound.session import InboundSession
+from aries_cloudagent.transport.wire_format import BaseWireFormat
+
+from acapy_plugin_pickup.acapy import Attach
+from acapy_plugin_pickup.config import PickupConfig
+from acapy_plugin_pickup.queue import MemoryPickupQueue
+from acapy_plugin_pickup.v2_0.delivery import (
+    DELIVERY_OVERHEAD,
+    Delivery,
+    DeliveryRequest,
+    MessagesReceived,
+    attachment_size,
+    delivery_attachments,
+)
+from acapy_plugin_pickup.v2_0.status import Status
+
+from conftest import message
+
+TRANSPORT = {"~transport": {"return_route": "all"}}
+
+
+async def deliver(queue, key, **kwargs):
+    return [
+        (queued, attachment)
+        async for queued, attachment in delivery_attachments(
+            queue, key, None, None, **kwargs
+        )
+    ]
+
+
+async def handle(queue, message, config: PickupConfig = None) -> MockResponder:
+    profile = InMemoryProfile.test_profile(bind={BaseWireFormat: BaseWireFormat()})
+    if config:
+        profile.context.injector.bind_instance(PickupConfig, config)
+    manager = InboundTransportManager(profile, None)
+    manager.undelivered_queue = queue
+    manager.sessions["session"] = InboundSession(
+        profile=profile,
+        inbound_handler=None,
+        session_id="session",
+        wire_format=None,
+        reply_mode="all",
+        reply_verkeys=["key"],
+    )
+    context = RequestContext(profile)
+    context.injector.bind_instance(InboundTransportManager, manager)
+    context.message_receipt = MessageReceipt(sender_verkey="key")
+    context.message = message
+    responder = MockResponder()
+    BaseResponder.__init__(responder, reply_to_verkey="key")
+    await message.handle(context, responder)
+    return responder
+
+
+@pytest.mark.asyncio
+async def test_attachment_size_is_exact():
+    queue = MemoryPickupQueue()
+    for size in range(1, 8):
+        queue.add_message(message("key", f"tag{size}", "x" * size))
+    for queued, attachment in await deliver(queue, "key"):
+        one = Delivery(message_attachments=[attachment]).to_json()
+        two = Delivery(message_attachments=[attachment, attachment]).to_json()
+        assert len(two) - len(one) == attachment_size(queued)
+
+
+@pytest.mark.asyncio
+async def test_delivery_within_byte_budget():
+    queue = MemoryPickupQueue()
+    for i in range(10):
+        queue.add_message(message("key", f"tag{i}", "x" * 1000))
+    queued = next(queue.queued_messages_for_key("key"))
+    budget = DELIVERY_OVERHEAD + 3 * attachment_size(queued)
+
+    delivered = await deliver(queue, "key", limit=5, max_bytes=budget)
+    assert [queued.tag for queued, _ in delivered] == ["tag0", "tag1", "tag2"]
+    delivery = Delivery(message_attachments=[attachment for _, attachment in delivered])
+    assert len(delivery.to_json()) <= budget
+    # The attachment of the first message over budget is not built
+    assert [
+        queued._b64_payload is None for queued in queue.queued_messages_for_key("key")
+    ] == [False] * 3 + [True] * 7
+
+    assert len(await deliver(queue, "key", limit=2, max_bytes=budget)) == 2
+
+    # A message larger than the budget is still delivered, alone
+    assert len(await deliver(queue, "key", max_bytes=100)) == 1
+
+
+@pytest.mark.asyncio
+async def test_delivery_serialized_as_validated():
+    queue = MemoryPickupQueue()
+    for i in range(3):
+        queue.add_message(message("key", f"tag{i}", "x" * 100))
+    attachments = [attachment for _, attachment in await deliver(queue, "key")]
+    delivery = Delivery.of_attachments(attachments)
+    delivery.assign_thread_id("thread")
+
+    validated = Delivery(
+        id=delivery.id,
+        message_attachments=[
+            Attach.data_base64(ident=queued.tag, value=queued.enc_payload)
+            for queued in queue.queued_messages_for_key("key")
+        ],
+    )
+    validated.assign_thread_id("thread")
+    assert delivery.serialize() == validated.dict(exclude_none=True, by_alias=True)
+    assert delivery.to_json() == validated.json()
+
+    # Attachments joined in directly or serialized give the same JSON
+    delivery.recipient_key = validated.recipient_key = "key"
+    delivery.last_sequence = validated.last_sequence = 3
+    assert delivery.to_json() == validated.to_json()
+    mixed = Delivery.of_attachments(
+        [*attachments[:2], validated.message_attachments[2]]
+    )
+    mixed.id, mixed.recipient_key, mixed.last_sequence = delivery.id, "key", 3
+    mixed.assign_thread_id("thread")
+    assert mixed.to_json() == delivery.to_json()
+    assert Delivery.deserialize(json.loads(delivery.to_json())) == validated
+    assert validated.to_json() == validated.json()
+
+    responder = MockResponder()
+    BaseResponder.__init__(responder, reply_session_id="session", reply_to_verkey="key")
+    await delivery.send_reply(responder)
+    ((outbound, _),) = responder.messages
+    assert outbound.payload == delivery.to_json()
+    assert outbound.reply_thread_id == "thread"
+    assert outbound.reply_session_id == "session"
+    assert outbound.reply_to_verkey == "key"
+
+    # The responder makes the same reply of the validated message
+    expected = await responder.create_outbound(
+        validated, reply_session_id="session", reply_to_verkey="key"
+    )
+    assert json.loads(expected.payload) == json.loads(outbound.payload)
+    expected.payload = outbound.payload
+    assert vars(expected) == vars(outbound)
+
+
+@pytest.mark.asyncio
+async def test_leased_messages_are_skipped():
+    queue = MemoryPickupQueue()
+    for i in range(6):
+        queue.add_message(message("key", f"tag{i}", "x" * 10))
+    first = await deliver(queue, "key", limit=2)
+    assert await queue.lease("key", [queued.seq for queued, _ in first], 60) == [
+        queued.seq for queued, _ in first
+    ]
+
+    leased = await queue.leased("key")
+    delivered = await deliver(queue, "key", limit=3, leased=leased)
+    assert [queued.tag for queued, _ in delivered] == ["tag2", "tag3", "tag4"]
+    # Leased by another delivery meanwhile, so not leased again
+    seqs = [queued.seq for queued, _ in first + delivered]
+    assert await queue.lease("key", seqs, 60) == seqs[2:]
+
+
+@pytest.mark.asyncio
+async def test_acknowledge_by_sequence_and_delivery():
+    queue = MemoryPickupQueue()
+    for i in range(5):
+        queue.add_message(message("key", f"tag{i}", "x" * 10))
+
+    request = DeliveryRequest.deserialize({"limit": 2, **TRANSPORT})
+    ((outbound, _),) = (await handle(queue, request)).messages
+    first = json.loads(outbound.payload)
+    ((outbound, _),) = (await handle(queue, request)).messages
+    assert json.loads(outbound.payload)["last_sequence"] == first["last_sequence"]
+
+    ack = MessagesReceived.deserialize(
+        {"up_to_sequence": first["last_sequence"], **TRANSPORT}
+    )
+    ((status, _),) = (await handle(queue, ack)).messages
+    assert isinstance(status, Status)
+    assert status.message_count == 3
+
+    ((outbound, _),) = (await handle(queue, request)).messages
+    second = json.loads(outbound.payload)
+    assert [attach["@id"] for attach in second["~attach"]] == ["tag2", "tag3"]
+    ack = MessagesReceived.deserialize(
+        {"delivery_id": second["@id"], "message_id_list": ["tag4"], **TRANSPORT}
+    )
+    ((status, _),) = (await handle(queue, ack)).messages
+    assert status.message_count == 0
+
+
+@pytest.mark.asyncio
+async def test_config_bound_at_startup():
+    queue = MemoryPickupQueue()
+    for i in range(4):
+        queue.add_message(message("key", f"tag{i}", "x" * 10))
+    config = PickupConfig(lease_timeout=60)
+
+    # Leasing is configured by the configuration bound rather than settings
+    request = DeliveryRequest.deserialize({"limit": 2, **TRANSPORT})
+    tags = []
+    for _ in range(2):
+        ((outbound, _),) = (await handle(queue, request, config)).messages
+        tags += [attach["@id"] for attach in json.loads(outbound.payload)["~attach"]]
+    assert tags == ["tag0", "tag1", "tag2", "tag3"]
+
+
+@pytest.mark.asyncio
+async def test_wait_honoured_while_all_leased():
+    queue = MemoryPickupQueue()
+    queue.add_message(message("key", "tag", "x" * 10))
+    config = PickupConfig(lease_timeout=60)
+    request = DeliveryRequest.deserialize({"limit": 10, **TRANSPORT})
+    ((outbound, _),) = (await handle(queue, request, config)).messages
+    assert json.loads(outbound.payload)["~attach"]
+
+    # Its only message is leased, so a long poll waits rather than answering
+    # at once with a status
+    request = DeliveryRequest.deserialize(
+        {"limit": 10, "wait_timeout": 0.2, **TRANSPORT}
+    )
+    started = time.monotonic()
+    ((status, _),) = (await handle(queue, request, config)).messages
+    assert time.monotonic() - started >= 0.2
+    assert isinstance(status, Status)
+    assert status.message_count == 1
+
+
+@pytest.mark.asyncio
+async def test_ack_through_sequence_keeps_leases_of_others():
+    queue = MemoryPickupQueue()
+    for i in range(3):
+        queue.add_message(message("key", f"tag{i}", "x" * 10))
+    config = PickupConfig(lease_timeout=60)
+    seqs = [queued.seq async for queued in queue.messages_for_key("key")]
+    # Delivered to another sender for the same key, not yet acknowledged
+    await queue.lease("key", seqs[:1], 60, owner="other")
+
+    request = DeliveryRequest.deserialize({"limit": 10, **TRANSPORT})
+    ((outbound, _),) = (await handle(queue, request, config)).messages
+    delivery = json.loads(outbound.payload)
+    assert [attach["@id"] for attach in delivery["~attach"]] == ["tag1", "tag2"]
+
+    ack = MessagesReceived.deserialize(
+        {"up_to_sequence": delivery["last_sequence"], **TRANSPORT}
+    )
+    ((status, _),) = (await handle(queue, ack, config)).messages
+    assert status.message_count == 1
+    assert queue.message_count_for_key("key") == 1
+    assert [queued.seq async for queued in queue.messages_for_key("key")] == seqs[:1]
@@ -0,0 +1,87 @@
+"""Test background encoding of plaintext queued messages."""
+
+import asyncio
+import json
+
+import pytest
+
+from aries_cloudagent.connections.models.connection_target import ConnectionTarget
+from aries_cloudagent.core.in_memory import InMemoryProfile
+from aries_cloudagent.transport.outbound.message import OutboundMessage
+from aries_cloudagent.transport.wire_format import BaseWireFormat
+
+from acapy_plugin_pickup.encoder import PayloadEncoder
+from acapy_plugin_pickup.queue import MemoryPickupQueue
+
+
+class SlowWireFormat(BaseWireFormat):
+    """Wire format taking a while to encrypt, tracking concurrent encryptions."""
+
+    def __init__(self):
+        super().__init__()
+        self.encoded = 0
+        self.active = 0
+        self.max_active = 0
+
+    async def encode_message(self, session, message_json, *args):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        self.encoded += 1
+        return json.dumps({"ciphertext": message_json, "tag": f"tag{self.encoded}"})
+
+
+def plaintext(key: str) -> OutboundMessage:
+    return OutboundMessage(
+        payload="{}",
+        reply_to_verkey=key,
+        target_list=[ConnectionTarget(recipient_keys=[key], sender_key="mediator")],
+    )
+
+
+@pytest.fixture
+def wire_format():
+    return SlowWireFormat()
+
+
+@pytest.fixture
+def encoder(wire_format):
+    profile = InMemoryProfile.test_profile(bind={BaseWireFormat: wire_format})
+    return PayloadEncoder(MemoryPickupQueue(), profile, concurrency=3)
+
+
+async def settle(encoder: PayloadEncoder):
+    await asyncio.sleep(0)
+    while encoder.backlog or encoder.pending_keys or encoder._scanning:
+        await asyncio.sleep(0.005)
+
+
+@pytest.mark.asyncio
+async def test_encodes_queued_messages_concurrently(encoder, wire_format):
+    encoder.start()
+    for key in ("a", "b"):
+        for _ in range(6):
+            encoder.queue.add_message(plaintext(key))
+    await settle(encoder)
+
+    assert wire_format.encoded == 12
+    assert wire_format.max_active == 3
+    assert encoder.metrics.encoded == 12
+    assert encoder.metrics.encode_seconds >= 12 * 0.01
+    tags = {queued.tag for queued in encoder.queue.queued_messages_for_key("a")}
+    assert len(tags) == 6 and None not in tags
+    await encoder.close()
+
+
+@pytest.mark.asyncio
+async def test_delivery_shares_encoding_in_progress(encoder, wire_format):
+    encoder.queue.add_message(plaintext("a"))
+    (queued,) = encoder.queue.queued_messages_for_key("a")
+
+    await asyncio.gather(encoder.encode("a", queued), encoder.encode("a", queued))
+    assert wire_format.encoded == 1
+    assert queued.tag == "tag1"
+
+    await encoder.encode("a", queued)
+    assert wire_format.encoded == 1
@@ -0,0 +1,106 @@
+"""Test forward messages turned away over the queue caps."""
+
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from aries_cloudagent.connections.models.connection_target import ConnectionTarget
+from aries_cloudagent.core.in_memory import InMemoryProfile
+from aries_cloudagent.messaging.request_context import RequestContext
+from aries_cloudagent.messaging.responder import MockResponder
+from aries_cloudagent.protocols.coordinate_mediation.v1_0.route_manager import (
+    RouteManager,
+)
+from aries_cloudagent.protocols.problem_report.v1_0.message import ProblemReport
+from aries_cloudagent.transport.inbound.manager import InboundTransportManager
+from aries_cloudagent.transport.inbound.receipt import MessageReceipt
+from aries_cloudagent.transport.inbound.session import InboundSession
+
+from acapy_plugin_pickup import forward
+from acapy_plugin_pickup.config import LimitsConfig
+from acapy_plugin_pickup.queue import MemoryPickupQueue
+
+from conftest import message
+
+PACKED = {"protected": "abc", "ciphertext": "def", "tag": "ghi"}
+
+
+@pytest.fixture
+def routed(monkeypatch):
+    target = ConnectionTarget(recipient_keys=["recipient"])
+
+    async def get_recipient(self, to):
+        return SimpleNamespace(connection_id="conn")
+
+    async def get_connection_targets(self, connection_id):
+        return [target]
+
+    monkeypatch.setattr(forward.RoutingManager, "get_recipient", get_recipient)
+    monkeypatch.setattr(
+        forward.ConnectionManager, "get_connection_targets", get_connection_targets
+    )
+    return target
+
+
+async def handle_forward(queue, session: bool = False) -> MockResponder:
+    # Connection targets are stubbed; the route manager is only constructed
+    profile = InMemoryProfile.test_profile(bind={RouteManager: SimpleNamespace()})
+    manager = InboundTransportManager(profile, None)
+    manager.undelivered_queue = queue
+    if session:
+        manager.sessions["ws"] = InboundSession(
+            profile=profile,
+            inbound_handler=None,
+            session_id="ws",
+            wire_format=None,
+            reply_verkeys=["recipient"],
+        )
+    context = RequestContext(profile)
+    context.injector.bind_instance(InboundTransportManager, manager)
+    context.message_receipt = MessageReceipt(recipient_verkey="mediator")
+    context.message = forward.CappedForward(to="routing-key", msg=PACKED)
+    responder = MockResponder()
+    await context.message.Handler().handle(context, responder)
+    return responder
+
+
+@pytest.mark.asyncio
+async def test_forward_within_caps(routed):
+    queue = MemoryPickupQueue(LimitsConfig(max_messages_per_key=2, policy="reject-new"))
+    queue.add_message(message("recipient", "a"))
+    responder = await handle_forward(queue)
+    ((sent, options),) = responder.messages
+    assert json.loads(sent) == PACKED
+    assert options["reply_to_verkey"] == "recipient"
+    assert queue.rejected == 0
+
+
+@pytest.mark.asyncio
+async def test_forward_over_caps(routed):
+    queue = MemoryPickupQueue(
+        LimitsConfig(max_bytes_per_key=len(json.dumps(PACKED)), policy="reject-new")
+    )
+    queue.add_message(message("recipient", "a"))
+    responder = await handle_forward(queue)
+    ((report, _),) = responder.messages
+    assert isinstance(report, ProblemReport)
+    assert report.description["code"] == "e.m.recipient-over-quota"
+    assert queue.rejected == 1
+    assert await queue.take_dropped("recipient") == (0, 1)
+    assert queue.message_count_for_key("recipient") == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("delivered", ["endpoint", "session"])
+async def test_forward_not_queued_skips_caps(routed, delivered):
+    queue = MemoryPickupQueue(LimitsConfig(max_messages_per_key=1, policy="reject-new"))
+    queue.add_message(message("recipient", "a"))
+    if delivered == "endpoint":
+        routed.endpoint = "http://recipient"
+    responder = await handle_forward(queue, session=delivered == "session")
+
+    # Forwards sent rather than queued are left to ACA-Py whatever the caps
+    ((sent, _),) = responder.messages
+    assert json.loads(sent) == PACKED
+    assert queue.rejected == 0
@@ -0,0 +1,173 @@
+"""Test pickup requests naming the recipient key they are about."""
+
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from aries_cloudagent.connections.models.connection_target import ConnectionTarget
+from aries_cloudagent.core.event_bus import Event
+from aries_cloudagent.core.in_memory import InMemoryProfile
+from aries_cloudagent.messaging.request_context import RequestContext
+from aries_cloudagent.messaging.responder import BaseResponder, MockResponder
+from aries_cloudagent.protocols.problem_report.v1_0.message import ProblemReport
+from aries_cloudagent.transport.inbound.manager import InboundTransportManager
+from aries_cloudagent.transport.inbound.receipt import MessageReceipt
+from aries_cloudagent.transport.inbound.session import InboundSession
+from aries_cloudagent.transport.wire_format import BaseWireFormat
+
+from acapy_plugin_pickup import keys
+from acapy_plugin_pickup.keys import RecipientKeyIndex
+from acapy_plugin_pickup.queue import MemoryPickupQueue
+from acapy_plugin_pickup.v2_0.delivery import DeliveryRequest, MessagesReceived
+from acapy_plugin_pickup.v2_0.status import Status, StatusRequest
+
+from conftest import message
+
+TRANSPORT = {"~transport": {"return_route": "all"}}
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """Serve the connection "conn" owning "sender" and routing key "routed"."""
+    reads = []
+
+    async def get_connection_targets(self, connection_id):
+        reads.append(connection_id)
+        return [ConnectionTarget(recipient_keys=["sender"])]
+
+    async def get_routes(self, client_connection_id):
+        return [SimpleNamespace(recipient_key="routed")]
+
+    monkeypatch.setattr(keys.ConnectionManager, "__init__", lambda self, profile: None)
+    monkeypatch.setattr(
+        keys.ConnectionManager, "get_connection_targets", get_connection_targets
+    )
+    monkeypatch.setattr(keys.RoutingManager, "get_routes", get_routes)
+    return reads
+
+
+async def handle(queue, message, profile=None) -> MockResponder:
+    profile = profile or InMemoryProfile.test_profile(
+        bind={BaseWireFormat: BaseWireFormat()}
+    )
+    manager = InboundTransportManager(profile, None)
+    manager.undelivered_queue = queue
+    manager.sessions["session"] = InboundSession(
+        profile=profile,
+        inbound_handler=None,
+        session_id="session",
+        wire_format=None,
+        reply_mode="all",
+        reply_verkeys=["sender"],
+    )
+    context = RequestContext(profile)
+    context.injector.bind_instance(InboundTransportManager, manager)
+    context.connection_record = SimpleNamespace(connection_id="conn")
+    context.message_receipt = MessageReceipt(
+        sender_verkey="sender", recipient_verkey="mediator"
+    )
+    context.message = message
+    responder = MockResponder()
+    BaseResponder.__init__(responder, reply_to_verkey="sender")
+    await message.handle(context, responder)
+    return responder
+
+
+@pytest.mark.asyncio
+async def test_index_reads_keys_once(reads):
+    index = RecipientKeyIndex()
+    profile = InMemoryProfile.test_profile()
+    assert await index.owns(profile, "conn", "routed")
+    assert await index.owns(profile, "conn", "sender")
+    assert reads == ["conn"]
+
+    # A key not found is looked up again, at most once per miss interval
+    assert not await index.owns(profile, "conn", "other")
+    assert not await index.owns(profile, "conn", "other")
+    assert reads == ["conn"]
+    index.miss_interval = 0
+    assert not await index.owns(profile, "conn", "other")
+    assert reads == ["conn", "conn"]
+
+    await index.on_connection_event(
+        profile, Event("acapy::record::connections::active", {"connection_id": "conn"})
+    )
+    assert "conn" not in index.keys_by_connection
+
+
+@pytest.mark.asyncio
+async def test_index_bounded(reads):
+    index = RecipientKeyIndex(max_connections=2)
+    profile = InMemoryProfile.test_profile()
+    for connection_id in ("a", "b", "a", "c"):
+        await index.owns(profile, connection_id, "sender")
+    # The connection used least recently is dropped
+    assert list(index.keys_by_connection) == ["a", "c"]
+
+    # Connections unused for a refresh interval are dropped as others are read
+    index.refresh_interval = 0
+    await index.owns(profile, "d", "sender")
+    assert list(index.keys_by_connection) == []
+
+    # A deleted connection is dropped
+    index.refresh_interval = 60
+    await index.owns(profile, "a", "sender")
+    await index.on_connection_event(
+        profile, Event("acapy::record::connections::deleted", {"connection_id": "a"})
+    )
+    assert not index.keys_by_connection
+
+
+@pytest.mark.asyncio
+async def test_index_bound_once(reads):
+    queue = MemoryPickupQueue()
+    queue.add_message(message("routed", "a"))
+    request = StatusRequest.deserialize({"recipient_key": "routed", **TRANSPORT})
+    profile = InMemoryProfile.test_profile(bind={BaseWireFormat: BaseWireFormat()})
+    for _ in range(2):
+        ((status, _),) = (await handle(queue, request, profile)).messages
+        assert status.message_count == 1
+    # Without an index bound at startup, requests share the one bound on first use
+    assert reads == ["conn"]
+
+
+@pytest.mark.asyncio
+async def test_delivery_for_recipient_key(reads):
+    queue = MemoryPickupQueue()
+    for key, tag in (("sender", "own"), ("routed", "a"), ("routed", "b")):
+        queue.add_message(message(key, tag))
+
+    request = DeliveryRequest.deserialize(
+        {"limit": 10, "recipient_key": "routed", **TRANSPORT}
+    )
+    ((outbound, _),) = (await handle(queue, request)).messages
+    delivery = json.loads(outbound.payload)
+    assert delivery["recipient_key"] == "routed"
+    assert [attach["@id"] for attach in delivery["~attach"]] == ["a", "b"]
+
+    ack = MessagesReceived.deserialize(
+        {"message_id_list": ["a", "own"], "recipient_key": "routed", **TRANSPORT}
+    )
+    ((status, _),) = (await handle(queue, ack)).messages
+    assert isinstance(status, Status)
+    assert (status.recipient_key, status.message_count) == ("routed", 1)
+    assert queue.message_count_for_key("sender") == 1
+
+
+@pytest.mark.asyncio
+async def test_key_not_owned_is_rejected(reads):
+    queue = MemoryPickupQueue()
+    queue.add_message(message("other", "a"))
+    for request in (
+        DeliveryRequest.deserialize(
+            {"limit": 10, "recipient_key": "other", **TRANSPORT}
+        ),
+        MessagesReceived.deserialize(
+            {"message_id_list": ["a"], "recipient_key": "other", **TRANSPORT}
+        ),
+    ):
+        ((report, _),) = (await handle(queue, request)).messages
+        assert isinstance(report, ProblemReport)
+        assert report.description["code"] == "e.m.recipient-key-not-owned"
+    assert queue.message_count_for_key("other") == 1
@@ -0,0 +1,106 @@
+"""Test live delivery."""
+
+import asyncio
+import json
+
+import pytest
+
+from aries_cloudagent.core.in_memory import InMemoryProfile
+from aries_cloudagent.transport.inbound.session import InboundSession
+
+from acapy_plugin_pickup.queue import MemoryPickupQueue
+from acapy_plugin_pickup.v2_0.live_mode import LiveDelivery
+
+from conftest import message
+
+
+def ws_session(*verkeys: str) -> InboundSession:
+    return InboundSession(
+        profile=InMemoryProfile.test_profile(),
+        inbound_handler=None,
+        session_id="ws",
+        wire_format=None,
+        can_respond=True,
+        reply_mode="all",
+        reply_verkeys=verkeys,
+        transport_type="ws",
+    )
+
+
+async def pushed_tags(live: LiveDelivery, session: InboundSession, key: str):
+    await asyncio.sleep(0)
+    while key in live._pushing:
+        await asyncio.sleep(0.001)
+    if not session.response_buffer:
+        return []
+    delivery = json.loads(session.response_buffer.payload)
+    assert delivery["@type"].endswith("/delivery")
+    session.clear_response()
+    return [attach["@id"] for attach in delivery["~attach"]]
+
+
+@pytest.mark.asyncio
+async def test_push_new_messages():
+    queue = MemoryPickupQueue()
+    live = LiveDelivery(queue)
+    session = ws_session("key")
+    queue.add_message(message("key", "queued"))
+
+    live.enable("key", session, "mediator")
+    assert live.is_live("key")
+    assert await pushed_tags(live, session, "key") == ["queued"]
+
+    queue.add_message(message("key", "a"))
+    queue.add_message(message("key", "b"))
+    queue.add_message(message("other", "c"))
+    assert await pushed_tags(live, session, "key") == ["a", "b"]
+    assert session.response_buffer is None
+
+    # Pushed messages stay queued until acknowledged
+    assert queue.message_count_for_key("key") == 3
+
+    session.close()
+    queue.add_message(message("key", "d"))
+    assert not live.is_live("key")
+    assert await pushed_tags(live, session, "key") == []
+
+
+@pytest.mark.asyncio
+async def test_push_waits_for_session():
+    queue = MemoryPickupQueue()
+    live = LiveDelivery(queue)
+    session = ws_session("key")
+    session.set_response(message("key"))
+
+    live.enable("key", session, "mediator")
+    queue.add_message(message("key", "a"))
+    await asyncio.sleep(0.01)
+    assert "key" in live._pushing
+
+    session.clear_response()
+    assert await pushed_tags(live, session, "key") == ["a"]
+
+    live.disable("key")
+    queue.add_message(message("key", "b"))
+    assert await pushed_tags(live, session, "key") == []
+    await live.close()
+
+
+@pytest.mark.asyncio
+async def test_push_leaves_messages_queued_while_session_busy():
+    queue = MemoryPickupQueue()
+    live = LiveDelivery(queue, send_timeout=0.05)
+    session = ws_session("key")
+    session.set_response(message("key"))
+
+    live.enable("key", session, "mediator")
+    queue.add_message(message("key", "a"))
+    await asyncio.sleep(0.1)
+    assert "key" not in live._pushing
+    assert live.is_live("key")
+
+    # Messages left queued are pushed along with the next one
+    session.clear_response()
+    queue.add_message(message("key", "b"))
+    assert await pushed_tags(live, session, "key") == ["a", "b"]
+    await live.close()
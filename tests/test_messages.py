@@ -2,8 +2,20 @@
 
 import pytest
 import json
-from datetime import datetime
-from acapy_plugin_pickup.v2_0.status import Status
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from aries_cloudagent.messaging.base_handler import BaseHandler
+from dateutil.parser import isoparse
+from pydantic import parse_obj_as
+from acapy_plugin_pickup.acapy import AgentMessage, Attach, AttachData
+from acapy_plugin_pickup.valid import ISODateTime
+from acapy_plugin_pickup.v2_0.delivery import (
+    Delivery,
+    DeliveryRequest,
+    MessagesReceived,
+)
+from acapy_plugin_pickup.v2_0.live_mode import LiveDeliveryChange
+from acapy_plugin_pickup.v2_0.status import Status, StatusRequest
 
 
 def test_create_status():
@@ -26,3 +38,113 @@ def test_create_status():
     serialized = json.loads(status.json())
     assert serialized["newest_time"]
     assert serialized["newest_time"] == now.isoformat()
+
+
+def sample_messages():
+    thread = {"~thread": {"thid": "thread-id"}}
+    transport = {"~transport": {"return_route": "all"}}
+    return [
+        StatusRequest.deserialize({"recipient_key": "key", **transport}),
+        Status.deserialize(
+            {
+                "message_count": 2,
+                "recipient_key": "key",
+                "newest_time": "2023-01-02T03:04:05.123456+00:00",
+                "oldest_time": "2023-01-02T03:04:05Z",
+                "total_size": 2048,
+                "live_mode": False,
+                **thread,
+            }
+        ),
+        DeliveryRequest.deserialize({"limit": 10, "max_bytes": 4096, **transport}),
+        Delivery(
+            message_attachments=[
+                Attach.data_base64(
+                    {"ciphertext": "abc"}, ident="tag", description="message"
+                ),
+                Attach(
+                    ident="json",
+                    mime_type="application/json",
+                    lastmod_time=datetime(2023, 1, 2, tzinfo=timezone.utc),
+                    data=AttachData(json_={"a": [1, None]}),
+                ),
+            ],
+            **thread,
+        ),
+        MessagesReceived.deserialize({"message_id_list": ["a", "b"], **transport}),
+        LiveDeliveryChange.deserialize({"live_delivery": True, **transport}),
+    ]
+
+
+@pytest.mark.parametrize("msg", sample_messages(), ids=lambda msg: msg.type)
+def test_serialization_matches_pydantic(msg):
+    serialized = msg.serialize()
+    assert serialized == msg.dict(exclude_none=True, by_alias=True)
+    assert list(serialized) == list(msg.dict(exclude_none=True, by_alias=True))
+    assert msg.to_json() == msg.json()
+    loaded = json.loads(msg.to_json())
+    assert type(msg).deserialize(loaded) == msg
+    assert type(msg).deserialize(loaded) == parse_obj_as(type(msg), loaded)
+
+
+@pytest.mark.parametrize(
+    "value",
+    [
+        "2023-01-02",
+        "2023-01-02T03:04",
+        "2023-01-02T03:04:05.123+05:30",
+        "2023-01-02T03:04:05Z",
+        "20230102T030405",
+        "2023-01-02T24:00:00",
+    ],
+)
+def test_iso_datetime_parsed_as_by_dateutil(value):
+    parsed = ISODateTime.validate(value)
+    assert parsed == isoparse(value)
+    assert parsed.isoformat() == isoparse(value).isoformat()
+
+
+@pytest.mark.parametrize(
+    "value", ["2023-01-02T03:04:05-05:30:15", "2023-01-02T03:04:05 +05:00"]
+)
+def test_iso_datetime_rejected_as_by_dateutil(value):
+    # Accepted by datetime.fromisoformat, but not ISO 8601
+    with pytest.raises(ValueError):
+        isoparse(value)
+    with pytest.raises(ValueError):
+        ISODateTime.validate(value)
+
+
+def test_json_shape():
+    delivery = Delivery(
+        id="delivery",
+        message_attachments=[Attach.data_base64(b"{}", ident="tag")],
+    )
+    delivery.assign_thread_id("thread")
+    # Aliased names, and no fields left unset
+    assert delivery.to_json() == (
+        '{"@id": "delivery", '
+        '"@type": "https://didcomm.org/messagepickup/2.0/delivery", '
+        '"~thread": {"thid": "thread"}, '
+        '"~attach": [{"@id": "tag", "mime-type": "application/json", '
+        '"data": {"base64": "e30="}}]}'
+    )
+    assert delivery.to_json() == delivery.json()
+
+
+@pytest.mark.asyncio
+async def test_handler_created_once_per_message_class():
+    class Echo(AgentMessage):
+        message_type = "https://example.org/test/1.0/echo"
+
+        async def handle(self, context, responder):
+            context.handled = self
+
+    msg = Echo()
+    assert msg.Handler is Echo().Handler
+    assert msg.Handler is not StatusRequest().Handler
+    assert issubclass(msg.Handler, BaseHandler)
+
+    context = SimpleNamespace(message=msg)
+    await msg.Handler().handle(context, None)
+    assert context.handled is msg
@@ -0,0 +1,108 @@
+"""Test the metrics exposed by the plugin."""
+
+from types import SimpleNamespace
+
+import pytest
+
+from acapy_plugin_pickup.config import CompressionConfig
+from acapy_plugin_pickup.metrics import Histogram, PickupMetrics, observed
+from acapy_plugin_pickup.queue import MemoryPickupQueue, SpillPickupQueue
+
+from conftest import message
+
+
+def samples(text: str) -> dict:
+    return dict(
+        line.rsplit(" ", 1) for line in text.splitlines() if not line.startswith("#")
+    )
+
+
+class Handled:
+    @observed("test")
+    async def handle(self, context, responder):
+        if responder == "fail":
+            raise ValueError()
+        return responder
+
+
+def test_histogram_buckets_are_inclusive():
+    histogram = Histogram((1, 10))
+    for value in (0.5, 1, 5, 10, 11):
+        histogram.observe(value)
+    assert histogram.counts == [2, 2, 1]
+    assert (histogram.count, histogram.sum) == (5, 27.5)
+
+
+@pytest.mark.asyncio
+async def test_observed_handler():
+    metrics = PickupMetrics()
+    context = SimpleNamespace(inject_or=lambda cls: metrics)
+    assert await Handled().handle(context, "ok") == "ok"
+    with pytest.raises(ValueError):
+        await Handled().handle(context, "fail")
+
+    handler = metrics.handler("test")
+    assert (handler.requests.value, handler.errors.value) == (2, 1)
+    assert handler.seconds.count == 2
+
+    # Without metrics bound, handling is left as is
+    context = SimpleNamespace(inject_or=lambda cls: None)
+    assert await Handled().handle(context, "ok") == "ok"
+    assert handler.requests.value == 2
+
+
+@pytest.mark.asyncio
+async def test_render():
+    queue = MemoryPickupQueue()
+    for key, tag in (("first", "a"), ("second", "b"), ("second", "c")):
+        queue.add_message(message(key, tag))
+    metrics = PickupMetrics()
+    metrics.handler("delivery").requests.inc()
+    metrics.delivered(queue.queued_messages_for_key("second"))
+    metrics.acked(2)
+
+    text = await metrics.render(queue)
+    assert text.endswith("\n")
+    values = samples(text)
+    assert values['pickup_handler_requests_total{handler="delivery"}'] == "1"
+    assert values["pickup_messages_delivered_total"] == "2"
+    assert values["pickup_bytes_delivered_total"] == str(
+        2 * len(message("key", "a").enc_payload)
+    )
+    assert values["pickup_messages_acked_total"] == "2"
+    assert values['pickup_delivery_age_seconds_bucket{le="+Inf"}'] == "2"
+    assert values["pickup_queue_keys"] == "2"
+    assert values["pickup_queue_messages"] == "3"
+    assert values["pickup_messages_expired_total"] == "0"
+    assert values['pickup_queue_depth_bucket{le="1"}'] == "1"
+    assert values['pickup_queue_depth_bucket{le="5"}'] == "2"
+    assert "pickup_encode_backlog" not in values
+    assert "pickup_compression_ratio" not in values
+    assert "pickup_spill_segments" not in values
+
+
+@pytest.mark.asyncio
+async def test_render_compression():
+    queue = MemoryPickupQueue(compression=CompressionConfig(codec="zlib", min_size=0))
+    queue.add_message(message("key", "a" * 1000))
+    (queued,) = queue.queued_messages_for_key("key")
+    assert queued.b64_payload
+
+    values = samples(await PickupMetrics().render(queue))
+    assert values["pickup_payloads_compressed_total"] == "1"
+    assert float(values["pickup_compression_ratio"]) > 10
+    assert values["pickup_payloads_decompressed_total"] == "1"
+    assert float(values["pickup_compress_seconds_total"]) >= 0
+
+
+@pytest.mark.asyncio
+async def test_render_spill(tmp_path):
+    queue = SpillPickupQueue(str(tmp_path), memory_bytes=0)
+    queue.add_message(message("key", "a"))
+
+    values = samples(await PickupMetrics().render(queue))
+    assert values["pickup_spill_resident_bytes"] == "0"
+    assert values["pickup_payloads_spilled_total"] == "1"
+    assert values["pickup_spill_segments"] == "1"
+    assert values["pickup_spill_bytes"] == values["pickup_spill_segment_bytes"]
+    await queue.close()
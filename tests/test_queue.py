@@ -0,0 +1,459 @@
+"""Test pickup delivery queue."""
+
+import asyncio
+import base64
+import json
+import random
+import time
+import tracemalloc
+
+import pytest
+
+from aries_cloudagent.transport.inbound.delivery_queue import DeliveryQueue
+
+from acapy_plugin_pickup.config import CompressionConfig, LimitsConfig
+from acapy_plugin_pickup.queue import MemoryPickupQueue, payload_tag, sort_position
+from acapy_plugin_pickup.v2_0.status import queue_status
+
+from conftest import (
+    AGE_ORDER,
+    DEPTH_ORDER,
+    fill_keys,
+    list_all,
+    message,
+    replied,
+    tags,
+)
+
+
+def test_remove_by_tag():
+    queue = MemoryPickupQueue()
+    for tag in ("a", "b", "c"):
+        queue.add_message(message("key", tag))
+    queue.add_message(message("other", "a"))
+
+    assert queue.remove_messages_by_tag("key", {"a", "c", "missing"}) == 2
+    assert [msg.enc_payload for msg in queue.queued_messages_for_key("key")] == [
+        json.dumps({"ciphertext": "abc", "tag": "b"}).encode()
+    ]
+    assert queue.message_count_for_key("other") == 1
+
+    assert queue.remove_messages_by_tag("key", {"b"}) == 1
+    assert not queue.has_message_for_key("key")
+    assert "key" not in queue.tags_by_key
+
+
+def test_set_enc_payload_indexes_tag():
+    queue = MemoryPickupQueue()
+    queue.add_message(message("key"))
+    (queued,) = queue.queued_messages_for_key("key")
+    assert queue.remove_messages_by_tag("key", {"late"}) == 0
+    assert queued.msg.target_list
+
+    # The plaintext message is only held until encrypted
+    queue.set_enc_payload(queued, json.dumps({"tag": "late"}))
+    assert queued.plaintext is None
+    assert queued.enc_payload == b'{"tag": "late"}'
+    assert queue.remove_messages_by_tag("key", {"late"}) == 1
+    assert queue.message_count_for_key("key") == 0
+
+
+def test_acapy_queue_interface():
+    queue = MemoryPickupQueue()
+    first, second = message("key", "1"), message("key", "2")
+    queue.add_message(first)
+    queue.add_message(second)
+
+    inspected = list(queue.inspect_all_messages_for_key("key"))
+    assert [msg.enc_payload.decode() for msg in inspected] == [
+        first.enc_payload,
+        second.enc_payload,
+    ]
+    queue.remove_message_for_key("key", inspected[0])
+    assert queue.get_one_message_for_key("key").enc_payload.decode() == (
+        second.enc_payload
+    )
+    assert not queue.has_message_for_key("key")
+
+
+def test_inspected_message_keeps_reply_fields():
+    queue = MemoryPickupQueue()
+    queue.add_message(replied("a"))
+    # Queued for both keys, the message is given back to ACA-Py as queued
+    for key in ("key", "sender"):
+        (msg,) = queue.inspect_all_messages_for_key(key)
+        assert (msg.reply_to_verkey, msg.reply_thread_id) == ("sender", "thread")
+
+
+def test_migrate_from_delivery_queue():
+    original = DeliveryQueue()
+    msg = message("key", "1")
+    original.add_message(msg)
+
+    queue = MemoryPickupQueue()
+    queue.migrate_from(original)
+    (queued,) = queue.queued_messages_for_key("key")
+    assert queued.enc_payload.decode() == msg.enc_payload
+    assert queued.timestamp == original.queue_by_key["key"][0].timestamp
+    assert queue.remove_messages_by_tag("key", ["1"]) == 1
+
+
+def test_payload_tag():
+    assert payload_tag(b'{"ciphertext": "abc", "tag": "dGFn"}') == "dGFn"
+    assert payload_tag('{"tag" :"dGFn", "iv": "aXY"}') == "dGFn"
+    assert payload_tag('{"ciphertext": "abc"}') is None
+    assert payload_tag(None) is None
+
+
+def test_queued_metadata():
+    queue = MemoryPickupQueue()
+    msg = message("key", "1")
+    queue.add_message(msg)
+    (queued,) = queue.queued_messages_for_key("key")
+    assert queued.tag == "1"
+    assert queued.size == len(msg.enc_payload)
+    assert queued.enc_payload == msg.enc_payload.encode()
+    assert queued.plaintext is None and not hasattr(queued, "__dict__")
+    assert queued.received_at.timestamp() == pytest.approx(queued.timestamp)
+
+
+def test_iteration_is_lazy_and_survives_mutation():
+    queue = MemoryPickupQueue()
+    for tag in "abcde":
+        queue.add_message(message("key", tag))
+
+    cursor = queue.queued_messages_for_key("key", limit=3)
+    assert next(cursor).tag == "a"
+    queue.remove_messages_by_tag("key", {"a", "b"})
+    queue.add_message(message("key", "f"))
+    assert [queued.tag for queued in cursor] == ["c", "d"]
+
+    assert [queued.tag for queued in queue.queued_messages_for_key("key")] == [
+        "c",
+        "d",
+        "e",
+        "f",
+    ]
+
+
+def test_limited_iteration_is_flat_in_queue_depth():
+    def cost(depth: int):
+        queue = MemoryPickupQueue()
+        for i in range(depth):
+            queue.add_message(message("key", str(i)))
+        tracemalloc.start()
+        best = float("inf")
+        for _ in range(20):
+            start = time.perf_counter()
+            for _ in queue.queued_messages_for_key("key", limit=10):
+                pass
+            best = min(best, time.perf_counter() - start)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return best, peak
+
+    shallow_time, shallow_peak = cost(100)
+    deep_time, deep_peak = cost(50_000)
+    assert deep_peak <= shallow_peak * 2
+    assert deep_time <= shallow_time * 10
+
+
+@pytest.mark.asyncio
+async def test_waiters_are_woken_by_their_key():
+    queue = MemoryPickupQueue()
+    keys = [f"key{i}" for i in range(2000)]
+    waiters = [
+        asyncio.ensure_future(queue.wait_for_messages(key, timeout=10)) for key in keys
+    ]
+    await asyncio.sleep(0)
+    assert len(queue._events) == len(keys)
+
+    started = time.monotonic()
+    for key in keys[:-1]:
+        queue.add_message(message(key, "tag"))
+    woken = await asyncio.gather(*waiters[:-1])
+    assert all(woken)
+    assert time.monotonic() - started < 1
+    assert not waiters[-1].done()
+
+    assert not await queue.wait_for_messages("other", timeout=0.01)
+    waiters[-1].cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiters[-1]
+    assert not queue._events
+    assert await queue.wait_for_messages(keys[0], timeout=10)
+
+
+@pytest.mark.asyncio
+async def test_list_keys_follows_changes():
+    queue = MemoryPickupQueue()
+    rng = random.Random(7)
+
+    async def check():
+        # Pages read from the sorted lists match sorting all keys
+        stats = [(key, await queue.stats_for_key(key)) for key in queue.queue_by_key]
+        for order in ("depth", "bytes", "age"):
+            expected = [
+                key
+                for key, stats in sorted(
+                    stats,
+                    key=lambda item: sort_position(order, *item),
+                    reverse=order != "age",
+                )
+            ]
+            assert await list_all(queue, order, 3) == expected
+
+    for i in range(300):
+        key = f"key{rng.randrange(20)}"
+        if rng.random() < 0.3:
+            await queue.remove_for_key(key, before=rng.randrange(300))
+        else:
+            queue._add(message(key, f"{i}" if rng.random() < 0.8 else None), i)
+            if rng.random() < 0.2:
+                *_, queued = queue.queued_messages_for_key(key)
+                queue.set_enc_payload(queued, json.dumps({"tag": f"late{i}"}))
+        if i % 25 == 0:
+            await check()
+    await check()
+
+
+# Tests below run against every backend, through the queue fixtures
+
+
+@pytest.mark.asyncio
+async def test_rebuilt_message_keeps_reply_fields(queue):
+    queue.add_message(replied("a"))
+    queue.add_message(replied())
+    for key in ("key", "sender"):
+        async for queued in queue.messages_for_key(key):
+            msg = queued.msg
+            assert (msg.reply_to_verkey, msg.reply_thread_id) == ("sender", "thread")
+
+
+@pytest.mark.asyncio
+async def test_stats_follow_queue(queue):
+    assert await queue.stats_for_key("key") == (0, 0, None, None)
+    for tag in "abc":
+        queue.add_message(message("key", tag))
+    queue.add_message(message("key"))
+    size = len(message("key", "a").enc_payload)
+
+    stats = await queue.stats_for_key("key")
+    assert (stats.count, stats.total_size) == (4, 3 * size + 2)
+    first, *_, plain = [queued async for queued in queue.messages_for_key("key")]
+    assert (stats.oldest, stats.newest) == (first.timestamp, plain.timestamp)
+
+    await queue.store_enc_payload(plain, message("key", "d").enc_payload)
+    assert await queue.remove_by_tags("key", ["a", "c"]) == 2
+    stats = await queue.stats_for_key("key")
+    assert (stats.count, stats.total_size) == (2, 2 * size)
+    assert stats.oldest > first.timestamp
+
+    assert await queue.remove_by_tags("key", ["b", "d"]) == 2
+    assert await queue.stats_for_key("key") == (0, 0, None, None)
+
+
+@pytest.mark.asyncio
+async def test_stats_by_key(queue):
+    for key, tag in (("first", "a"), ("second", "b"), ("second", "c")):
+        queue.add_message(message(key, tag))
+    queue.add_message(message("emptied", "x"))
+    await queue.remove_by_tags("emptied", ["x"])
+
+    stats = {key: stats async for key, stats in queue.stats_by_key()}
+    assert stats == {
+        "first": await queue.stats_for_key("first"),
+        "second": await queue.stats_for_key("second"),
+    }
+    assert stats["second"].count == 2
+
+
+@pytest.mark.asyncio
+async def test_list_keys_and_remove(queue):
+    fill_keys(queue)
+    for limit in (1, 2, 3, 100):
+        assert await list_all(queue, "depth", limit) == DEPTH_ORDER
+        assert await list_all(queue, "bytes", limit) == DEPTH_ORDER
+        assert await list_all(queue, "age", limit) == AGE_ORDER
+    (key, stats), *_ = await queue.list_keys("depth", 1)
+    assert (key, stats) == ("key6", await queue.stats_for_key("key6"))
+
+    assert await queue.remove_for_key("key6", before=97) == 3
+    stats = await queue.stats_for_key("key6")
+    assert (stats.count, stats.oldest) == (4, 97)
+    assert (await list_all(queue, "age", 2))[:4] == ["key5", "key4", "key3", "key6"]
+    assert await queue.remove_for_key("key6") == 4
+    assert await queue.remove_for_key("key6") == 0
+    assert "key6" not in await list_all(queue, "depth", 2)
+    assert "key6" not in await list_all(queue, "age", 2)
+    await queue.remove_by_tags("tie-a", ["tie-a"])
+    assert await list_all(queue, "bytes", 100) == DEPTH_ORDER[1:7] + ["key0"]
+
+
+@pytest.mark.asyncio
+async def test_expire(make_queue):
+    queue = make_queue(limits=LimitsConfig(ttl=10))
+    fill_keys(queue)
+    # Messages received before 97: three of key6, two of key5 and one of key4
+    assert await queue.expire(now=107) == 6
+    assert queue.expired == 6
+    assert (await queue.stats_for_key("key6")).oldest == 97
+    assert await queue.take_dropped("key6") == (3, 0)
+    assert await queue.take_dropped("key6") == (0, 0)
+    assert await queue.expire(now=107) == 0
+
+    status = await queue_status(queue, "key5")
+    assert (status.expired_count, status.evicted_count) == (2, None)
+    assert (await queue_status(queue, "key5")).expired_count is None
+
+
+@pytest.mark.asyncio
+async def test_caps_drop_oldest(make_queue):
+    queue = make_queue(limits=LimitsConfig(max_messages_per_key=2, max_messages=5))
+    for i in range(4):
+        queue._add(message("a", f"a{i}"), i)
+    for i in range(3):
+        queue._add(message("b", f"b{i}"), 10 + i)
+    queue._add(message("c", "c0"), 20)
+    assert await tags(queue, "a") == ["a2", "a3"]
+    assert await tags(queue, "b") == ["b1", "b2"]
+
+    # Over the cap on all messages, the oldest message of any key makes room
+    queue._add(message("c", "c1"), 21)
+    assert await tags(queue, "a") == ["a3"]
+    assert await tags(queue, "c") == ["c0", "c1"]
+    assert await queue.take_dropped("a") == (0, 3)
+    assert await queue.take_dropped("b") == (0, 1)
+    assert (queue.evicted, queue.rejected) == (4, 0)
+
+
+@pytest.mark.asyncio
+async def test_caps_reject_new(make_queue):
+    size = len(message("key", "tag").enc_payload)
+    queue = make_queue(
+        limits=LimitsConfig(
+            max_messages_per_key=2, max_bytes=3 * size, policy="reject-new"
+        )
+    )
+    for i in range(3):
+        queue._add(message("a", f"a{i}"), i)
+    queue._add(message("b", "b0"), 10)
+    queue._add(message("b", "b1"), 11)
+    assert await tags(queue, "a") == ["a0", "a1"]
+    assert await tags(queue, "b") == ["b0"]
+    assert await queue.take_dropped("a") == (0, 1)
+    assert await queue.take_dropped("b") == (0, 1)
+    assert (queue.evicted, queue.rejected) == (0, 2)
+
+    # Messages are turned away before being queued with the same checks
+    assert not await queue.admit("c", size)
+    assert await queue.take_dropped("c") == (0, 1)
+
+
+@pytest.mark.asyncio
+async def test_leases_end_after_timeout(queue):
+    for tag in "abc":
+        queue.add_message(message("key", tag))
+    first, second, third = [
+        queued.seq async for queued in queue.messages_for_key("key")
+    ]
+    assert await queue.lease("key", [first, second], 60) == [first, second]
+    assert await queue.lease("key", [second, third], 0) == [third]
+    assert await queue.leased("key") == {first, second}
+    assert await queue.lease("key", [third], 60) == [third]
+    assert await queue.leased("other") == set()
+
+
+@pytest.mark.asyncio
+async def test_remove_through_keeps_leases_of_others(queue):
+    for tag in "abcd":
+        queue.add_message(message("key", tag))
+    seqs = [queued.seq async for queued in queue.messages_for_key("key")]
+    assert await queue.lease("key", seqs[:2], 60, owner="a") == seqs[:2]
+    assert await queue.lease("key", seqs[2:3], 60, owner="b") == seqs[2:3]
+    assert await queue.leased_to_others("key", "b") == set(seqs[:2])
+
+    keep = await queue.leased_to_others("key", "b")
+    assert await queue.remove_through("key", seqs[2], keep=keep) == 1
+    assert await tags(queue, "key") == ["a", "b", "d"]
+
+
+@pytest.mark.asyncio
+async def test_wait_skips_leased_messages(queue):
+    queue.add_message(message("key", "a"))
+    (seq,) = [queued.seq async for queued in queue.messages_for_key("key")]
+    await queue.lease("key", [seq], 0.5)
+
+    # Every message is leased, so the wait runs its course
+    started = time.monotonic()
+    assert not await queue.wait_for_messages("key", 0.1, skip_leased=True)
+    assert time.monotonic() - started >= 0.1
+    assert await queue.wait_for_messages("key", 0.1)
+
+    # A message queued meanwhile ends the wait
+    waiter = asyncio.ensure_future(queue.wait_for_messages("key", 10, skip_leased=True))
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+    queue.add_message(message("key", "b"))
+    assert await waiter
+
+    # As does the end of a lease
+    await queue.remove_by_tags("key", ["b"])
+    started = time.monotonic()
+    assert await queue.wait_for_messages("key", 10, skip_leased=True)
+    assert 0.05 < time.monotonic() - started < 1
+
+
+@pytest.mark.asyncio
+async def test_remove_by_sequence(queue):
+    for tag in "abcde":
+        queue.add_message(message("key", tag))
+    queue.add_message(message("other", "x"))
+    seqs = [queued.seq async for queued in queue.messages_for_key("key")]
+    assert seqs == sorted(seqs)
+
+    assert await queue.remove_through("key", seqs[1]) == 2
+    assert await queue.remove_through("key", seqs[1]) == 0
+    await queue.record_delivery("key", "delivery", seqs[3:])
+    assert (
+        await queue.remove_seqs("key", await queue.take_delivery("key", "delivery"))
+        == 2
+    )
+    assert not await queue.take_delivery("key", "delivery")
+    assert await tags(queue, "key") == ["c"]
+    assert await tags(queue, "other") == ["x"]
+
+    # Messages kept are left in place, those around them removed
+    for tag in "fghi":
+        queue.add_message(message("key", tag))
+    seqs = [queued.seq async for queued in queue.messages_for_key("key")]
+    assert await queue.remove_through("key", seqs[3], keep=[seqs[1], seqs[4]]) == 3
+    assert await tags(queue, "key") == ["f", "i"]
+
+
+@pytest.mark.parametrize("codec", ["zlib", "lzma"])
+def test_compressed_payloads(codec):
+    queue = MemoryPickupQueue(
+        compression=CompressionConfig(codec=codec, min_size=100, level=1)
+    )
+    large = message("key", "large")
+    large.enc_payload = json.dumps({"ciphertext": "abc" * 100, "tag": "large"})
+    queue.add_message(large)
+    queue.add_message(message("key", "small"))
+    first, second = queue.queued_messages_for_key("key")
+
+    # Only payloads of at least min_size are compressed, keeping their metadata
+    assert (first.tag, first.size) == ("large", len(large.enc_payload))
+    assert len(first.enc_payload) < first.size
+    assert second.enc_payload == message("key", "small").enc_payload.encode()
+    assert queue.size_by_key["key"] == first.size + second.size
+    assert queue.compressor.compressed == 1
+    assert queue.compressor.ratio == first.size / len(first.enc_payload)
+
+    # and only decompressed for delivery
+    assert queue.compressor.decompressed == 0
+    assert base64.b64decode(first.b64_payload) == large.enc_payload.encode()
+    assert queue.get_one_message_for_key("key").enc_payload == (
+        large.enc_payload.encode()
+    )
+    assert queue.compressor.decompressed == 2
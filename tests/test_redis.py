@@ -0,0 +1,231 @@
+"""Test Redis pickup queue against an in-process stand-in server."""
+
+import asyncio
+import base64
+import json
+import time
+
+import pytest
+
+from acapy_plugin_pickup.config import CompressionConfig
+from acapy_plugin_pickup.queue import RedisPickupQueue
+from acapy_plugin_pickup.queue.resp import RespClient
+
+from conftest import message, tags
+
+
+def replica(resp_server) -> RedisPickupQueue:
+    return RedisPickupQueue(RespClient.from_url(resp_server.url), page_size=2)
+
+
+@pytest.mark.asyncio
+async def test_replicas_share_queue(resp_server):
+    first, second = replica(resp_server), replica(resp_server)
+    for tag in "abcde":
+        first.add_message(message("key", tag))
+    await first.flush()
+
+    assert await second.count_for_key("key") == 5
+    assert await tags(second, "key") == list("abcde")
+    assert await tags(second, "key", 3) == list("abc")
+    assert await first.remove_by_tags("key", ["a", "c", "missing"]) == 2
+    assert await tags(second, "key") == list("bde")
+
+    second.add_message(message("key"))
+    (*_, queued) = [queued async for queued in second.messages_for_key("key")]
+    await second.store_enc_payload(queued, json.dumps({"tag": "late"}))
+    assert await first.remove_by_tags("key", ["late"]) == 1
+    assert await first.count_for_key("key") == 3
+
+    await first.close()
+    await second.close()
+
+
+@pytest.mark.asyncio
+async def test_waiters_woken_by_other_replicas(resp_server):
+    first, second = replica(resp_server), replica(resp_server)
+    waiters = [
+        asyncio.ensure_future(second.wait_for_messages(key, 5))
+        for key in ("key", "key", "other")
+    ]
+    await asyncio.sleep(0.1)
+
+    # Parked waiters do not poll
+    round_trips = second.client.round_trips
+    await asyncio.sleep(0.3)
+    assert second.client.round_trips == round_trips
+
+    start = time.monotonic()
+    first.add_message(message("key"))
+    assert await asyncio.gather(*waiters[:2]) == [True, True]
+    assert time.monotonic() - start < 0.5
+    assert not waiters[2].done()
+
+    waiters[2].cancel()
+    await first.close()
+    await second.close()
+
+
+@pytest.mark.asyncio
+async def test_round_trips_independent_of_limit(resp_server):
+    queue = RedisPickupQueue(RespClient.from_url(resp_server.url), page_size=100)
+    for i in range(100):
+        queue.add_message(message("key", str(i)))
+    await queue.flush()
+
+    async def cost(operation) -> int:
+        before = queue.client.round_trips
+        await operation
+        return queue.client.round_trips - before
+
+    async def deliver(limit):
+        assert len(await tags(queue, "key", limit)) == limit
+
+    assert await cost(deliver(1)) == await cost(deliver(50)) == 2
+    assert await cost(queue.remove_by_tags("key", ["0"])) == 3
+    assert await cost(queue.remove_by_tags("key", map(str, range(1, 60)))) == 3
+    assert await cost(queue.stats_for_key("key")) == 2
+    await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_stats_follow_queue(resp_server):
+    first, second = replica(resp_server), replica(resp_server)
+    for tag in "abc":
+        first.add_message(message("key", tag))
+    second.add_message(message("key"))
+    size = len(message("key", "a").enc_payload)
+
+    await second.flush()
+    stats = await first.stats_for_key("key")
+    assert (stats.count, stats.total_size) == (4, 3 * size + 2)
+    assert stats.oldest <= stats.newest
+
+    queued_messages = [queued async for queued in first.messages_for_key("key")]
+    (plain,) = [queued for queued in queued_messages if queued.tag is None]
+    await first.store_enc_payload(plain, message("key", "d").enc_payload)
+    assert await first.remove_by_tags("key", ["a", "c"]) == 2
+    assert await second.remove_by_tags("key", ["a", "b"]) == 1
+    stats = await second.stats_for_key("key")
+    assert (stats.count, stats.total_size) == (1, size)
+    await first.close()
+    await second.close()
+
+
+@pytest.mark.asyncio
+async def test_acapy_queue_interface(resp_server):
+    first, second = replica(resp_server), replica(resp_server)
+    for tag in "abc":
+        first._add(message("key", tag), 100)
+    # Buffered messages are counted before they are written
+    assert first.message_count_for_key("key") == 3
+    await first.flush()
+    assert first.has_message_for_key("key")
+    assert not first.has_message_for_key("other")
+
+    # Messages of other replicas are counted once the key is read again
+    second._add(message("key", "d"), 200)
+    await second.flush()
+    assert first.message_count_for_key("key") == 3
+    assert await first.count_for_key("key") == 4
+    assert first.message_count_for_key("key") == 4
+
+    # Buffered messages expire at once, written ones in the background
+    first._add(message("key", "e"), 100)
+    first.expire_messages(ttl=time.time() - 150)
+    assert first.expired == 1
+    await first._sync_expiry
+    assert first.expired == 4
+    assert await tags(second, "key") == ["d"]
+    assert first.message_count_for_key("key") == 1
+    assert await second.take_dropped("key") == (4, 0)
+    await first.close()
+    await second.close()
+
+
+@pytest.mark.asyncio
+async def test_replicas_share_leases(resp_server):
+    first, second = replica(resp_server), replica(resp_server)
+    for tag in "abc":
+        first.add_message(message("key", tag))
+    seqs = [queued.seq async for queued in first.messages_for_key("key")]
+
+    assert await first.lease("key", seqs[:2], 60) == seqs[:2]
+    assert await second.lease("key", seqs, 60) == seqs[2:]
+    assert await second.leased("key") == set(seqs)
+    assert await first.lease("key", [], 60) == []
+
+    # Ended leases and those of removed messages are dropped
+    await second.remove_by_tags("key", ["a"])
+    assert await first.lease("key", seqs[2:], 0) == []
+    assert await first.leased("key") == set(seqs[1:])
+    await first.close()
+    await second.close()
+
+
+@pytest.mark.asyncio
+async def test_remove_through_keeps_leases_of_others(resp_server):
+    first, second = replica(resp_server), replica(resp_server)
+    for tag in "abcd":
+        first.add_message(message("key", tag))
+    seqs = [queued.seq async for queued in first.messages_for_key("key")]
+    assert await first.lease("key", seqs[:2], 60, owner="a") == seqs[:2]
+    assert await second.lease("key", seqs[2:3], 60, owner="b") == seqs[2:3]
+
+    # Owners are shared by replicas
+    keep = await first.leased_to_others("key", "b")
+    assert keep == set(seqs[:2])
+    assert await second.remove_through("key", seqs[2], keep=keep) == 1
+    assert await tags(first, "key") == ["a", "b", "d"]
+    await first.close()
+    await second.close()
+
+
+@pytest.mark.asyncio
+async def test_remove_by_sequence(resp_server):
+    first, second = replica(resp_server), replica(resp_server)
+    for tag in "abcde":
+        first.add_message(message("key", tag))
+    first.add_message(message("other", "x"))
+    seqs = [queued.seq async for queued in first.messages_for_key("key")]
+    assert seqs == [1, 2, 3, 4, 5]
+
+    # Prefixes are removed a page at a time
+    assert await first.remove_through("key", 3) == 3
+    assert await first.remove_through("key", 3) == 0
+
+    # Deliveries recorded by one replica are acknowledged through another
+    await first.record_delivery("key", "delivery", [4, 6])
+    assert await second.remove_seqs("key", await second.take_delivery("key", "d")) == 0
+    assert (
+        await second.remove_seqs("key", await second.take_delivery("key", "delivery"))
+        == 1
+    )
+    assert await first.take_delivery("key", "delivery") == []
+    assert await tags(first, "key") == ["e"]
+    assert await first.count_for_key("key") == 1
+    assert await tags(first, "other") == ["x"]
+    await first.close()
+    await second.close()
+
+
+@pytest.mark.asyncio
+async def test_compressed_payloads(resp_server):
+    queue = RedisPickupQueue(
+        RespClient.from_url(resp_server.url),
+        compression=CompressionConfig(codec="zlib", min_size=0),
+    )
+    queue.add_message(message("key", "a" * 1000))
+    (queued,) = [queued async for queued in queue.messages_for_key("key")]
+    assert queued.tag == "a" * 1000
+    assert len(queued.enc_payload) < queued.size
+    assert await queue.stats_for_key("key") == (
+        1,
+        queued.size,
+        *(queued.timestamp,) * 2,
+    )
+    assert (
+        base64.b64decode(queued.b64_payload)
+        == message("key", "a" * 1000).enc_payload.encode()
+    )
+    await queue.close()
@@ -0,0 +1,133 @@
+"""Test the admin routes of the plugin."""
+
+import base64
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from aiohttp import web
+from aries_cloudagent.core.in_memory import InMemoryProfile
+from aries_cloudagent.transport.inbound.manager import InboundTransportManager
+
+from acapy_plugin_pickup.queue import MemoryPickupQueue
+from acapy_plugin_pickup.v2_0.routes import (
+    list_queues,
+    purge_queues,
+    queue_detail,
+    remove_queue,
+    remove_queued_tags,
+)
+
+from conftest import message
+
+
+class Request(dict):
+    """Stand-in for an admin request."""
+
+    def __init__(self, queue, query=None, match_info=None, body=None):
+        super().__init__()
+        profile = InMemoryProfile.test_profile()
+        manager = InboundTransportManager(profile, None)
+        manager.undelivered_queue = queue
+        profile.context.injector.bind_instance(InboundTransportManager, manager)
+        self["context"] = SimpleNamespace(profile=profile)
+        self.query = query or {}
+        self.match_info = match_info or {}
+        self.body = body
+
+    async def json(self):
+        return self.body
+
+
+async def call(handler, *args, **kwargs) -> dict:
+    response = await handler(Request(*args, **kwargs))
+    return json.loads(response.body)
+
+
+@pytest.fixture
+def queue():
+    queue = MemoryPickupQueue()
+    for n in range(5):
+        for i in range(n + 1):
+            queue._add(message(f"key{n}", f"{n}-{i}"), 1000 + i - n)
+    return queue
+
+
+@pytest.mark.asyncio
+async def test_list_queues(queue):
+    listed, cursor = [], None
+    while True:
+        query = {
+            "order": "depth",
+            "limit": "2",
+            **({"cursor": cursor} if cursor else {}),
+        }
+        page = await call(list_queues, queue, query)
+        listed.extend(result["recipient_key"] for result in page["results"])
+        cursor = page["next"]
+        if not cursor:
+            break
+    assert listed == ["key4", "key3", "key2", "key1", "key0"]
+
+    (oldest,) = (await call(list_queues, queue, {"order": "age", "limit": "1"}))[
+        "results"
+    ]
+    assert oldest["recipient_key"] == "key4"
+    assert oldest["message_count"] == 5
+    assert oldest["oldest_time"].startswith("1970-01-01T00:16:36")
+
+    with pytest.raises(web.HTTPBadRequest):
+        await call(list_queues, queue, {"order": "age", "cursor": cursor or "x"})
+    page = await call(list_queues, queue, {"order": "depth", "limit": "2"})
+    with pytest.raises(web.HTTPBadRequest):
+        await call(list_queues, queue, {"order": "age", "cursor": page["next"]})
+
+    # Cursors decoding to JSON of another shape are rejected alike
+    for decoded in ("{}", "1", '{"a": 1, "b": 2, "c": 3}', '["depth", "1", "key"]'):
+        cursor = base64.urlsafe_b64encode(decoded.encode()).decode()
+        with pytest.raises(web.HTTPBadRequest):
+            await call(list_queues, queue, {"order": "depth", "cursor": cursor})
+
+
+@pytest.mark.asyncio
+async def test_queue_detail(queue):
+    detail = await call(
+        queue_detail, queue, {"limit": "3"}, match_info={"recipient_key": "key4"}
+    )
+    assert detail["message_count"] == 5
+    assert [m["tag"] for m in detail["messages"]] == ["4-0", "4-1", "4-2"]
+    assert all(m["encrypted"] for m in detail["messages"])
+
+    detail = await call(
+        queue_detail,
+        queue,
+        {"after": str(detail["next"])},
+        match_info={"recipient_key": "key4"},
+    )
+    assert [m["tag"] for m in detail["messages"]] == ["4-3", "4-4"]
+    assert detail["next"] is None
+
+
+@pytest.mark.asyncio
+async def test_remove(queue):
+    key4 = {"recipient_key": "key4"}
+    removed = await call(
+        remove_queued_tags, queue, match_info=key4, body={"tags": ["4-4"]}
+    )
+    assert removed == {"removed": 1}
+    assert await call(remove_queue, queue, match_info=key4) == {"removed": 4}
+    assert not queue.message_count_for_key("key4")
+
+    # Messages queued in 1970 are older than any age
+    purged = await call(purge_queues, queue, body={"older_than": 60, "limit": 2})
+    assert purged == {"removed": 4 + 3, "more": True}
+    purged = await call(purge_queues, queue, body={"older_than": 60})
+    assert purged == {"removed": 2 + 1, "more": False}
+    assert not queue.queue_by_key
+
+    queue._add(message("key0", "new"), 1000)
+    purged = await call(purge_queues, queue, body={"recipient_keys": ["key0", "key9"]})
+    assert purged == {"removed": 1, "more": False}
+    with pytest.raises(web.HTTPBadRequest):
+        await call(purge_queues, queue, body={})
@@ -0,0 +1,50 @@
+"""Test session index."""
+
+from aries_cloudagent.core.in_memory import InMemoryProfile
+from aries_cloudagent.transport.inbound.manager import InboundTransportManager
+from aries_cloudagent.transport.inbound.session import InboundSession
+
+from acapy_plugin_pickup.sessions import get_session_index, session_for_verkey
+
+
+def session(manager: InboundTransportManager, session_id: str, *verkeys: str):
+    session = InboundSession(
+        profile=manager.profile,
+        inbound_handler=None,
+        session_id=session_id,
+        wire_format=None,
+        close_handler=manager.closed_session,
+        reply_verkeys=verkeys,
+    )
+    manager.sessions[session_id] = session
+    return session
+
+
+def test_index_follows_sessions():
+    manager = InboundTransportManager(InMemoryProfile.test_profile(), None)
+    existing = session(manager, "existing", "a")
+    index = get_session_index(manager)
+    assert index.session_for_verkey("a") is existing
+
+    new = session(manager, "new")
+    assert index.session_for_verkey("b") is None
+    new.add_reply_verkeys("b")
+    assert index.session_for_verkey("b") is new
+
+    new.close()
+    assert "new" not in manager.sessions
+    assert index.session_for_verkey("b") is None
+    assert "b" not in index.sessions_by_verkey
+
+
+def test_stale_index_falls_back_to_scan():
+    manager = InboundTransportManager(InMemoryProfile.test_profile(), None)
+    index = get_session_index(manager)
+    first = session(manager, "first", "a")
+
+    # Replacing the reply verkeys bypasses the index
+    first.reply_verkeys = ["b"]
+    assert index.session_for_verkey("a") is None
+    assert index.session_for_verkey("b") is None
+    assert session_for_verkey(manager, "b") is first
+    assert index.session_for_verkey("b") is first
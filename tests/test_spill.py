@@ -0,0 +1,134 @@
+"""Test pickup queue spilling payloads to segment files."""
+
+import base64
+import json
+import os
+
+import pytest
+
+from acapy_plugin_pickup.config import CompressionConfig, PickupConfig
+from acapy_plugin_pickup.queue import SpillPickupQueue, create_queue
+
+from conftest import message
+
+
+def segment_files(queue: SpillPickupQueue):
+    return sorted(os.listdir(queue.directory))
+
+
+async def payloads(queue, key: str):
+    return [json.loads(queued.payload) async for queued in queue.messages_for_key(key)]
+
+
+@pytest.mark.asyncio
+async def test_payloads_spill_past_memory_budget(tmp_path):
+    queue = SpillPickupQueue(str(tmp_path), memory_bytes=250)
+    for tag in "abcde":
+        queue.add_message(message("key", tag, "a" * 70))
+    size = len(message("key", "a", "a" * 70).enc_payload)
+
+    # The payloads held last stay in memory, the others are appended to a segment
+    assert queue.resident_bytes == 2 * size
+    assert (queue.spilled, queue.spilled_bytes) == (3, 3 * size)
+    assert segment_files(queue) == ["00000001.seg"]
+    assert [payload["tag"] for payload in await payloads(queue, "key")] == list("abcde")
+    (first,) = [queued async for queued in queue.messages_for_key("key", 1)]
+    assert first.encrypted and first.enc_payload is None
+    assert first.msg.enc_payload == first.payload
+    assert first.b64_payload
+
+    # Sizes are those of the payloads, wherever they are held
+    assert (await queue.stats_for_key("key")).total_size == 5 * size
+
+    assert await queue.remove_by_tags("key", ["a", "e"]) == 2
+    assert (queue.resident_bytes, queue.spilled_bytes) == (size, 2 * size)
+
+    # Payloads held in memory keep their base64 encoding, until spilled
+    *_, held = [queued async for queued in queue.messages_for_key("key")]
+    assert held.segment is None and held.b64_payload is held.b64_payload
+    for tag in "fg":
+        queue.add_message(message("key", tag, "a" * 70))
+    assert held.segment is not None and held._b64_payload is None
+    assert base64.b64decode(held.b64_payload) == held.payload
+    await queue.close()
+    assert segment_files(queue) == []
+
+
+@pytest.mark.asyncio
+async def test_segments_compacted_once_mostly_removed(tmp_path):
+    queue = SpillPickupQueue(str(tmp_path), memory_bytes=0, segment_bytes=1000)
+    for i in range(20):
+        queue.add_message(message("key", f"{i:02d}", "a" * 70))
+    size = len(message("key", "00", "a" * 70).enc_payload)
+    assert queue.resident_bytes == 0
+    assert len(segment_files(queue)) == 20 // (1000 // size) + 1
+
+    # Removing most messages of the first segment moves the others to the last
+    per_segment = 1000 // size
+    removed = [f"{i:02d}" for i in range(per_segment - 1)]
+    assert await queue.remove_by_tags("key", removed) == len(removed)
+    assert queue.compactions == 1
+    assert "00000001.seg" not in segment_files(queue)
+    assert queue.spilled_bytes == (20 - len(removed)) * size
+    assert [payload["tag"] for payload in await payloads(queue, "key")] == [
+        f"{i:02d}" for i in range(per_segment - 1, 20)
+    ]
+
+    # A message is read as it is removed, though that compacts its segment
+    await queue.remove_by_tags("key", [f"{i:02d}" for i in range(per_segment, 20)])
+    msg = queue.get_one_message_for_key("key")
+    assert json.loads(msg.enc_payload)["tag"] == f"{per_segment - 1:02d}"
+    assert queue.spilled_bytes == 0
+    # Sealed segments are deleted, the active one is kept
+    assert queue.compactions == 2
+    assert segment_files(queue) == ["00000003.seg"]
+    await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_plaintext_spilled_once_encrypted(tmp_path):
+    queue = SpillPickupQueue(str(tmp_path), memory_bytes=0)
+    queue.add_message(message("key"))
+    (queued,) = [queued async for queued in queue.messages_for_key("key")]
+    assert not queued.encrypted and queue.spilled == 0
+
+    await queue.store_enc_payload(queued, json.dumps({"tag": "late"}))
+    assert queued.encrypted and queued.segment is not None
+    assert await queue.remove_by_tags("key", ["late"]) == 1
+    assert queue.spilled_bytes == 0
+    await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_compressed_payloads_spilled(tmp_path):
+    queue = SpillPickupQueue(
+        str(tmp_path),
+        memory_bytes=0,
+        compression=CompressionConfig(codec="zlib", min_size=100),
+    )
+    queue.add_message(message("key", "a", "a" * 1000))
+    (queued,) = [queued async for queued in queue.messages_for_key("key")]
+    assert queued.stored_size < queued.size
+    assert json.loads(queued.payload)["tag"] == "a"
+    await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_created_from_config(tmp_path):
+    (tmp_path / "00000001.seg").write_bytes(b"left over")
+    config = PickupConfig.parse_obj(
+        {"backend": "spill", "spill": {"directory": str(tmp_path), "memory_bytes": 0}}
+    )
+    queue = create_queue(config)
+    assert isinstance(queue, SpillPickupQueue)
+    assert segment_files(queue) == []
+    queue.add_message(message("key", "a"))
+    assert await payloads(queue, "key") == [{"ciphertext": "abc", "tag": "a"}]
+    await queue.close()
+
+    # Without a directory, segments go to a temporary directory removed on close
+    queue = SpillPickupQueue(memory_bytes=0)
+    queue.add_message(message("key", "a"))
+    assert segment_files(queue) == ["00000001.seg"]
+    await queue.close()
+    assert not os.path.exists(queue.directory)
@@ -0,0 +1,196 @@
+"""Test SQLite pickup queue."""
+
+import base64
+import json
+import sqlite3
+import time
+
+import pytest
+
+from aries_cloudagent.connections.models.connection_target import ConnectionTarget
+from aries_cloudagent.transport.outbound.message import OutboundMessage
+
+from acapy_plugin_pickup.config import CompressionConfig
+from acapy_plugin_pickup.queue import SqlitePickupQueue
+
+from conftest import message, replied, tags
+
+
+@pytest.mark.asyncio
+async def test_queue_round_trip(tmp_path):
+    path = str(tmp_path / "queue.db")
+    queue = SqlitePickupQueue(path, page_size=2)
+    for tag in "abcde":
+        queue.add_message(message("key", tag))
+    queue.add_message(message("other", "a"))
+
+    assert await queue.count_for_key("key") == 5
+    assert await tags(queue, "key") == list("abcde")
+    assert await tags(queue, "key", 3) == list("abc")
+    assert await queue.remove_by_tags("key", {"a", "c", "missing"}) == 2
+    await queue.close()
+
+    queue = SqlitePickupQueue(path)
+    assert await tags(queue, "key") == list("bde")
+    assert await queue.count_for_key("other") == 1
+    await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_store_enc_payload():
+    queue = SqlitePickupQueue()
+    queue.add_message(
+        OutboundMessage(
+            payload="{}",
+            reply_to_verkey="key",
+            target_list=[ConnectionTarget(recipient_keys=["key"], sender_key="sender")],
+        )
+    )
+    (queued,) = [queued async for queued in queue.messages_for_key("key")]
+    assert queued.tag is None
+    assert queued.msg.target_list[0].sender_key == "sender"
+
+    await queue.store_enc_payload(queued, json.dumps({"tag": "late"}))
+    (stored,) = [queued async for queued in queue.messages_for_key("key")]
+    assert stored.tag == "late"
+
+    # The first payload stored wins
+    queued.enc_payload = None
+    await queue.store_enc_payload(queued, json.dumps({"tag": "later"}))
+    assert queued.tag == "late"
+    assert await queue.remove_by_tags("key", ["late"]) == 1
+    assert not queue.has_message_for_key("key")
+
+
+@pytest.mark.asyncio
+async def test_acapy_queue_interface(tmp_path):
+    path = str(tmp_path / "queue.db")
+    queue = SqlitePickupQueue(path)
+    for tag in "abc":
+        queue._add(message("key", tag), 100)
+    # Messages are counted in process, before they are inserted
+    assert queue.message_count_for_key("key") == 3
+    assert queue.has_message_for_key("key")
+    assert not queue.has_message_for_key("other")
+    assert await queue.remove_by_tags("key", ["a"]) == 1
+    assert queue.message_count_for_key("key") == 2
+
+    # Messages are only handed out through pickup
+    assert list(queue.inspect_all_messages_for_key("key")) == []
+    assert queue.get_one_message_for_key("key") is None
+
+    # Messages expire in the background
+    queue._add(message("key", "d"), 200)
+    queue.expire_messages(ttl=time.time() - 150)
+    await queue._sync_expiry
+    assert queue.expired == 2
+    assert await tags(queue, "key") == ["d"]
+    assert queue.message_count_for_key("key") == 1
+    await queue.close()
+
+    # Counts are read back on opening
+    queue = SqlitePickupQueue(path)
+    assert queue.message_count_for_key("key") == 1
+    await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_stats_computed_on_opening(tmp_path):
+    path = str(tmp_path / "queue.db")
+    queue = SqlitePickupQueue(path)
+    for tag in "abcd":
+        queue.add_message(message("key", tag))
+    size = len(message("key", "a").enc_payload)
+    assert await queue.remove_by_tags("key", ["a", "c"]) == 2
+    await queue.close()
+
+    # Queues created before stats were kept get them computed on opening
+    conn = sqlite3.connect(path)
+    conn.executescript("DROP TABLE queue_stats")
+    conn.close()
+    queue = SqlitePickupQueue(path)
+    assert (await queue.stats_for_key("key"))[:2] == (2, 2 * size)
+    assert await queue.remove_by_tags("key", ["b", "d"]) == 2
+    assert await queue.stats_for_key("key") == (0, 0, None, None)
+    await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_reply_columns_added(tmp_path):
+    path = str(tmp_path / "queue.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE queued_messages (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "recipient_key TEXT NOT NULL, received_at REAL NOT NULL, tag TEXT, "
+        "size INTEGER, enc_payload BLOB, payload BLOB, target TEXT)"
+    )
+    conn.execute(
+        "INSERT INTO queued_messages (recipient_key, received_at, tag, size, "
+        "enc_payload) VALUES ('key', 1, 'old', 3, X'616263')"
+    )
+    conn.commit()
+    conn.close()
+
+    # Queues created before the reply columns are upgraded in place
+    queue = SqlitePickupQueue(path)
+    queue.add_message(replied("new"))
+    rebuilt = {queued.tag: queued.msg async for queued in queue.messages_for_key("key")}
+    assert rebuilt["old"].reply_to_verkey is None
+    assert rebuilt["new"].reply_thread_id == "thread"
+    await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_stats_triggers_dropped(tmp_path):
+    path = str(tmp_path / "queue.db")
+    queue = SqlitePickupQueue(path)
+    queue.add_message(message("key", "a"))
+    await queue.close()
+
+    # Earlier versions kept the stats with triggers, which would count twice
+    conn = sqlite3.connect(path)
+    conn.executescript(
+        "CREATE TRIGGER queue_stats_insert AFTER INSERT ON queued_messages BEGIN "
+        "UPDATE queue_totals SET count = count + 1; END"
+    )
+    conn.close()
+    queue = SqlitePickupQueue(path)
+    assert not queue.conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger'"
+    ).fetchall()
+    queue.add_message(message("key", "b"))
+    queue.flush()
+    assert queue.conn.execute("SELECT count FROM queue_totals").fetchone() == (2,)
+    assert (await queue.stats_for_key("key")).count == 2
+    await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_compressed_payloads(tmp_path):
+    path = str(tmp_path / "queue.db")
+    queue = SqlitePickupQueue(
+        path, compression=CompressionConfig(codec="lzma", min_size=0)
+    )
+    enc_payload = json.dumps({"ciphertext": "abc" * 100, "tag": "a"})
+    queue.add_message(message("key", "a"))
+    queue.add_message(message("key"))
+    (_, plaintext) = [queued async for queued in queue.messages_for_key("key")]
+    await queue.store_enc_payload(plaintext, enc_payload)
+    ((stored,),) = queue.conn.execute(
+        "SELECT enc_payload FROM queued_messages WHERE seq = ?", (plaintext.seq,)
+    )
+    assert len(stored) < len(enc_payload)
+    await queue.close()
+
+    # Compressed payloads are read whatever the configuration
+    queue = SqlitePickupQueue(path)
+    first, second = [queued async for queued in queue.messages_for_key("key")]
+    assert (
+        first.b64_payload
+        == base64.b64encode(
+            json.dumps({"ciphertext": "abc", "tag": "a"}).encode()
+        ).decode()
+    )
+    assert (second.tag, second.size) == ("a", len(enc_payload))
+    assert base64.b64decode(second.b64_payload) == enc_payload.encode()
+    await queue.close()